@@ -56,6 +56,14 @@ class CircTest(circ_module.circ_template.CircTemplate):
             # exit with -1 error if we can't use it
             exit(-1)
 
+        # the R script reads the text tables, recreate them from the sparse .npz count matrices of detect -sp
+        from detect import countMatrix
+        for table in ["CircRNACount", "LinearCount"]:
+            table = self.cli_params.detect_dir + table
+            if not os.path.isfile(table) and os.path.isfile(countMatrix.npzname(table)):
+                self.log_entry("Writing %s from %s" % (table, countMatrix.npzname(table)))
+                countMatrix.readnpz(table).writetext(table)
+
         # check DCC files (only existence, not the content)
         self.check_input_files([
             self.cli_params.detect_dir + "CircRNACount",
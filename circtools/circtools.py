@@ -198,6 +198,25 @@ class CircTools(object):
                            default=False
                            )
 
+        group.add_argument("-s",
+                           "--seed",
+                           dest="seed",
+                           help="Seed of the random number generator used for the shuffling of the input peaks "
+                                "[default: random]",
+                           type=int,
+                           default=None
+                           )
+
+        group.add_argument("-C",
+                           "--checkpoint",
+                           dest="checkpoint_iterations",
+                           help="Number of iterations after which the state of the permutation test is saved to "
+                                "the output folder. An interrupted run is resumed from there when started again "
+                                "[default: 100]",
+                           type=int,
+                           default=100
+                           )
+
         args = parser.parse_args(sys.argv[2:])
 
         # make sure we can load the sub module
@@ -829,6 +848,9 @@ class CircTools(object):
                             help="Output directory [default: .]")
         parser.add_argument("-t", "--temp", dest="tmp_dir", default="_tmp_circtools/",
                             help="Temporary directory [default: _tmp_circtools/]")
+        parser.add_argument("-sp", "--sparse", dest="sparse", action="store_true", default=False,
+                            help="Also store CircRNACount and LinearCount as sparse matrices (.npz), which are "
+                                 "read by circtools instead of the text tables [default: False]")
 
         group = parser.add_argument_group("Find circRNA Options", "Options to find circRNAs from STAR output")
         group.add_argument("-D", "--detect", action="store_true", dest="detect", default=False,
@@ -843,10 +865,20 @@ class CircTools(object):
                            help="The maximum length of candidate circRNAs (including introns) [default: 1000000]")
         group.add_argument("-n", "--minimum", dest="min", type=int, default=30,
                            help="The minimum length of candidate circRNAs (including introns) [default 30]")
+        group.add_argument("-st", "--streaming", action="store_true", dest="streaming", default=False,
+                           help="Detect circRNAs in a single pass over each junction file without writing "
+                                "intermediate temporary files [default: False]")
+        group.add_argument("-cs", "--chunk-size", dest="chunk_size", type=int, default=0,
+                           help="Split junction files into chunks of this many MB which are processed in parallel; "
+                                "0 processes every file as a whole [default: 0]")
         group.add_argument("-an", "--annotation", dest="annotate",
                            help="Gene annotation file in GTF/GFF3 format, to annotate "
                                 "circRNAs by their host gene name/identifier")
 
+        group.add_argument("-ac", "--annotation-cache", dest="annotation_cache",
+                           help="Directory to cache the data derived from the annotation file (-an), so "
+                                "later runs with the same annotation do not parse it again")
+
         group.add_argument("-Pi", "--PE-independent", action="store_true", dest="pairedendindependent", default=False,
                            help="Has to be specified if the paired end mates have also been mapped separately."
                                 "If specified, -mt1 and -mt2 must also be provided [default: False]")
@@ -1,10 +1,143 @@
 # This script is used to fetch the ortholog information per gene 
 # using the REST API by ENSMBLE
+#
+# Coordinates are lifted in-process like liftOver -multiple -minMatch=0.1: the chain file is parsed once per
+# process into per-chromosome arrays of alignment blocks, sorted by start, which are searched for each region.
+import gzip
 import os, sys
-import subprocess
+import numpy as np
 import requests
 import pybedtools
 
+# minimal fraction of the bases of a region which have to be mapped by a chain (liftOver -minMatch)
+MIN_MATCH = 0.1
+
+# chain files parsed in this process, by path
+_chain_indices = {}
+
+
+def chain_index(chain_file):
+    # Parsed chain file, loaded only on first use
+    if chain_file not in _chain_indices:
+        _chain_indices[chain_file] = ChainIndex(chain_file)
+    return _chain_indices[chain_file]
+
+
+class ChainIndex(object):
+    # Alignment blocks of a UCSC chain file (.over.chain or .over.chain.gz) per source chromosome
+
+    def __init__(self, chain_file):
+        self.q_names = []
+        self.q_sizes = []
+        self.q_strands = []
+
+        # source chromosome -> block starts, sizes, target starts and chain numbers
+        blocks = {}
+
+        opener = gzip.open if chain_file.endswith(".gz") else open
+        with opener(chain_file, 'rt') as chain_handle:
+            for line in chain_handle:
+                fields = line.split()
+                if not fields or fields[0].startswith("#"):
+                    continue
+
+                if fields[0] == "chain":
+                    # chain score tName tSize tStrand tStart tEnd qName qSize qStrand qStart qEnd id
+                    chain = len(self.q_names)
+                    self.q_names.append(fields[7])
+                    self.q_sizes.append(int(fields[8]))
+                    self.q_strands.append(fields[9])
+                    t_blocks = blocks.setdefault(fields[2], ([], [], [], []))
+                    t_position, q_position = int(fields[5]), int(fields[10])
+                    continue
+
+                # size [dt dq]: an ungapped block followed by the gaps to the next one
+                size = int(fields[0])
+                t_blocks[0].append(t_position)
+                t_blocks[1].append(size)
+                t_blocks[2].append(q_position)
+                t_blocks[3].append(chain)
+                if len(fields) == 3:
+                    t_position += size + int(fields[1])
+                    q_position += size + int(fields[2])
+
+        self.chromosomes = {}
+        for chrom, (starts, sizes, q_starts, chains) in blocks.items():
+            starts = np.array(starts, dtype='int64')
+            order = np.argsort(starts, kind='stable')
+            sizes = np.array(sizes, dtype='int64')[order]
+            self.chromosomes[chrom] = (starts[order], starts[order] + sizes, np.array(q_starts, dtype='int64')[order],
+                                       np.array(chains, dtype='int64')[order], int(sizes.max()))
+
+    def lift_regions(self, regions, min_match=MIN_MATCH):
+        """Lifts (chromosome, start, end) regions through all chains covering at least min_match of their bases
+        Returns per region a list of (chromosome, start, end, strand) of the lifted regions, in chain file order;
+        strand is "-" if the region is reversed
+        """
+        lifted = [[] for _ in regions]
+
+        by_chromosome = {}
+        for number, (chrom, start, end) in enumerate(regions):
+            if chrom in self.chromosomes and end > start:
+                by_chromosome.setdefault(chrom, []).append(number)
+
+        for chrom, numbers in by_chromosome.items():
+            starts, ends, q_starts, chains, max_size = self.chromosomes[chrom]
+            region_starts = np.array([regions[number][1] for number in numbers], dtype='int64')
+            region_ends = np.array([regions[number][2] for number in numbers], dtype='int64')
+
+            # blocks starting before the region end and not ending before the region start
+            first = np.searchsorted(starts, region_starts - max_size, side='right')
+            last = np.searchsorted(starts, region_ends, side='left')
+
+            for number, start, end, lo, hi in zip(numbers, region_starts.tolist(), region_ends.tolist(),
+                                                  first.tolist(), last.tolist()):
+                overlapping = lo + np.flatnonzero(ends[lo:hi] > start)
+
+                # blocks clipped to the region
+                clipped_starts = np.maximum(starts[overlapping], start)
+                clipped_ends = np.minimum(ends[overlapping], end)
+                clipped_q_starts = q_starts[overlapping] + clipped_starts - starts[overlapping]
+                clipped_q_ends = q_starts[overlapping] + clipped_ends - starts[overlapping]
+
+                for chain in np.unique(chains[overlapping]).tolist():
+                    in_chain = chains[overlapping] == chain
+
+                    if (clipped_ends[in_chain] - clipped_starts[in_chain]).sum() < (end - start) * min_match:
+                        continue
+
+                    q_start = int(clipped_q_starts[in_chain].min())
+                    q_end = int(clipped_q_ends[in_chain].max())
+
+                    if self.q_strands[chain] == "-":
+                        q_start, q_end = self.q_sizes[chain] - q_end, self.q_sizes[chain] - q_start
+
+                    lifted[number].append((self.q_names[chain], q_start, q_end, self.q_strands[chain]))
+
+        return lifted
+
+    def lift_bed(self, bed_lines, min_match=MIN_MATCH):
+        """Lifts BED lines (lists of fields) like liftOver -multiple
+        Returns per line a list of lifted lines: coordinates replaced, the 5th column holds the serial number of
+        the lifted region and the strand is flipped for reversed regions
+        """
+        lifted = []
+
+        for fields, regions in zip(bed_lines, self.lift_regions(
+                [(fields[0], int(fields[1]), int(fields[2])) for fields in bed_lines], min_match)):
+            lifted_lines = []
+            for serial, (chrom, start, end, strand) in enumerate(regions, 1):
+                lifted_fields = [chrom, str(start), str(end)] + list(fields[3:])
+                if len(lifted_fields) > 4:
+                    lifted_fields[4] = str(serial)
+                if len(lifted_fields) > 5 and strand == "-":
+                    lifted_fields[5] = {"+": "-", "-": "+"}.get(lifted_fields[5], lifted_fields[5])
+                lifted_lines.append(lifted_fields)
+            lifted.append(lifted_lines)
+
+        return lifted
+
+
 class liftover(object):
 
     def __init__(self, from_species, to_species, bed_coord, tmpdir, prefix, orthologs, flag, dict_species_liftover) -> None:
@@ -18,17 +151,6 @@ class liftover(object):
         self.ortho_dict = orthologs
         self.dict_species_liftover = dict_species_liftover
 
-    def call_liftover_binary(self):
-        # encapsulated liftover binary call
-
-        # liftover command
-        liftover_utility = os.path.dirname(os.path.realpath(__file__)) + "/liftOver"
-        command = liftover_utility + " " + self.liftover_input_file + " " + self.chain_file + " " + self.liftover_output_file + " " + self.liftover_unlifted_file + "  -multiple -minMatch=0.1"
-        p = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-        return(p)
-
-    
     def lifting(self):
         # function to perform actual lifting
 
@@ -37,86 +159,57 @@ class liftover(object):
             # this is only internal leftover for mouse from version mm10 to mm39
             self.from_id = "mm10"
             self.to_id = "mm39"
-            tmp_from_bed = self.tmpdir + self.prefix + "_liftover_internal.tmp"
-            open(tmp_from_bed, 'w').close()             # erase old contents
         
         elif self.flag == "hg19":
             # this is only internal leftover for mouse from version hg19 to hg38
             self.from_id = "hg19"
             self.to_id = "hg38"
-            tmp_from_bed = self.tmpdir + self.prefix + "_liftover_internal.tmp"
-            open(tmp_from_bed, 'w').close()             # erase old contents
         
         elif self.flag == "other":
             #species_IDs_dict = {"mouse":"mm39", "human":"hg38", "pig":"susScr11", "dog":"canFam6", "rat":"rn7"}
             species_IDs_dict = self.dict_species_liftover
             self.from_id = species_IDs_dict[self.from_species]
             self.to_id = species_IDs_dict[self.to_species]
-            tmp_from_bed = self.tmpdir + self.prefix + "_liftover.tmp"
-            open(tmp_from_bed, 'w').close()             # erase old contents
         
         else:
             print("Unidentified flag for liftOver function:", self.flag)
             sys.exit()
 
         
-        with open(tmp_from_bed, 'a') as data_store:
-            data_store.write("chr" + "\t".join(self.from_coord) + "\n")
         # chain file
         tmp_name_species = self.to_id[0].upper() + self.to_id[1:]
         chain_file = self.from_id + "To" + tmp_name_species + ".over.chain.gz"
         self.chain_file = chain_file
-        
-        tmp_to_bed = tmp_from_bed + ".out"              # output file
-        open(tmp_to_bed, 'a').close()                   # erase old contents
-        tmp_unlifted = tmp_from_bed + ".unlifted"       # unlifted file
-        open(tmp_unlifted, 'a').close()                   # erase old contents
 
-        self.liftover_input_file = tmp_from_bed
-        self.liftover_output_file = tmp_to_bed
-        self.liftover_unlifted_file = tmp_unlifted
-
-        # liftover binary call
-        p = self.call_liftover_binary()
-        
-        # check the command status 
-        out, err = p.communicate()
-        p_status = p.wait()
-        if (p_status != 0):
-            print("liftOver command not run successfully. Exiting!")
-            print(out, err)
+        if not os.path.isfile(chain_file):
+            print("liftOver chain file " + chain_file + " not found. Exiting!")
             sys.exit()
-        else:
-            print("Successfully ran liftOver command " + self.to_species)
+
+        # the chain file is only parsed for the first region lifted with it
+        bed_line = ["chr" + self.from_coord[0]] + list(self.from_coord[1:])
+        self.lifted_coordinates = chain_index(chain_file).lift_bed([bed_line])[0]
+
+        print("Successfully lifted coordinates to " + self.to_species)
 
     def parseLiftover(self):
-        # function to parse liftover output files and return the lifted coordinates to main function
+        # function to return the lifted coordinates to main function
         self.lifting()
-        tmp_from_bed = self.liftover_input_file
-        tmp_to_bed = self.liftover_output_file
-        tmp_unlifted = self.liftover_unlifted_file
-        
-        # read in the unlifted file to see if there were any errors 
-        # if not, read the output file and print the lifted coordinates
-        if os.stat(tmp_unlifted).st_size != 0:
+
+        # if no chain covers enough of the region, the coordinates are unlifted
+        if not self.lifted_coordinates:
             print("Unlifted coordinates present. Liftover did not run well. Exiting!")
             #sys.exit()
             return(None)
-        else:
-            fin = open(tmp_to_bed).readlines() #.strip().split("\t")
-            with open(tmp_to_bed) as fin:
-                lines = fin.read().splitlines()
-            if (len(lines) == 1):
-                #print(lines)
-                lifted_coordinates = lines[0].split("\t")
-            else:
-                # somehow the lifted coordinates are split into two. 
-                for line in lines:
-                    print("Lifted coordinates are splitted into two regions", line)
-            
-            lifted_coordinates[0] = lifted_coordinates[0].replace("chr", "")
-            #print("Lifted coordinates:", lifted_coordinates)
-            return(lifted_coordinates)
+        elif len(self.lifted_coordinates) > 1:
+            # somehow the lifted coordinates are split into two.
+            for line in self.lifted_coordinates:
+                print("Lifted coordinates are splitted into two regions", "\t".join(line))
+            return(None)
+
+        lifted_coordinates = self.lifted_coordinates[0]
+        lifted_coordinates[0] = lifted_coordinates[0].replace("chr", "")
+        #print("Lifted coordinates:", lifted_coordinates)
+        return(lifted_coordinates)
     
     def parse_gff_rest(self, output):
         # function to parse the gff output from REST API exon extraction information
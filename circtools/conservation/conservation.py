@@ -276,6 +276,11 @@ class Conservation(circ_module.circ_template.CircTemplate):
                         lifted = LO.liftover("human", "human", current_line, self.temp_dir, tmp_prefix, {}, "hg19", self.dict_species_liftover)
                         current_line = lifted.parseLiftover()
 
+                    # unlifted or split into several regions by the liftover
+                    if current_line is None:
+                        print("Skipping circRNA, coordinates could not be lifted:", line)
+                        continue
+
                     sep = "_"
                     name = sep.join([current_line[3],
                                         current_line[0],
@@ -9,8 +9,12 @@ from .IntervalTree import IntervalTree
 
 
 class CircNonCircExon(object):
-    def __init__(self, tmp_dir):
+    def __init__(self, tmp_dir, cache=None):
         self.tmp_dir = tmp_dir
+        # optional annotationCache.AnnotationCache of the annotation file
+        self.cache = cache
+        # exon trees read by readexontree, by file name
+        self.exontrees = {}
 
     def print_start_end_file(self, circcoordinates):
         # Print start.bed and end.bed
@@ -44,8 +48,11 @@ class CircNonCircExon(object):
         return start2end
 
     def select_exon(self, gtf_file):
+        exon_sorted = self.tmp_dir + 'tmp_' + os.path.basename(gtf_file) + '.exon.sorted'
+        if self.cache is not None and self.cache.restorefile('exon.sorted', exon_sorted):
+            return
         gtf = HTSeq.GFF_Reader(gtf_file, end_included=True)
-        new_gtf = open(self.tmp_dir + 'tmp_' + os.path.basename(gtf_file) + '.exon.sorted', 'w')
+        new_gtf = open(exon_sorted, 'w')
         gtf_exon = []
         for feature in gtf:
             # Select only exon line
@@ -57,13 +64,19 @@ class CircNonCircExon(object):
         gtf_exon_sorted = ['\t'.join(s) for s in gtf_exon_sorted]
         new_gtf.writelines(gtf_exon_sorted)
         new_gtf.close()
+        if self.cache is not None:
+            self.cache.storefile('exon.sorted', exon_sorted)
 
     def modifyExon_id(self, exon_gtf_file):
+        # the cache holds the modified exon file of the annotation, exon_gtf_file has to be its .exon.sorted file
+        modified = self.tmp_dir + os.path.basename(exon_gtf_file) + '.modified'
+        if self.cache is not None and self.cache.restorefile('exon.sorted.modified', modified):
+            return True
         rtrn = True
         # write custom_exon_id as transcript_id:exon_number
         gtf = HTSeq.GFF_Reader(exon_gtf_file, end_included=True)
         # gff = True
-        new_gtf = open(self.tmp_dir + os.path.basename(exon_gtf_file) + '.modified', 'w')
+        new_gtf = open(modified, 'w')
         exon_number = {}
         for feature in gtf:
             # if gff:
@@ -118,6 +131,8 @@ class CircNonCircExon(object):
         #### MAKE sure only modify and interact with exons!!!!!!!!  FIrst get only exons!!!
         ####  for gff3 files, go for IDs!!!!!!		# Solved
         new_gtf.close()
+        if rtrn and self.cache is not None:
+            self.cache.storefile('exon.sorted.modified', modified)
         return rtrn
 
     def readModifiedgtf(self, modifiedgtf):
@@ -139,12 +154,7 @@ class CircNonCircExon(object):
     def intersectcirc(self, circ_file, modified_gtf_file, strand=True, isStartBED=True):
         # input the result file of print_start_end_file
         input_bed_file = open(circ_file).readlines()
-        exon_gtf_file = HTSeq.GFF_Reader(modified_gtf_file, end_included=True)
-        gtf_exon_sorted = IntervalTree()
-        for feature in exon_gtf_file:
-            row = feature.attr
-            current_bed_interval = feature.iv
-            gtf_exon_sorted.insert(current_bed_interval, annotation=row)
+        gtf_exon_sorted = self.readexontree(modified_gtf_file)
 
         circ_exon_set = {}
         for bed_line in input_bed_file:
@@ -185,6 +195,26 @@ class CircNonCircExon(object):
         # return the filled set
         return circ_exon_set
 
+    def readexontree(self, modified_gtf_file):
+        # IntervalTree of the exons in the modified gtf file, annotated with their custom_exon_id
+        if modified_gtf_file in self.exontrees:
+            return self.exontrees[modified_gtf_file]
+        if self.cache is not None:
+            gtf_exon_sorted = self.cache.loadtree('exons')
+            if gtf_exon_sorted is not None:
+                self.exontrees[modified_gtf_file] = gtf_exon_sorted
+                return gtf_exon_sorted
+        exon_gtf_file = HTSeq.GFF_Reader(modified_gtf_file, end_included=True)
+        gtf_exon_sorted = IntervalTree()
+        for feature in exon_gtf_file:
+            row = dict((key, feature.attr[key]) for key in ('custom_exon_id',) if key in feature.attr)
+            current_bed_interval = feature.iv
+            gtf_exon_sorted.insert(current_bed_interval, annotation=row)
+        if self.cache is not None:
+            self.cache.storetree('exons', gtf_exon_sorted)
+        self.exontrees[modified_gtf_file] = gtf_exon_sorted
+        return gtf_exon_sorted
+
     def printuniq(self, Infile):
         f = open(Infile, 'r').readlines()
         keys = []
@@ -23,6 +23,8 @@ import numpy as np
 import itertools
 import logging
 
+from . import countMatrix as Cm
+
 ##########################################################################
 class metatool():
 
@@ -90,6 +92,11 @@ class metatool():
         self.input_circcordinates = input_circcordinates
         self.input_linear = input_linear
         self.replace_string = replace_string
+        if Cm.hasnpz(input_circtools) and Cm.hasnpz(input_linear):
+            # sparse count matrices written by detect -sp
+            pd_circtools, pd_circtools_linear = self.parseCirctoolsSparse(input_circtools, input_circcordinates,
+                                                                          input_linear, replace_string)
+            return self.normalizeCirctools(pd_circtools, pd_circtools_linear)
         dict_circtools = {}
         dict_circtools_linear = {}
         inp = open(input_circtools, mode='r').readlines()
@@ -143,11 +150,50 @@ class metatool():
         pd_circtools_linear = pd.DataFrame.transpose(pd.DataFrame.from_dict(dict_circtools_linear))                  # non-normalized circtools linear count
         pd_circtools.columns = samplenames_circtools                                                                 
         pd_circtools_linear.columns = samplenames_circtools                                                                 
+        return self.normalizeCirctools(pd_circtools, pd_circtools_linear)
+
+    def normalizeCirctools(self, pd_circtools, pd_circtools_linear):
         normalized_pd_circtools=(pd_circtools-pd_circtools.min())/(pd_circtools.max()-pd_circtools.min())       # normalized circtools circular counts
         normalized_pd_circtools_linear=(pd_circtools_linear-pd_circtools_linear.min())/(pd_circtools_linear.max()-pd_circtools_linear.min())       # normalized circtools linear counts
         #print(normalized_pd_circtools_linear)
         return (pd_circtools, pd_circtools_linear, normalized_pd_circtools, normalized_pd_circtools_linear)
 
+    def parseCirctoolsSparse(self, input_circtools, input_circcordinates, input_linear, replace_string):
+        # same as parseCirctools, but reads the .npz count matrices of CircRNACount and LinearCount
+        circ = Cm.readnpz(input_circtools)
+        linear = Cm.readnpz(input_linear)
+        inp_co = open(input_circcordinates, mode='r').readlines()[1:]
+        if (circ.counts.shape[0] != len(inp_co)):
+            print("Number of lines in CircRNACount and CircCoordinates are different!")
+            exit(1)
+        if (circ.counts.shape[0] != linear.counts.shape[0]):
+            print("Number of lines in CircRNACount and LinearCount are different!")
+            exit(1)
+        samplenames_circtools = [s.replace(replace_string, "") for s in circ.samples]
+
+        index = []
+        for line, line_l, line_2 in zip(circ.coordinates.tolist(), linear.coordinates.tolist(), inp_co):
+            circ_id = line[0] + "_" + line[1] + "_" + line[2]
+            circ_id_l = line_l[0] + "_" + line_l[1] + "_" + line_l[2]
+            # fetch strand info from CircCoordinates file
+            line_2 = line_2.strip().split('\t')
+            circ_id_2 = line_2[0] + "_" + line_2[1] + "_" + line_2[2]
+            if (circ_id != circ_id_2):
+                print("Lines in CircRNACount and CircCoordinates do not match!")
+                print(line)
+                print(line_2)
+                exit(1)
+            elif (circ_id != circ_id_l):
+                print("Lines in CircRNACount and LinearCount do not match!")
+                print(line)
+                print(line_l)
+                exit(1)
+            index.append(circ_id + "_" + line_2[5])
+
+        pd_circtools = pd.DataFrame(circ.todense(), index=index, columns=samplenames_circtools)
+        pd_circtools_linear = pd.DataFrame(linear.todense(), index=index, columns=samplenames_circtools)
+        return (pd_circtools, pd_circtools_linear)
+
     ##########################################################################
     # Create a two-dimentional dictionary of CIRIquant matches. 
     def parseCIRIquant(self, list_ciriquant):
@@ -3,11 +3,12 @@
 # invoke with column nr to extract as first parameter followed by
 # file names. The files should all have the same number of rows
 
+import heapq
+import itertools
 import os
 import re
 import sys
 from collections import OrderedDict
-from copy import deepcopy
 
 
 class Combine(object):
@@ -57,7 +58,8 @@ class Combine(object):
                     mapto.setdefault(line_split[0] + line_split[1] + line_split[2], []).append(lin.strip('\n'))
 
         for fname in filelist:
-            run_mapto = deepcopy(mapto)
+            # only the counts of this sample are collected, the coordinates are shared by all samples
+            run_mapto = dict((key, []) for key in mapto)
             with open(fname) as f:
                 for lin in f:
                     line_split = lin.split('\t')
@@ -67,10 +69,50 @@ class Combine(object):
                         cor = line_split[0] + line_split[1] + line_split[2]
                     run_mapto[cor].append(line_split[col - 1])
             with open(fname + 'mapped', 'w') as fout:
-                for key in run_mapto:
-                    if len(run_mapto[key]) == 1:
-                        run_mapto[key].append('0')
-                    fout.write('\t'.join(run_mapto[key]) + '\n')
+                for key in mapto:
+                    mapped = mapto[key] + run_mapto[key]
+                    if len(mapped) == 1:
+                        mapped.append('0')
+                    fout.write('\t'.join(mapped) + '\n')
+
+    def readcirc(self, circfile, sample=0):
+        # Yield ((chr, start, end), sample, line fields) for the lines of a .circRNA file sorted by coordinates
+        previous = None
+        with open(circfile) as circ:
+            for lin in circ:
+                line_split = lin.rstrip('\n').split('\t')
+                coor = (line_split[0], int(line_split[1]), int(line_split[2]))
+                if previous is not None and coor < previous:
+                    sys.exit('%s is not sorted by coordinates, cannot combine the circRNA counts.' % circfile)
+                previous = coor
+                yield coor, sample, line_split
+
+    def mergecirc(self, circfiles, coordinates, counts, strand=True, samplelist=None, header=False):
+        """
+        Combine the per sample .circRNA files in a single k-way merge pass.
+        Writes the coordinates of all circRNAs (as comb_coor) and their count table with one column per sample
+        (as map, combine and writeouput), holding only the circRNAs of one position in memory.
+        """
+        streams = [self.readcirc(fname, sample) for sample, fname in enumerate(circfiles)]
+
+        coordinates = open(coordinates, 'w')
+        counts = open(counts, 'w')
+        if header:
+            counts.write('Chr\tStart\tEnd\tStrand\t' + samplelist + '\n')
+
+        # equal coordinates are merged in sample order, so the junction type and strand of the last sample win
+        for coor, circs in itertools.groupby(heapq.merge(*streams, key=lambda x: x[0]), key=lambda x: x[0]):
+            merged = {}
+            for _, sample, line_split in circs:
+                circ = merged.setdefault(line_split[5] if strand else None, [None, ['0'] * len(circfiles)])
+                circ[0] = line_split
+                circ[1][sample] = '0' if line_split[4] == '.' else line_split[4]
+            for line_split, samplecounts in sorted(merged.values(), key=lambda x: x[0][5]):
+                coordinates.write('\t'.join(line_split[:3] + ['.', line_split[6], line_split[5]]) + '\n')
+                counts.write('\t'.join(line_split[:3] + [line_split[5]] + samplecounts) + '\n')
+
+        coordinates.close()
+        counts.close()
 
     def deletefile(self, dirt, pattern):
         # First check whether the input is a list of files or a regular expression string
@@ -2,131 +2,208 @@
 Intersects ... faster.  Suports GenomicInterval datatype and multiple chromosomes.
 Accept GenomicInterval object, with attributes chrom, start, end, strand (optional).
 In case of unstranded data, interval.strand == '.'
+
+Intervals are collected by insert and bulk loaded into a static, array based index per
+chromosome on the first query. The index keeps the intervals sorted by start in NumPy arrays,
+split into classes of similar length, so all intervals overlapping a query are found with two
+binary searches per class. Inserting after a query rebuilds the index of that chromosome.
 """
 
-import math
-import random
+import numpy as np
 
 
 class IntervalTree(object):
     def __init__(self):
         self.chroms = {}
+        # intervals inserted since the index of their chromosome was built
+        self.pending = {}
 
     def insert(self, interval, annotation=None):
         # This interval is the interval to construct the tree, e.g. gtf annotations
-        chrom = interval.chrom
-        start = interval.start
-        end = interval.end
-        strand = interval.strand
-        if interval.chrom in self.chroms:
-            self.chroms[chrom] = self.chroms[chrom].insert(start, end, strand,
-                                                           annotation)  # self.chroms[chrom] is a IntervalNode object
-        else:
-            self.chroms[chrom] = IntervalNode(start, end, strand, annotation)
+        self.pending.setdefault(interval.chrom, []).append(
+            IntervalNode(interval.start, interval.end, interval.strand, annotation))
+
+    def index(self, chrom):
+        # Return the (built) IntervalIndex of chrom, or None if there is no interval on chrom
+        if chrom in self.pending:
+            nodes = self.pending.pop(chrom)
+            if chrom in self.chroms:
+                nodes = self.chroms[chrom].tonodes() + nodes
+            self.chroms[chrom] = IntervalIndex.fromnodes(nodes)
+        return self.chroms.get(chrom)
+
+    def indexes(self):
+        # Return the dict chromosome -> IntervalIndex of all inserted intervals
+        for chrom in list(self.pending):
+            self.index(chrom)
+        return self.chroms
 
     def intersect(self, interval, report_func):
         # This interval from the query
-        chrom = interval.chrom
-        start = interval.start
-        end = interval.end
-        strand = interval.strand  # query interval strand can be '.'
-        if chrom in self.chroms:
-            self.chroms[chrom].intersect(start, end, strand,
-                                         report_func)
-            # use the intersect method of IntervalNode class, need make this function aware of strand
+        index = self.index(interval.chrom)
+        if index is not None:
+            # query interval strand can be '.'
+            for node in index.nodesat(index.query(interval.start, interval.end, interval.strand)):
+                report_func(node)
+
+    def intersectmany(self, intervals):
+        """
+        Batch version of intersect.
+        Returns a list with the overlapping IntervalNodes of each of the intervals, in input order.
+        """
+        intervals = list(intervals)
+        hits = [[] for _ in intervals]
+
+        bychrom = {}
+        for i, interval in enumerate(intervals):
+            bychrom.setdefault(interval.chrom, []).append(i)
+
+        for chrom, queries in bychrom.items():
+            index = self.index(chrom)
+            if index is None:
+                continue
+            starts = np.array([intervals[i].start for i in queries], dtype='int64')
+            ends = np.array([intervals[i].end for i in queries], dtype='int64')
+            strands = [intervals[i].strand for i in queries]
+            query, node = index.querymany(starts, ends, strands)
+            for q, n in zip(query.tolist(), index.nodesat(node)):
+                hits[queries[q]].append(n)
+        return hits
 
     def traverse(self, func):
-        for item in self.chroms.values():
+        for item in self.indexes().values():
             item.traverse(func)
 
 
 class IntervalNode(object):
+    # One annotated interval, as reported to the report_func of IntervalTree.intersect
+    __slots__ = ('start', 'end', 'strand', 'annotation')
+
     def __init__(self, start, end, strand=None, annotation=None):
-        self.priority = math.ceil((-1.0 / math.log(.5)) * math.log(-1.0 / (random.uniform(0, 1) - 1)))
         self.start = start
         self.end = end
-        self.maxend = self.end
-        self.minend = self.end
-        self.left = None
-        self.right = None
         self.strand = strand
         self.annotation = annotation
 
-    def insert(self, start, end, strand=None, annotation=None):
-        root = self
-        if start > self.start:
-            # insert to right tree
-            if self.right:
-                self.right = self.right.insert(start, end, strand, annotation)
-            else:
-                self.right = IntervalNode(start, end, strand, annotation)
-            # rebalance tree
-            if self.priority < self.right.priority:
-                root = self.rotateleft()
-        else:
-            # insert to left tree
-            if self.left:
-                self.left = self.left.insert(start, end, strand, annotation)
-            else:
-                self.left = IntervalNode(start, end, strand, annotation)
-            # rebalance tree
-            if self.priority < self.left.priority:
-                root = self.rotateright()
-        if root.right and root.left:
-            root.maxend = max(root.end, root.right.maxend, root.left.maxend)
-            root.minend = min(root.end, root.right.minend, root.left.minend)
-        elif root.right:
-            root.maxend = max(root.end, root.right.maxend)
-            root.minend = min(root.end, root.right.minend)
-        elif root.left:
-            root.maxend = max(root.end, root.left.maxend)
-            root.minend = min(root.end, root.left.minend)
-        return root
-
-    def rotateright(self):
-        root = self.left
-        self.left = self.left.right
-        root.right = self
-        if self.right and self.left:
-            self.maxend = max(self.end, self.right.maxend, self.left.maxend)
-            self.minend = min(self.end, self.right.minend, self.left.minend)
-        elif self.right:
-            self.maxend = max(self.end, self.right.maxend)
-            self.minend = min(self.end, self.right.minend)
-        elif self.left:
-            self.maxend = max(self.end, self.left.maxend)
-            self.minend = min(self.end, self.left.minend)
-        return root
-
-    def rotateleft(self):
-        root = self.right
-        self.right = self.right.left
-        root.left = self
-        if self.right and self.left:
-            self.maxend = max(self.end, self.right.maxend, self.left.maxend)
-            self.minend = min(self.end, self.right.minend, self.left.minend)
-        elif self.right:
-            self.maxend = max(self.end, self.right.maxend)
-            self.minend = min(self.end, self.right.minend)
-        elif self.left:
-            self.maxend = max(self.end, self.left.maxend)
-            self.minend = min(self.end, self.left.minend)
-        return root
-
-    ### TODO
-    def intersect(self, start, end, strand, report_func):
-        if strand == '.':  # unstranded data, not going to compare strand
-            if start < self.end and end > self.start:
-                report_func(self)
-        else:
-            if start < self.end and end > self.start and strand == self.strand:
-                report_func(self)
-        if self.left and start < self.left.maxend:
-            self.left.intersect(start, end, strand, report_func)
-        if self.right and end > self.start:
-            self.right.intersect(start, end, strand, report_func)
+
+class IntervalIndex(object):
+    """
+    Immutable interval index of one chromosome.
+    Intervals are sorted by start and split into classes by the power of two of their length.
+    Within a class an interval can only overlap [start, end) if its own start is in
+    (start - maxlength of the class, end), which is a contiguous range of the sorted starts.
+    @strands: strand code of each interval, strandnames[code] is the strand itself
+    @annotations: sequence with the annotation of each interval
+    @presorted: intervals are already sorted by start and end
+    """
+
+    def __init__(self, starts, ends, strands, strandnames, annotations, presorted=False):
+        self.starts = np.asarray(starts, dtype='int64')
+        self.ends = np.asarray(ends, dtype='int64')
+        self.strands = np.asarray(strands, dtype='int32')
+        # position in annotations of each (sorted) interval, None if in the same order
+        self.order = None
+        if not presorted:
+            self.order = np.lexsort((self.ends, self.starts))
+            self.starts = self.starts[self.order]
+            self.ends = self.ends[self.order]
+            self.strands = self.strands[self.order]
+        self.annotations = annotations
+        # IntervalNodes, created on demand by nodesat
+        self.nodes = [None] * len(self.starts)
+        self.strandnames = list(strandnames)
+        self.strandcodes = dict((strand, code) for code, strand in enumerate(self.strandnames))
+
+        lengths = np.maximum(self.ends - self.starts, 1)
+        lengthclass = np.floor(np.log2(lengths)).astype('int64')
+        # (sorted starts, ends, index of the intervals, maximal length) per length class
+        self.classes = []
+        byclass = np.argsort(lengthclass, kind='stable')
+        bounds = np.flatnonzero(np.diff(lengthclass[byclass])) + 1
+        for members in np.split(byclass, bounds):
+            if len(members):
+                self.classes.append((self.starts[members], self.ends[members], members,
+                                     int((self.ends[members] - self.starts[members]).max())))
+
+    @classmethod
+    def fromnodes(cls, nodes):
+        strandcodes = {}
+        strands = [strandcodes.setdefault(node.strand, len(strandcodes)) for node in nodes]
+        return cls([node.start for node in nodes], [node.end for node in nodes], strands,
+                   sorted(strandcodes, key=strandcodes.get), [node.annotation for node in nodes])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def annotation(self, i):
+        # Annotation of the i-th interval in start order
+        return self.annotations[i if self.order is None else self.order[i]]
+
+    def node(self, i):
+        return self.nodesat([i])[0]
+
+    def nodesat(self, indices):
+        # IntervalNodes of the intervals at indices (in start order), each node is only created once
+        indices = np.asarray(indices, dtype='int64').tolist()
+        nodes = self.nodes
+        missing = np.array([i for i in set(indices) if nodes[i] is None], dtype='int64')
+        if len(missing):
+            positions = missing if self.order is None else self.order[missing]
+            for i, start, end, strand, position in zip(missing.tolist(), self.starts[missing].tolist(),
+                                                       self.ends[missing].tolist(),
+                                                       self.strands[missing].tolist(), positions.tolist()):
+                nodes[i] = IntervalNode(start, end, self.strandnames[strand], self.annotations[position])
+        return [nodes[i] for i in indices]
+
+    def tonodes(self):
+        return self.nodesat(np.arange(len(self)))
+
+    def query(self, start, end, strand='.'):
+        # Indices (in start order, see node) of all intervals overlapping [start, end) on strand
+        query, node = self.querymany(np.array([start], dtype='int64'), np.array([end], dtype='int64'), [strand])
+        return node.tolist()
+
+    def querymany(self, starts, ends, strands):
+        """
+        Find all overlaps of the query intervals starts[i]:ends[i] on strands[i] ('.' matches any strand).
+        Returns two arrays: the query index and the node index of each overlap, sorted by query and node.
+        """
+        if len(starts) == 0 or len(self) == 0:
+            return np.zeros(0, dtype='int64'), np.zeros(0, dtype='int64')
+
+        # strand '.' is unstranded data, -1 matches every strand, unknown strands match none
+        anystrand = -1
+        nostrand = len(self.strandcodes)
+        querystrands = np.array([anystrand if strand == '.' else self.strandcodes.get(strand, nostrand)
+                                 for strand in strands], dtype='int32')
+
+        queries = []
+        nodes = []
+        for cstarts, cends, members, maxlength in self.classes:
+            lo = np.searchsorted(cstarts, starts - maxlength, side='right')
+            hi = np.searchsorted(cstarts, ends, side='left')
+            counts = np.maximum(hi - lo, 0)
+            total = counts.sum()
+            if total == 0:
+                continue
+            # expand every query to the candidate range lo:hi of this class
+            query = np.repeat(np.arange(len(starts)), counts)
+            offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            candidate = np.repeat(lo, counts) + offsets
+            overlap = cends[candidate] > starts[query]
+            query = query[overlap]
+            node = members[candidate[overlap]]
+            samestrand = (querystrands[query] == anystrand) | (querystrands[query] == self.strands[node])
+            queries.append(query[samestrand])
+            nodes.append(node[samestrand])
+
+        if not queries:
+            return np.zeros(0, dtype='int64'), np.zeros(0, dtype='int64')
+        query = np.concatenate(queries)
+        node = np.concatenate(nodes)
+        order = np.lexsort((node, query))
+        return query[order], node[order]
 
     def traverse(self, func):
-        if self.left: self.left.traverse(func)
-        func(self)
-        if self.right: self.right.traverse(func)
+        for node in self.tonodes():
+            func(node)
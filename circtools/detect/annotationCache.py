@@ -0,0 +1,182 @@
+# Persistent on-disk cache for the structures circtools detect derives from a GTF/GFF annotation file
+# Required: numpy
+#
+# Entries are keyed by the SHA-1 checksum of the annotation file, so a cache directory can be shared by
+# runs against several references. The checksum of a file is remembered together with its size and
+# modification time, so an unchanged annotation file is not read again to look up its entries.
+# Interval trees are stored as plain NumPy arrays (.npz), other entries as copies of the derived files.
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from .IntervalTree import IntervalIndex, IntervalTree
+
+# bump to invalidate existing cache entries whenever their layout changes
+CACHE_VERSION = 1
+
+CHECKSUMS = 'checksums.json'
+
+
+class AnnotationTable(object):
+    # Sequence of annotation dicts, stored column wise as codes into a table of distinct values per key
+    def __init__(self, keys, tables, codes, start, end):
+        self.keys = keys
+        self.tables = tables
+        self.codes = codes
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, i):
+        i = self.start + int(i)
+        annotation = {}
+        for key, table, codes in zip(self.keys, self.tables, self.codes):
+            code = codes[i]
+            if code >= 0:
+                annotation[key] = table[code]
+        return annotation
+
+
+class AnnotationCache(object):
+    def __init__(self, cache_dir, annotation_file):
+        self.cache_dir = cache_dir
+        self.annotation_file = annotation_file
+        self._checksum = None
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def checksum(self):
+        # SHA-1 of the annotation file, looked up by (path, size, mtime) if it was computed before
+        if self._checksum is not None:
+            return self._checksum
+
+        path = os.path.realpath(self.annotation_file)
+        stat = os.stat(path)
+        fingerprint = [stat.st_size, stat.st_mtime_ns]
+        checksums = self.readchecksums()
+        entry = checksums.get(path)
+        if entry is not None and entry[:2] == fingerprint:
+            self._checksum = entry[2]
+            return self._checksum
+
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as annotation:
+            for block in iter(lambda: annotation.read(1 << 20), b''):
+                sha1.update(block)
+        self._checksum = sha1.hexdigest()
+
+        checksums = self.readchecksums()
+        checksums[path] = fingerprint + [self._checksum]
+        self.atomicwrite(CHECKSUMS, lambda out: out.write(json.dumps(checksums, indent=1).encode()))
+        return self._checksum
+
+    def readchecksums(self):
+        try:
+            with open(os.path.join(self.cache_dir, CHECKSUMS), 'r') as checksums:
+                return json.load(checksums)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def path(self, name):
+        return os.path.join(self.cache_dir, '%s.v%d.%s' % (self.checksum(), CACHE_VERSION, name))
+
+    def atomicwrite(self, name, write):
+        # Write a cache file via a temporary file, so concurrent runs never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp_')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                write(out)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, os.path.join(self.cache_dir, name))
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def storefile(self, name, filename):
+        # Keep a copy of a file derived from the annotation
+        def copy(out):
+            with open(filename, 'rb') as derived:
+                shutil.copyfileobj(derived, out)
+
+        self.atomicwrite(os.path.basename(self.path(name)), copy)
+
+    def restorefile(self, name, filename):
+        # Copy a cached file to filename, returns False if there is no such entry
+        if not os.path.isfile(self.path(name)):
+            return False
+        shutil.copyfile(self.path(name), filename)
+        logging.info('Restored %s from annotation cache %s' % (filename, self.path(name)))
+        return True
+
+    def storetree(self, name, tree):
+        # Store an IntervalTree whose annotations are dicts of strings
+        chroms = []
+        offsets = [0]
+        starts = []
+        ends = []
+        strands = []
+        strandnames = []
+        strandcodes = {}
+        keys = {}
+        values = []
+        for chrom, index in sorted(tree.indexes().items()):
+            chroms.append(chrom)
+            offsets.append(offsets[-1] + len(index))
+            starts.append(index.starts)
+            ends.append(index.ends)
+            for strand in index.strandnames:
+                if strand not in strandcodes:
+                    strandcodes[strand] = len(strandnames)
+                    strandnames.append(strand)
+            strands.append(np.array([strandcodes[strand] for strand in index.strandnames], dtype='int32')[
+                               index.strands])
+            for i in range(len(index)):
+                annotation = index.annotation(i)
+                for key in annotation:
+                    keys.setdefault(key, len(keys))
+                values.append(annotation)
+
+        arrays = {'chroms': np.array(chroms, dtype=str), 'offsets': np.array(offsets, dtype='int64'),
+                  'starts': np.concatenate(starts) if starts else np.zeros(0, dtype='int64'),
+                  'ends': np.concatenate(ends) if ends else np.zeros(0, dtype='int64'),
+                  'strands': np.concatenate(strands) if strands else np.zeros(0, dtype='int32'),
+                  'strandnames': np.array([str(strand) for strand in strandnames], dtype=str),
+                  'keys': np.array(sorted(keys, key=keys.get), dtype=str)}
+        for k, key in enumerate(arrays['keys'].tolist()):
+            table = {}
+            codes = np.array([table.setdefault(annotation[key], len(table)) if key in annotation else -1
+                              for annotation in values], dtype='int32')
+            arrays['table%d' % k] = np.array(sorted(table, key=table.get), dtype=str)
+            arrays['codes%d' % k] = codes
+
+        self.atomicwrite(os.path.basename(self.path(name + '.npz')), lambda out: np.savez(out, **arrays))
+
+    def loadtree(self, name):
+        # Load a stored IntervalTree, returns None if there is no such entry
+        if not os.path.isfile(self.path(name + '.npz')):
+            return None
+        with np.load(self.path(name + '.npz'), allow_pickle=False) as npz:
+            arrays = dict(npz.items())
+
+        keys = arrays['keys'].tolist()
+        tables = [arrays['table%d' % k].tolist() for k in range(len(keys))]
+        codes = [arrays['codes%d' % k] for k in range(len(keys))]
+        strandnames = arrays['strandnames'].tolist()
+        offsets = arrays['offsets'].tolist()
+
+        tree = IntervalTree()
+        for c, chrom in enumerate(arrays['chroms'].tolist()):
+            start, end = offsets[c], offsets[c + 1]
+            tree.chroms[chrom] = IntervalIndex(arrays['starts'][start:end], arrays['ends'][start:end],
+                                               arrays['strands'][start:end], strandnames,
+                                               AnnotationTable(keys, tables, codes, start, end), presorted=True)
+        logging.info('Loaded %s from annotation cache %s' % (name, self.path(name + '.npz')))
+        return tree
@@ -13,13 +13,21 @@ from .IntervalTree import IntervalTree
 
 
 class CircAnnotate(object):
-    def __init__(self, tmp_dir, strand=True):
+    def __init__(self, tmp_dir, strand=True, cache=None):
         self.strand = strand
         self.tmp_dir = tmp_dir
+        # optional annotationCache.AnnotationCache of the annotation file
+        self.cache = cache
 
     def selectGeneGtf(self, gtf_file):
         # construct annotation tree
         # new_gtf file contains only exon annotation
+        exon_sorted = self.tmp_dir + "tmp_" + os.path.basename(gtf_file) + '.exon.sorted'
+        if self.cache is not None:
+            annotation_tree = self.cache.loadtree('genes')
+            if annotation_tree is not None and self.cache.restorefile('exon.sorted', exon_sorted):
+                return annotation_tree
+
         gtf = HTSeq.GFF_Reader(gtf_file, end_included=True)
         annotation_tree = IntervalTree()
         gtf_exon = []
@@ -35,13 +43,19 @@ class CircAnnotate(object):
             except:
                 row = feature.get_gff_line()
 
-            annotation_tree.insert(iv, annotation=row)
+            # only keep what searchGeneName looks up, instead of all attributes of every feature
+            annotation_tree.insert(iv, annotation={'gene_name': self.searchGeneName([row]),
+                                                   'type': self.searchGeneName([row], what='region')})
 
         gtf_exon_sorted = sorted(gtf_exon, key=lambda x: (x[0], int(x[3]), int(x[4])))
         gtf_exon_sorted = ['\t'.join(s) for s in gtf_exon_sorted]
-        new_gtf = open(self.tmp_dir + "tmp_" + os.path.basename(gtf_file) + '.exon.sorted', 'w')
+        new_gtf = open(exon_sorted, 'w')
         new_gtf.writelines(gtf_exon_sorted)
         new_gtf.close()
+
+        if self.cache is not None:
+            self.cache.storetree('genes', annotation_tree)
+            self.cache.storefile('exon.sorted', exon_sorted)
         return annotation_tree
 
     def annotate_one_interval(self, interval, annotation_tree, what='gene'):
@@ -84,16 +98,22 @@ class CircAnnotate(object):
         circ = open(circfile, 'r').readlines()
         new_CircCoordinates = open(output, 'w')
         new_CircCoordinates.write('Chr\tStart\tEnd\tGene\tJunctionType\tStrand\tStart-End Region\tOverallRegion\n')
+        iv_lefts = []
+        iv_rights = []
         for line in circ:
             line_split = line.split('\t')
-            iv_left = HTSeq.GenomicInterval(line_split[0], int(line_split[1]), int(line_split[1]) + 1,
-                                            line_split[5].strip('\n'))
-            iv_right = HTSeq.GenomicInterval(line_split[0], int(line_split[2]) - 1, int(line_split[2]),
-                                             line_split[5].strip('\n'))
-            iv_left_annotation = self.annotate_one_interval(iv_left, annotation_tree, what='region')
+            iv_lefts.append(HTSeq.GenomicInterval(line_split[0], int(line_split[1]), int(line_split[1]) + 1,
+                                                  line_split[5].strip('\n')))
+            iv_rights.append(HTSeq.GenomicInterval(line_split[0], int(line_split[2]) - 1, int(line_split[2]),
+                                                   line_split[5].strip('\n')))
+        # query all boundaries at once
+        hits_left = annotation_tree.intersectmany(iv_lefts)
+        hits_right = annotation_tree.intersectmany(iv_rights)
+        for line, hit_left, hit_right in zip(circ, hits_left, hits_right):
+            iv_left_annotation = self.searchGeneName([x.annotation for x in hit_left], what='region')
             if not iv_left_annotation:
                 iv_left_annotation = '.'
-            iv_right_annotation = self.annotate_one_interval(iv_right, annotation_tree, what='region')
+            iv_right_annotation = self.searchGeneName([x.annotation for x in hit_right], what='region')
             if not iv_right_annotation:
                 iv_right_annotation = '.'
             overall_annotation = self.uniqstring(iv_left_annotation + ',' + iv_right_annotation)
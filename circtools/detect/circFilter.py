@@ -36,10 +36,9 @@ class Circfilter(object):
     # Read circRNA count and coordinates information to numpy array
     def readcirc(self, countfile, coordinates):
         # Read the circRNA count file
-        circ = open(countfile, 'r')
-        coor = open(coordinates, 'r')
         count = []
         indx = []
+        circ = open(countfile, 'r')
         for line in circ:
             fields = line.split('\t')
             # row_indx = [str(itm) for itm in fields[0:4]]
@@ -50,15 +49,17 @@ class Circfilter(object):
                 row_count = [float(itm) for itm in fields[4:]]
             count.append(row_count)
             # indx.append(row_indx)
+        circ.close()
 
+        coor = open(coordinates, 'r')
         for line in coor:
             fields = line.split('\t')
             row_indx = [str(itm).strip() for itm in fields[0:6]]
             indx.append(row_indx)
+        coor.close()
 
         count = np.array(count)
         indx = np.array(indx)
-        circ.close()
         return count, indx
 
     # Do filtering
@@ -96,13 +97,18 @@ class Circfilter(object):
                 right = HTSeq.GenomicInterval(str(array[0]), int(array[2]) - self.length, int(array[2]), str(array[5]))
                 return left, right
 
-            keep_index = []
-            for i, j in enumerate(indx0):
-                out = []
+            lefts = []
+            rights = []
+            for j in indx0:
                 left, right = numpy_array_2_GenomiInterval(j)
-                rep_tree.intersect(left, lambda x: out.append(x))
-                rep_tree.intersect(right, lambda x: out.append(x))
-                if not out:
+                lefts.append(left)
+                rights.append(right)
+
+            # query all circRNA boundaries at once
+            keep_index = []
+            for i, (out_left, out_right) in enumerate(zip(rep_tree.intersectmany(lefts),
+                                                          rep_tree.intersectmany(rights))):
+                if not out_left and not out_right:
                     # not in repetitive region
                     keep_index.append(i)
             indx0 = indx0[keep_index]
@@ -0,0 +1,146 @@
+# Sparse binary storage of the count tables written by circtools detect
+# Required: numpy, pandas, scipy
+#
+# CircRNACount and LinearCount are dense text tables with a few coordinate columns and one count column per
+# sample, which are mostly zero for large cohorts. With the detect option -sp each table is additionally stored
+# as <table>.npz: the column names, the coordinate columns as strings and the counts as a CSR matrix
+# (circRNAs x samples). load() prefers the .npz over the text table if it is up to date.
+#
+# CircSkipJunctions holds junction lists (chr1:50-99+:3;...) instead of counts and always stays a text table.
+
+import csv
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+SUFFIX = '.npz'
+
+# header names of the leading coordinate columns of the detect count tables
+COORDINATE_COLUMNS = ('Chr', 'Start', 'End', 'Strand')
+
+# tables with non-numeric sample columns, which are never stored as .npz
+TEXT_TABLES = ('CircSkipJunctions',)
+
+# number of table lines parsed at once
+CHUNKSIZE = 100000
+
+
+class CountMatrix(object):
+    def __init__(self, columns, coordinates, counts):
+        # columns: names of the coordinate and sample columns (None for tables without header)
+        # coordinates: (circRNAs x coordinate columns) array of strings
+        # counts: scipy.sparse.csr_matrix (circRNAs x samples)
+        self.columns = columns
+        self.coordinates = coordinates
+        self.counts = counts
+
+    @property
+    def samples(self):
+        if self.columns is None:
+            return None
+        return self.columns[self.coordinates.shape[1]:]
+
+    def todense(self):
+        return self.counts.toarray()
+
+    def write(self, output):
+        # Store as .npz, see load
+        arrays = {'coordinates': self.coordinates.astype(str), 'data': self.counts.data,
+                  'indices': self.counts.indices, 'indptr': self.counts.indptr,
+                  'shape': np.array(self.counts.shape, dtype='int64')}
+        if self.columns is not None:
+            arrays['columns'] = np.array(self.columns, dtype=str)
+        with open(output, 'wb') as out:
+            np.savez_compressed(out, **arrays)
+
+    def writetext(self, output):
+        # Write the dense text table again, as written by detect
+        with open(output, 'w') as out:
+            if self.columns is not None:
+                out.write('\t'.join(self.columns) + '\n')
+            for start in range(0, self.counts.shape[0], CHUNKSIZE):
+                rows = self.counts[start:start + CHUNKSIZE].toarray().astype(str)
+                for coordinates, row in zip(self.coordinates[start:start + CHUNKSIZE].tolist(), rows.tolist()):
+                    out.write('\t'.join(coordinates + row) + '\n')
+
+
+def npzname(table):
+    return table if table.endswith(SUFFIX) else table + SUFFIX
+
+
+def istext(table):
+    # Whether table is one of the TEXT_TABLES, which are only read from the text table
+    name = os.path.basename(table)
+    return (name[:-len(SUFFIX)] if name.endswith(SUFFIX) else name) in TEXT_TABLES
+
+
+def hasnpz(table):
+    # Whether table has a .npz version which is at least as new as the text table
+    if istext(table):
+        return False
+    npz = npzname(table)
+    if not os.path.isfile(npz):
+        return False
+    return npz == table or not os.path.isfile(table) or os.path.getmtime(npz) >= os.path.getmtime(table)
+
+
+def readtext(table, header=True, ncoordinates=None):
+    """
+    Read a dense text count table.
+    @header: the first line holds the column names, the leading ones from COORDINATE_COLUMNS are coordinates
+    @ncoordinates: number of coordinate columns, required for tables without header
+    """
+    columns = None
+    if header:
+        with open(table, 'r') as tablefile:
+            columns = tablefile.readline().rstrip('\n').split('\t')
+        if ncoordinates is None:
+            ncoordinates = 0
+            while columns[ncoordinates:ncoordinates + 1] == list(COORDINATE_COLUMNS[ncoordinates:ncoordinates + 1]):
+                ncoordinates += 1
+    if ncoordinates is None:
+        raise ValueError('Number of coordinate columns of %s without header is unknown' % table)
+
+    # read in chunks, so only the sparse matrix of the whole table is held in memory
+    coordinates = []
+    counts = []
+    try:
+        reader = pd.read_csv(table, sep='\t', header=None, skiprows=1 if header else 0, dtype=str,
+                             quoting=csv.QUOTE_NONE, na_filter=False, chunksize=CHUNKSIZE)
+        for frame in reader:
+            coordinates.append(frame.iloc[:, :ncoordinates].values.astype(str))
+            counts.append(sparse.csr_matrix(frame.iloc[:, ncoordinates:].apply(pd.to_numeric).values))
+    except pd.errors.EmptyDataError:
+        pass
+    except ValueError as error:
+        raise ValueError('%s is not a count table: %s' % (table, error))
+    if not counts:
+        nsamples = len(columns) - ncoordinates if columns is not None else 0
+        return CountMatrix(columns, np.zeros((0, ncoordinates), dtype=str),
+                           sparse.csr_matrix((0, nsamples), dtype='int64'))
+    return CountMatrix(columns, np.concatenate(coordinates), sparse.vstack(counts, format='csr'))
+
+
+def readnpz(table):
+    with np.load(npzname(table), allow_pickle=False) as npz:
+        counts = sparse.csr_matrix((npz['data'], npz['indices'], npz['indptr']), shape=tuple(npz['shape']))
+        columns = npz['columns'].tolist() if 'columns' in npz.files else None
+        return CountMatrix(columns, npz['coordinates'], counts)
+
+
+def load(table, header=True, ncoordinates=None):
+    # Read a count table from its .npz version if available, else from the text table
+    if hasnpz(table):
+        return readnpz(table)
+    return readtext(table, header=header, ncoordinates=ncoordinates)
+
+
+def convert(table, header=True, ncoordinates=None):
+    # Store the text count table as <table>.npz, returns the name of the .npz file
+    if istext(table):
+        raise ValueError('%s has no counts and is only stored as text table' % table)
+    output = npzname(table)
+    readtext(table, header=header, ncoordinates=ncoordinates).write(output)
+    return output
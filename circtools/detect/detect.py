@@ -15,6 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import functools
 import logging
 import multiprocessing
@@ -27,8 +28,10 @@ import time
 import pysam
 
 from . import CombineCounts as Cc
+from . import annotationCache as Ac
 from . import circAnnotate as Ca
 from . import circFilter as Ft
+from . import countMatrix as Cm
 from . import findcircRNA as Fc
 from . import genecount as Gc
 from .fix2chimera import Fix2Chimera
@@ -148,8 +151,14 @@ class Detect(circ_module.circ_template.CircTemplate):
 
         # Make instance
         cm = Cc.Combine(options.tmp_dir)
+        if options.annotation_cache and options.annotate:
+            annotation_cache = Ac.AnnotationCache(options.annotation_cache,
+                                                  options.annotate)
+        else:
+            annotation_cache = None
         circann = Ca.CircAnnotate(tmp_dir=options.tmp_dir,
-                                  strand=options.strand)
+                                  strand=options.strand,
+                                  cache=annotation_cache)
 
         if (
                 not options.mate1 or not options.mate1) and options.pairedendindependent:
@@ -223,7 +232,21 @@ class Detect(circ_module.circ_template.CircTemplate):
             else:
                 Input = options.Input
 
-            if options.strand:
+            if options.chunk_size:
+                print("Splitting junction files into chunks of %d MB" %
+                      options.chunk_size)
+                logging.info("Splitting junction files into chunks of %d MB" %
+                             options.chunk_size)
+                circfiles = findcircchunked(pool, Input,
+                                            chunk_size=options.chunk_size * 1024 * 1024,
+                                            endTol=options.endTol,
+                                            maxL=options.max,
+                                            minL=options.min,
+                                            strand=options.strand,
+                                            pairdendindependent=options.pairedendindependent,
+                                            same=same)
+
+            elif options.strand:
 
                 if options.pairedendindependent:
                     circfiles = pool.map(
@@ -231,7 +254,8 @@ class Detect(circ_module.circ_template.CircTemplate):
                                           endTol=options.endTol,
                                           maxL=options.max,
                                           minL=options.min, strand=True,
-                                          pairdendindependent=True, same=same),
+                                          pairdendindependent=True, same=same,
+                                          streaming=options.streaming),
                         Input)
                 else:
                     circfiles = pool.map(
@@ -239,7 +263,8 @@ class Detect(circ_module.circ_template.CircTemplate):
                                           endTol=options.endTol,
                                           maxL=options.max,
                                           minL=options.min, strand=True,
-                                          pairdendindependent=False, same=same),
+                                          pairdendindependent=False, same=same,
+                                          streaming=options.streaming),
                         Input)
 
             else:
@@ -249,7 +274,8 @@ class Detect(circ_module.circ_template.CircTemplate):
                                           endTol=options.endTol,
                                           maxL=options.max,
                                           minL=options.min, strand=False,
-                                          pairdendindependent=True, same=same),
+                                          pairdendindependent=True, same=same,
+                                          streaming=options.streaming),
                         Input)
                 else:
                     circfiles = pool.map(
@@ -257,7 +283,8 @@ class Detect(circ_module.circ_template.CircTemplate):
                                           endTol=options.endTol,
                                           maxL=options.max,
                                           minL=options.min, strand=False,
-                                          pairdendindependent=False, same=same),
+                                          pairdendindependent=False, same=same,
+                                          streaming=options.streaming),
                         Input)
 
             # Combine the individual count files
@@ -265,12 +292,15 @@ class Detect(circ_module.circ_template.CircTemplate):
             print("Combining individual circRNA read counts")
             logging.info("Combining individual circRNA read counts")
 
-            cm.comb_coor(circfiles, strand=options.strand)
-            cm.map(options.tmp_dir + "tmp_coordinates", circfiles,
-                   strand=options.strand)
-
-            res = cm.combine([files + "mapped" for files in circfiles], col=7,
-                             circ=True)
+            # coordinates and counts of all samples in one pass over the sorted
+            # .circRNA files
+            if options.filter:
+                circcounts = options.tmp_dir + "tmp_circCount"
+            else:
+                circcounts = output_circ_counts
+            cm.mergecirc(circfiles, options.tmp_dir + "tmp_coordinates",
+                         circcounts, strand=options.strand,
+                         samplelist=samplelist, header=not options.filter)
 
             # swap strand if the sequences are sense strand
             if (options.secondstrand and options.strand):
@@ -290,7 +320,6 @@ class Detect(circ_module.circ_template.CircTemplate):
                           options.tmp_dir + "tmp_coordinates")
 
             if options.filter:
-                cm.writeouput(options.tmp_dir + "tmp_circCount", res)
                 if options.annotate:
                     logging.info("Write in annotation")
                     logging.info("Select gene features in Annotation file")
@@ -302,7 +331,6 @@ class Detect(circ_module.circ_template.CircTemplate):
                     os.rename(options.tmp_dir + "tmp_coordinates_annotated",
                               options.tmp_dir + "tmp_coordinates")
             else:
-                cm.writeouput(output_circ_counts, res, samplelist, header=True)
                 if options.annotate:
                     logging.info("Write in annotation")
                     logging.info("Select gene features in Annotation file")
@@ -474,22 +502,18 @@ class Detect(circ_module.circ_template.CircTemplate):
                     # For each sample (each bamfile), do one host gene count, and then combine to a single table
 
                     if options.circ:
-                        linearfiles = pool.map(
-                            functools.partial(wraphostgenecount,
-                                              tmp_dir=options.tmp_dir,
-                                              circ_coor=options.circ,
-                                              ref=options.refseq,
-                                              countlinearsplicedreads=True),
-                            bamfiles)
+                        linearfiles = hostgenecount(pool, bamfiles,
+                                                    tmp_dir=options.tmp_dir,
+                                                    circ_coor=options.circ,
+                                                    ref=options.refseq,
+                                                    countlinearsplicedreads=True)
                     else:
                         if options.detect:
-                            linearfiles = pool.map(
-                                functools.partial(wraphostgenecount,
-                                                  tmp_dir=options.tmp_dir,
-                                                  circ_coor=output_circ_counts,
-                                                  ref=options.refseq,
-                                                  countlinearsplicedreads=False),
-                                bamfiles)
+                            linearfiles = hostgenecount(pool, bamfiles,
+                                                        tmp_dir=options.tmp_dir,
+                                                        circ_coor=output_circ_counts,
+                                                        ref=options.refseq,
+                                                        countlinearsplicedreads=False)
                         else:
                             logging.error(
                                 "Linear gene counting only works if circRNA detection is enabled via -D.")
@@ -521,7 +545,8 @@ class Detect(circ_module.circ_template.CircTemplate):
                                                  options.annotate, circfiles,
                                                  SJ_out_tab,
                                                  strand=options.strand,
-                                                 same=same)
+                                                 same=same,
+                                                 cache=annotation_cache)
             fin = open(output_coordinates, "r").readlines()[1:]
             with open(options.tmp_dir + "tmp_CircCoordinatesNoheader",
                       "w") as fout:
@@ -536,6 +561,15 @@ class Detect(circ_module.circ_template.CircTemplate):
             logging.info(
                 "CircSkip junctions not counted, not running in detected mode (-D)")
 
+        # Sparse binary versions of the count tables, CircSkipJunctions holds
+        # junction lists and stays a text table
+        if options.sparse:
+            for table in (output_circ_counts, output_linear_counts):
+                if os.path.isfile(table):
+                    logging.info("Writing sparse count matrix %s" %
+                                 Cm.npzname(table))
+                    Cm.convert(table)
+
         # Delete temporary files
         if not options.temp:
             deletion_regex = r"^tmp_\.*"
@@ -736,10 +770,10 @@ def convertjunctionfile2bamfile(junctionfilelist):
 
 # CircSkip junctions
 def findCircSkipJunction(CircCoordinates, tmp_dir, gtffile, circfiles,
-                         SJ_out_tab, strand=True, same=False):
+                         SJ_out_tab, strand=True, same=False, cache=None):
     from .Circ_nonCirc_Exon_Match import CircNonCircExon
     CircSkipfiles = []
-    CCEM = CircNonCircExon(tmp_dir)
+    CCEM = CircNonCircExon(tmp_dir, cache=cache)
     # Modify gtf file
     if not os.path.isfile(
             tmp_dir + "tmp_" + os.path.basename(gtffile) + ".exon.sorted"):
@@ -862,30 +896,69 @@ def checkBAMsorting(bamfiles):
     return unsortedBAMs
 
 
-def wraphostgenecount(bamfile, tmp_dir, circ_coor, ref,
-                      countlinearsplicedreads=True):
-    # create the Genecount object
+def wraphostgenecountchunk(unit, tmp_dir, circ_coor, ref,
+                           countlinearsplicedreads=True):
+    # unit is a (BAM file, chromosome) tuple, returns the start and end
+    # position counts of all circRNAs on this chromosome
+    bamfile, chromosome = unit
+
     gc = Gc.Genecount(tmp_dir)
 
-    # generate a unique thread ID
-    tid = id_generator()
+    return gc.count_positions(circ_coor, bamfile, ref,
+                              countlinearsplicedreads,
+                              chromosomes=[chromosome])
 
-    # create an (temporary) output file based on tid and file name
-    output = tmp_dir + "tmp_" + os.path.basename(
-        bamfile) + "_" + tid + "_junction.linear"
 
-    print("Counting host gene expression based on " \
-          "detected and filtered circRNA coordinates for %s" % bamfile)
+def hostgenecount(pool, bamfiles, tmp_dir, circ_coor, ref,
+                  countlinearsplicedreads=True):
+    # Split host gene counting into (BAM file, chromosome) work units, so
+    # the pool is used by all chromosomes of all samples and not only by one
+    # process per BAM file, and merge the counts into one table per BAM file
+    gc = Gc.Genecount(tmp_dir)
+
+    circs = collections.Counter(
+        chrom for chrom, start, end in gc.readcoordinates(circ_coor))
 
-    # launch the gene counting
-    gc.comb_gen_count(circ_coor, bamfile, ref, output, countlinearsplicedreads)
+    # chromosomes with most circRNAs first, so short units fill up the end
+    chromosomes = sorted(circs, key=lambda chrom: (-circs[chrom], chrom))
+    units = [(bamfile, chrom) for chrom in chromosomes for bamfile in bamfiles]
 
-    # return this input file's output name
-    return output
+    print("Counting host gene expression based on detected and filtered "
+          "circRNA coordinates in %d chunks of %d files" % (len(units),
+                                                            len(bamfiles)))
+
+    results = pool.map(
+        functools.partial(wraphostgenecountchunk, tmp_dir=tmp_dir,
+                          circ_coor=circ_coor, ref=ref,
+                          countlinearsplicedreads=countlinearsplicedreads),
+        units)
+
+    linearfiles = []
+    for bamfile in bamfiles:
+        coordinates_start = {}
+        coordinates_end = {}
+        for unit, (startcount, endcount) in zip(units, results):
+            if unit[0] == bamfile:
+                coordinates_start.update(startcount)
+                coordinates_end.update(endcount)
+
+        # create an (temporary) output file based on tid and file name
+        output = tmp_dir + "tmp_" + os.path.basename(
+            bamfile) + "_" + id_generator() + "_junction.linear"
+
+        gc.write_count_table(circ_coor, coordinates_start, coordinates_end,
+                             output)
+
+        print('Ended linear gene expression counting %s' % bamfile)
+        logging.info('Ended linear gene expression counting %s' % bamfile)
+
+        linearfiles.append(output)
+
+    return linearfiles
 
 
 def wrapfindcirc(files, tmp_dir, endTol, maxL, minL, strand=True,
-                 pairdendindependent=True, same=False):
+                 pairdendindependent=True, same=False, streaming=False):
     # create local instance
     f = Fc.Findcirc(endTol=endTol, maxL=maxL, minL=minL)
 
@@ -899,6 +972,18 @@ def wrapfindcirc(files, tmp_dir, endTol, maxL, minL, strand=True,
         circfilename = files + indx + ".circRNA"
     else:
         circfilename = files + ".circRNA"
+
+    if streaming:
+        # single pass over the junction file, no intermediate tmp_ files
+        print("\t=> locating circRNAs (streaming mode) [%s]" % files)
+        f.streamcirc(files, circfilename, strand=strand,
+                     pairedendindependent=pairdendindependent)
+
+        logging.info("finished circRNA detection from file %s" % files)
+        print("finished circRNA detection from file %s" % files)
+
+        return circfilename
+
     if pairdendindependent:
         f.printcircline(files, tmp_dir + "tmp_printcirclines." + indx)
 
@@ -950,3 +1035,58 @@ def wrapfindcirc(files, tmp_dir, endTol, maxL, minL, strand=True,
 
     return circfilename
 
+
+def wrapfindcircchunk(chunk, endTol, maxL, minL, strand=True,
+                      pairdendindependent=True):
+    # chunk is a (file name, chunk number, start byte, end byte) tuple
+    files, chunknr, start, end = chunk
+
+    f = Fc.Findcirc(endTol=endTol, maxL=maxL, minL=minL)
+
+    return f.findcircchunk(files, start, end, chunknr, strand=strand,
+                           pairedendindependent=pairdendindependent)
+
+
+def findcircchunked(pool, files, chunk_size, endTol, maxL, minL, strand=True,
+                    pairdendindependent=True, same=False):
+    # Split all junction files into byte ranges and process all chunks of all
+    # files on the pool, so a single large sample uses every worker
+    f = Fc.Findcirc(endTol=endTol, maxL=maxL, minL=minL)
+
+    chunks = []
+    owners = []  # index of the input file for each chunk
+    for indx, fname in enumerate(files):
+        for chunknr, (start, end) in enumerate(
+                f.chunkoffsets(fname, chunk_size)):
+            chunks.append((fname, chunknr, start, end))
+            owners.append(indx)
+
+    logging.info("started circRNA detection from %d chunks of %d files" % (
+        len(chunks), len(files)))
+    print("started circRNA detection from %d chunks of %d files" % (
+        len(chunks), len(files)))
+
+    results = pool.map(
+        functools.partial(wrapfindcircchunk, endTol=endTol, maxL=maxL,
+                          minL=minL, strand=strand,
+                          pairdendindependent=pairdendindependent),
+        chunks)
+
+    circfiles = []
+    for indx, fname in enumerate(files):
+        if same:
+            circfilename = fname + id_generator() + ".circRNA"
+        else:
+            circfilename = fname + ".circRNA"
+
+        print("\t=> merging chunks [%s]" % fname)
+        f.mergechunks([res for owner, res in zip(owners, results)
+                       if owner == indx], circfilename, strand=strand,
+                      pairedendindependent=pairdendindependent)
+
+        logging.info("finished circRNA detection from file %s" % fname)
+        print("finished circRNA detection from file %s" % fname)
+
+        circfiles.append(circfilename)
+
+    return circfiles
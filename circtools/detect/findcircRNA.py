@@ -1,8 +1,20 @@
 #!/usr/bin/env python2
 
 import collections
+import heapq
+import itertools
 import logging
+import os
 import re
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from . import junctionReader as Jr
+
+# Number of distinct read names sepDuplicates keeps in memory before switching to an external sort
+MAX_INMEMORY_READS = 10000000
 
 
 class Findcirc(object):
@@ -26,22 +38,66 @@ class Findcirc(object):
                 g = g + int(L[i])
         return g
 
+    def circmask(self, junctions):
+        # Vectorized back-splice filter on a junctionReader chunk: same chromosome and strand, circle length
+        # within (minL, maxL) and both alignments ending within endTol of the junction
+        A = junctions.brkpt_donorA.values
+        B = junctions.brkpt_acceptorB.values
+        plus = junctions.strand_donorA.values == '+'
+        minus = junctions.strand_donorA.values == '-'
+        length = np.where(plus, A - B, B - A)
+        return (junctions.valid.values & (junctions.junction_type.values >= 0) &
+                (junctions.chr_donorA.values == junctions.chr_acceptorB.values) &
+                (junctions.strand_donorA.values == junctions.strand_acceptorB.values) &
+                (plus | minus) & (length > 0) & (self.minL < length) & (length < self.maxL) &
+                ((plus & (junctions.start_alnA.values + self.endTol > B) &
+                  (junctions.start_alnB.values + junctions.span_alnB.values - self.endTol <= A)) |
+                 (minus & (junctions.start_alnB.values + self.endTol > A) &
+                  (junctions.start_alnA.values + junctions.span_alnA.values - self.endTol <= B))))
+
+    def circframe(self, junctions, strand=True):
+        # Vectorized circline, returns the circRNA records of all rows as lists of strings
+        A = junctions.brkpt_donorA.values
+        B = junctions.brkpt_acceptorB.values
+        jt = junctions.junction_type.values
+        plus = junctions.strand_donorA.values == '+'
+        if strand:
+            circstrand = np.where(plus, '-', '+')
+            circjt = np.where(jt == 0, 0, 3 - jt)
+        else:
+            circstrand = junctions.strand_donorA.values
+            circjt = jt
+        return pd.DataFrame({'chr': junctions.chr_donorA.values,
+                             'start': np.where(plus, B + 1, A + 1).astype(str),
+                             'end': np.where(plus, A - 1, B - 1).astype(str),
+                             'strand': circstrand,
+                             'junctiontype': circjt.astype(str),
+                             'repeat_left': junctions.repeat_left_lenA.values,
+                             'repeat_right': junctions.repeat_right_lenB.values}).values.tolist()
+
+    def circline(self, L, strand=True):
+        # Convert a split junction line into a circRNA record: chr, start, end, strand, junction type, repeats
+        if L[2] == '+':
+            start, end = str(int(L[4]) + 1), str(int(L[1]) - 1)
+        else:
+            start, end = str(int(L[1]) + 1), str(int(L[4]) - 1)
+        if strand:
+            if L[6] == '0':
+                return [L[0], start, end, '-' if L[2] == '+' else '+', '0', L[7], L[8]]
+            else:
+                return [L[0], start, end, '-' if L[2] == '+' else '+', str(3 - int(L[6])), L[7], L[8]]
+        else:
+            return [L[0], start, end, L[2], L[6], L[7], L[8]]
+
     def printcircline(self, Chim_junc, output):
+        # The junction file is read twice in parallel: columnar for the filter, as text to copy matching lines
         junctionfile = open(Chim_junc, 'r')
         outfile = open(output, 'w')
-        for line in junctionfile:
-            L = line.split('\t')
-            if L[0] == "chr_donorA":
-               continue
-            if int(L[6]) >= 0 and L[0] == L[3] and L[2] == L[5] and (
-                        (L[2] == '-' and int(L[4]) > int(L[1]) and self.minL < (int(L[4]) - int(L[1])) < self.maxL) or (
-                                        L[2] == '+' and int(L[1]) > int(L[4]) and self.minL < (
-                                        int(L[1]) - int(L[4])) < self.maxL)):
-                if (L[2] == '+' and (int(L[10]) + self.endTol) > int(L[4]) and (
-                                int(L[12]) + self.cigarGenomicDist(L[13]) - self.endTol) <= int(L[1])) or (
-                                    L[2] == '-' and (int(L[12]) + self.endTol) > int(L[1]) and (
-                                        int(L[10]) + self.cigarGenomicDist(L[11]) - self.endTol) <= int(L[4])):
-                    outfile.write(line)
+        if Jr.hasheader(junctionfile):
+            junctionfile.readline()
+        for junctions in Jr.readchunks(Chim_junc):
+            lines = itertools.islice(junctionfile, len(junctions))
+            outfile.writelines(itertools.compress(lines, self.circmask(junctions)))
         outfile.close()
         junctionfile.close()
 
@@ -49,20 +105,11 @@ class Findcirc(object):
     # but the nonduplicates not all from joined mapping. For some reason, some reads chimerically mapped separately,
     # but not jointly, although they are not two mates chimeria
 
-    def sepDuplicates(self, Chim_junc, duplicates, nonduplicates):
-        # seperate out duplicated reads, means both mates are chimera
-        # Chim_junc is the output of printcircline function
-        # Duplicated reads are appear in a scrambled order, the real strand read come later than the reversed strand
-
-        junctionfile = open(Chim_junc, 'r')
-        dup = open(duplicates, 'w')
-        nondup = open(nonduplicates, 'w')
-
-        reads = []
-        lines = []  # A list of all lines
+    def duplicatekeys(self, lines):
+        # Yield (readname, line_split) for split junction lines. The key joins donor and acceptor positions with
+        # the read name; once a '.1'/'.2' mate suffix has been seen it is stripped for all following lines.
         suffice = False
-        for line in junctionfile:
-            line_split = line.split('\t')
+        for line_split in lines:
             if not suffice:
                 if len(line_split[9].split('.')[-1]) == 1:
                     suffice = True
@@ -71,25 +118,98 @@ class Findcirc(object):
                     (line_split[1], line_split[2], line_split[4], '.'.join(line_split[9].split('.')[:-1])))
             else:
                 readname = '.'.join((line_split[1], line_split[2], line_split[4], line_split[9]))
-            reads.append(readname)
-            lines.append(line)
+            yield readname, line_split
 
-        for indx, read in enumerate(reads):
-            if reads.count(read) == 2:
-                dup.write(lines[indx])
-            elif reads.count(read) > 2:
-                print('Read %s has more than 2 count.' % read)
-                try:
-                    logging.warning('Read %s has more than 2 count.' % read)
-                except NameError:
-                    pass
+    def sepDuplicates(self, Chim_junc, duplicates, nonduplicates, maxreads=MAX_INMEMORY_READS):
+        # seperate out duplicated reads, means both mates are chimera
+        # Chim_junc is the output of printcircline function
+        # Duplicated reads are appear in a scrambled order, the real strand read come later than the reversed strand
+
+        # First pass: count read names in a hash table. If there are more distinct read names than maxreads
+        # fall back to an external sort on disk.
+        reads = collections.Counter()
+        with open(Chim_junc, 'r') as junctionfile:
+            for readname, line_split in self.duplicatekeys(line.split('\t') for line in junctionfile):
+                reads[readname] += 1
+                if maxreads and len(reads) > maxreads:
+                    break
             else:
-                nondup.write(lines[indx])
+                maxreads = None
+
+        if maxreads:
+            reads = None
+            logging.info('More than %d chimeric reads in %s, separating duplicates on disk' % (maxreads, Chim_junc))
+            self.sepDuplicatesOnDisk(Chim_junc, duplicates, nonduplicates, maxreads)
+            return
+
+        # Second pass: write each line in input order according to its read count
+        junctionfile = open(Chim_junc, 'r')
+        dup = open(duplicates, 'w')
+        nondup = open(nonduplicates, 'w')
+
+        for read, line_split in self.duplicatekeys(line.split('\t') for line in junctionfile):
+            self.writeduplicate(read, reads[read], '\t'.join(line_split), dup, nondup)
 
         junctionfile.close()
         dup.close()
         nondup.close()
 
+    def writeduplicate(self, read, count, line, dup, nondup):
+        if count == 2:
+            dup.write(line)
+        elif count > 2:
+            print('Read %s has more than 2 count.' % read)
+            logging.warning('Read %s has more than 2 count.' % read)
+        else:
+            nondup.write(line)
+
+    def sepDuplicatesOnDisk(self, Chim_junc, duplicates, nonduplicates, maxreads=MAX_INMEMORY_READS):
+        # External sort fallback of sepDuplicates for inputs with too many reads to count in memory.
+        # (read name, line number) pairs are sorted in runs of maxreads and merged to get the read counts,
+        # the resulting (line number, count) pairs are sorted back into input order and joined with the input.
+        tmp_dir = os.path.dirname(os.path.abspath(duplicates))
+
+        with open(Chim_junc, 'r') as junctionfile:
+            keys = ((read, linenr) for linenr, (read, line_split) in
+                    enumerate(self.duplicatekeys(line.split('\t') for line in junctionfile)))
+            key_runs = self.spillsorted(keys, maxreads, tmp_dir)
+
+        def counts():
+            merged = heapq.merge(*[self.readspilled(run) for run in key_runs])
+            for read, group in itertools.groupby(merged, key=lambda x: x[0]):
+                linenrs = [linenr for _, linenr in group]
+                for linenr in linenrs:
+                    yield linenr, read, len(linenrs)
+
+        count_runs = self.spillsorted(counts(), maxreads, tmp_dir)
+        for run in key_runs:
+            os.remove(run)
+
+        with open(Chim_junc, 'r') as junctionfile, open(duplicates, 'w') as dup, open(nonduplicates, 'w') as nondup:
+            merged = heapq.merge(*[self.readspilled(run) for run in count_runs])
+            for line, (linenr, read, count) in zip(junctionfile, merged):
+                self.writeduplicate(read, count, line, dup, nondup)
+
+        for run in count_runs:
+            os.remove(run)
+
+    def spillsorted(self, items, runlength, tmp_dir):
+        # Sort tuples in runs of runlength and write every run to a temporary file, returns the file names
+        runs = []
+        for run in iter(lambda: list(itertools.islice(items, runlength)), []):
+            run.sort()
+            fd, fname = tempfile.mkstemp(prefix='tmp_spill.', dir=tmp_dir)
+            with os.fdopen(fd, 'w') as out:
+                out.writelines('\t'.join(str(field) for field in itm) + '\n' for itm in run)
+            runs.append(fname)
+        return runs
+
+    def readspilled(self, fname):
+        # Read back a run written by spillsorted, integer fields are restored as int
+        with open(fname) as run:
+            for line in run:
+                yield tuple(int(field) if field.isdigit() else field for field in line.rstrip('\n').split('\t'))
+
     def smallcirc(self, duplicates, output, strand=True):
         '''
         Find small circRNAs in paired-end data where both mates are chimeric. Input is duplicates file by sepDuplicates.
@@ -97,10 +217,10 @@ class Findcirc(object):
 
         # The second occure read has the 'real' strand of that circle.
 
-        dup = open(duplicates).readlines()
+        dup = open(duplicates)
         outfile = open(output, 'w')
 
-        collect = []
+        collect = set()
         for line in dup:
             L = line.split('\t')
             if L[2] == '+':
@@ -130,7 +250,7 @@ class Findcirc(object):
                         res = [L[0], str(int(L[1]) + 1), str(int(L[4]) - 1), L[2], L[6], L[7], L[8]]
                         outfile.write(('\t').join(res) + '\n')
             else:
-                collect.append(identifier)  # Identifiers for duplicates
+                collect.add(identifier)  # Identifiers for duplicates
 
                 ## All switch to plus strand
                 # if L[2] == '-':
@@ -151,46 +271,113 @@ class Findcirc(object):
         outfile.close()
 
     def findcirc(self, Chim_junc, output, strand=True):
-        junctionfile = open(Chim_junc, 'r')
         outfile = open(output, 'w')
-        linecnt = 1
-        for line in junctionfile:
-            L = line.split('\t')
-            linecnt = linecnt + 1
-
-            if len(L) < 14:
-                print(("WARNING: File " + str(Chim_junc) + ", line " + str(linecnt) + " does not contain all features."))
-                print(("WARNING: " + str(Chim_junc) + " is probably corrupt."))
-            if L[0] == "chr_donorA":
-               continue
-            if int(L[6]) >= 0 and L[0] == L[3] and L[2] == L[5] and (
-                        (L[2] == '-' and int(L[4]) > int(L[1]) and self.minL < (int(L[4]) - int(L[1])) < self.maxL) or (
-                                        L[2] == '+' and int(L[1]) > int(L[4]) and self.minL < (
-                                        int(L[1]) - int(L[4])) < self.maxL)):
-                if (L[2] == '+' and (int(L[10]) + self.endTol) > int(L[4]) and (
-                                int(L[12]) + self.cigarGenomicDist(L[13]) - self.endTol) <= int(L[1])):
-                    if strand:
-                        if L[6] == '0':
-                            res = [L[0], str(int(L[4]) + 1), str(int(L[1]) - 1), '-', '0', L[7], L[8]]
-                        else:
-                            res = [L[0], str(int(L[4]) + 1), str(int(L[1]) - 1), '-', str(3 - int(L[6])), L[7], L[8]]
-                        outfile.write(('\t').join(res) + '\n')
-                    else:
-                        res = [L[0], str(int(L[4]) + 1), str(int(L[1]) - 1), L[2], L[6], L[7], L[8]]
-                        outfile.write(('\t').join(res) + '\n')
-                if L[2] == '-' and (int(L[12]) + self.endTol) > int(L[1]) and (
-                                int(L[10]) + self.cigarGenomicDist(L[11]) - self.endTol) <= int(L[4]):
-                    if strand:
-                        if L[6] == '0':
-                            res = [L[0], str(int(L[1]) + 1), str(int(L[4]) - 1), '+', '0', L[7], L[8]]
-                        else:
-                            res = [L[0], str(int(L[1]) + 1), str(int(L[4]) - 1), '+', str(3 - int(L[6])), L[7], L[8]]
-                        outfile.write(('\t').join(res) + '\n')
-                    else:
-                        res = [L[0], str(int(L[1]) + 1), str(int(L[4]) - 1), L[2], L[6], L[7], L[8]]
-                        outfile.write(('\t').join(res) + '\n')
+        for junctions in Jr.readchunks(Chim_junc):
+            res = self.circframe(junctions[self.circmask(junctions)], strand=strand)
+            outfile.writelines(('\t').join(itm) + '\n' for itm in res)
         outfile.close()
-        junctionfile.close()
+
+    # Streaming detection: every Chimeric.out.junction line is split once and handed through generator
+    # stages instead of being written to and re-read from tmp_printcirclines, tmp_duplicates, tmp_nonduplicates,
+    # tmp_smallcircs, tmp_normalcircs and tmp_findcirc. Results are identical to the file based chain.
+
+    def readcirclines(self, Chim_junc, start=0, end=None):
+        # Yield the split fields of junction lines passing circmask, optionally from a byte range only
+        for junctions in Jr.readchunks(Chim_junc, start, end):
+            for L in Jr.tolines(junctions[self.circmask(junctions)]):
+                yield L
+
+    def chunkoffsets(self, Chim_junc, chunk_size):
+        # Split Chim_junc into byte ranges of roughly chunk_size bytes, every range starts at a line start
+        size = os.path.getsize(Chim_junc)
+        offsets = [0]
+        with open(Chim_junc, 'rb') as junctionfile:
+            while offsets[-1] + chunk_size < size:
+                junctionfile.seek(offsets[-1] + chunk_size)
+                junctionfile.readline()
+                if junctionfile.tell() >= size:
+                    break
+                offsets.append(junctionfile.tell())
+        offsets.append(size)
+        return list(zip(offsets[:-1], offsets[1:]))
+
+    def sepduplicatelines(self, circlines):
+        # In-memory equivalent of sepDuplicates, returns (duplicates, nonduplicates) in input order.
+        # Only lines which passed circmask are kept, so memory scales with circRNA candidate reads.
+        reads = collections.Counter()
+        lines = []
+        for readname, L in self.duplicatekeys(circlines):
+            reads[readname] += 1
+            lines.append((readname, L))
+
+        duplicates = []
+        nonduplicates = []
+        for read, L in lines:
+            if reads[read] == 2:
+                duplicates.append(L)
+            elif reads[read] > 2:
+                print('Read %s has more than 2 count.' % read)
+                logging.warning('Read %s has more than 2 count.' % read)
+            else:
+                nonduplicates.append(L)
+        return duplicates, nonduplicates
+
+    def smallcirclines(self, duplicates, strand=True):
+        # Generator version of smallcirc, yields circRNA records for mates seen twice
+        collect = set()
+        for L in duplicates:
+            if L[2] == '+':
+                identifier = (L[0], L[1], L[3], L[4], L[9])
+            elif L[2] == '-':
+                identifier = (L[0], L[4], L[3], L[1], L[9])
+            if identifier in collect:
+                yield self.circline(L, strand=strand)
+            else:
+                collect.add(identifier)
+
+    def findcirclines(self, circlines, strand=True):
+        # Generator version of findcirc on lines that already passed circmask
+        for L in circlines:
+            yield self.circline(L, strand=strand)
+
+    def streamcirc(self, Chim_junc, output, strand=True, pairedendindependent=True):
+        """
+        Detect circRNAs from Chim_junc in a single pass and write the sorted count table to output.
+        Replaces printcircline, sepDuplicates, smallcirc, findcirc and Sort.sort_count without temporary files.
+        """
+        circlines = self.readcirclines(Chim_junc)
+        self.countcirclines(circlines, output, strand=strand, pairedendindependent=pairedendindependent)
+
+    def countcirclines(self, circlines, output, strand=True, pairedendindependent=True):
+        # Turn lines which passed circmask into the sorted count table
+        if pairedendindependent:
+            duplicates, nonduplicates = self.sepduplicatelines(circlines)
+            # small circles are always reported stranded, as in the file based work flow
+            records = itertools.chain(self.smallcirclines(duplicates),
+                                      self.findcirclines(nonduplicates, strand=strand))
+        else:
+            records = self.findcirclines(circlines, strand=strand)
+        Sort().stream_count(records, output, strand=strand)
+
+    def findcircchunk(self, Chim_junc, start, end, chunk, strand=True, pairedendindependent=True):
+        """
+        Process one byte range of Chim_junc, to be run in a worker process.
+        Duplicate mates may fall into different chunks, so in paired end independent mode the filtered lines
+        are returned and separated by mergechunks. Otherwise the partial counts of Sort.aggregate are returned.
+        """
+        circlines = list(self.readcirclines(Chim_junc, start, end))
+        if pairedendindependent:
+            return circlines
+        return Sort().aggregate(self.findcirclines(circlines, strand=strand), strand=strand, chunk=chunk)
+
+    def mergechunks(self, results, output, strand=True, pairedendindependent=True):
+        # Combine the findcircchunk results of one junction file, given in chunk order
+        if pairedendindependent:
+            self.countcirclines(itertools.chain.from_iterable(results), output, strand=strand,
+                                pairedendindependent=True)
+        else:
+            sort = Sort()
+            sort.writecounts(*sort.mergecounts(results), output=output)
 
 
 class Sort(object):
@@ -252,3 +439,44 @@ class Sort(object):
         sorted_count = self.count(tmp_sorted, strand=strand)
         output.writelines('\t'.join(j) + '\n' for j in sorted_count)
         output.close()
+
+    def stream_count(self, circlines, output, strand=True):
+        """
+        Count an iterable of Findcirc records and write the same table as sort_count.
+        Only the last record per circRNA in sort order is kept, so memory scales with distinct circRNAs.
+        """
+        self.writecounts(*self.aggregate(circlines, strand=strand), output=output)
+
+    def aggregate(self, circlines, strand=True, chunk=0):
+        # Count records per circRNA and remember the record sort_count would report.
+        # sort_count sorts stably by (chr, start, end, column 6), so the last record of a circRNA wins.
+        # chunk orders partial results of different chunks of the same input.
+        cnt = collections.Counter()
+        last = {}
+        for indx, itm in enumerate(circlines):
+            if strand:
+                circs = (itm[0], itm[1], itm[2], itm[3])
+            else:
+                circs = (itm[0], itm[1], itm[2])
+            cnt[circs] += 1
+            if circs not in last or itm[5] >= last[circs][0][0]:
+                last[circs] = ((itm[5], chunk, indx), itm)
+        return cnt, last
+
+    def mergecounts(self, partials):
+        # Merge (cnt, last) pairs returned by aggregate for several chunks
+        cnt = collections.Counter()
+        last = {}
+        for part_cnt, part_last in partials:
+            cnt.update(part_cnt)
+            for circs, (order, itm) in part_last.items():
+                if circs not in last or order > last[circs][0]:
+                    last[circs] = (order, itm)
+        return cnt, last
+
+    def writecounts(self, cnt, last, output):
+        ordered = sorted(last.items(), key=lambda x: (x[0][0], int(x[0][1]), int(x[0][2]), x[1][0]))
+        with open(output, 'w') as outfile:
+            for circs, (order, itm) in ordered:
+                outfile.write('\t'.join([itm[0], itm[1], itm[2], '.', str(cnt[circs]), itm[3], itm[4], itm[5],
+                                          itm[6]]) + '\n')
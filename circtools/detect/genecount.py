@@ -25,232 +25,171 @@ class Genecount(object):
         return "".join(random.choice(chars) for _ in range(size))
 
 
-    def countmapped(self, string):
-        # This function takes the 5th column (a string with mapping information),
-        # and return the count of '.' and ','. Which are mapped read count
-
-        rs = string.count(',') + string.count('.')
-
-        return str(rs)
-
-
-    def countspliced(self, string):
-        # return the count of '>' and '<'
-        rs = string.count('>') + string.count('<')
-        return str(rs)
-
-
-    def getreadscount(self, mpileup, countmapped=False):
-        # Input a mpileup result, which is a list
-        # The count information is in the 5th column
-        # count the number of mapped reads represented by ',' and '.' or, spliced reads
-        # represented by the number of '>' and '<' in the string
-
-        count = []
-
-        # print "mpileup is a " + str(type(mpileup))
-
-        if type(mpileup) is str:
-
-            mpileupline = mpileup.split('\n')
-
-            for itm in mpileupline:
-                tmp = itm.split('\t')
-
-                if countmapped:
-                    if len(tmp) == 6:
-                        count.append(tmp[0] + '\t' + tmp[1] + '\t' + self.countmapped(tmp[4]))
-                else:
-                    if len(tmp) == 6:
-                        count.append(tmp[0] + '\t' + tmp[1] + '\t' + self.countspliced(tmp[4]))
-
-        elif type(mpileup) is list:
-
-            for itm in mpileup:
-
-                if countmapped:
-                    if len(mpileup) == 6:
-                        count.append(itm[0] + '\t' + itm[1] + '\t' + self.countmapped(itm[4]))
-                else:
-                    if len(mpileup) == 6:
-                        count.append(itm[0] + '\t' + itm[1] + '\t' + self.countspliced(itm[4]))
-
-        return count
-
+    def readcoordinates(self, circ_coor, header=True, chromosomes=None):
+        # Return the (chr, start, end) string tuples of a circRNA coordinates file, optionally only for
+        # the given chromosomes
+        with open(circ_coor, 'r') as coor:
+            if header:
+                coor.readline()
+            coordinates = [tuple(line.rstrip('\n').split('\t')[:3]) for line in coor]
+        if chromosomes is not None:
+            chromosomes = set(chromosomes)
+            coordinates = [itm for itm in coordinates if itm[0] in chromosomes]
+        return coordinates
+
+    def windows(self, positions):
+        # Merge sorted 1-based positions into runs of consecutive positions (start, end), both inclusive
+        runs = []
+        for pos in positions:
+            if runs and pos == runs[-1][1] + 1:
+                runs[-1][1] = pos
+            else:
+                runs.append([pos, pos])
+        return runs
 
-    def genecount(self, circ_coordinates, bamfile, ref, tid):
+    def pileupcounts(self, bamfile, ref, positions):
+        """
+        Count reads at the given 1-based positions directly from the indexed BAM file.
+        @positions: dict, chromosome -> iterable of positions
+        Returns a dict (chr, position) -> (mapped, spliced) with the number of reads matching the reference
+        ('.' and ',' in mpileup) and skipping the position in an intron ('>' and '<' in mpileup).
+        Positions without coverage are missing, as in the mpileup output.
+        The pileup uses the samtools mpileup defaults (read filters, base quality 13, max depth 8000).
+        """
+        counts = {}
+        fasta = pysam.FastaFile(ref)
+        with pysam.AlignmentFile(bamfile, 'rb') as bam:
+            references = set(bam.references)
+            # one pass per chromosome, only reads overlapping the requested positions are read
+            for chrom in sorted(positions):
+                if chrom not in references:
+                    continue
+                for start, end in self.windows(sorted(set(pos for pos in positions[chrom] if pos > 0))):
+                    refseq = fasta.fetch(chrom, start - 1, end).upper()
+                    for column in bam.pileup(chrom, start - 1, end, truncate=True, stepper='samtools',
+                                             fastafile=fasta, min_base_quality=13, max_depth=8000,
+                                             ignore_overlaps=True, ignore_orphans=True):
+                        refbase = refseq[column.reference_pos - start + 1]
+                        mapped = 0
+                        spliced = 0
+                        # bases of all reads of the column at once, instead of decoding each read sequence
+                        for read, base in zip(column.pileups, column.get_query_sequences()):
+                            if read.is_refskip:
+                                spliced += 1
+                            elif not read.is_del:
+                                base = base.upper()
+                                if base == refbase or base == '=':
+                                    mapped += 1
+                        counts[(chrom, column.reference_pos + 1)] = (mapped, spliced)
+        fasta.close()
+        return counts
+
+    def genecount(self, circ_coordinates, bamfile, ref, chromosomes=None):
         """
         @circ_coordinates: quoted string, content with format "chr1\tstart\tend"
         @bamfile: quoted string
         @ref: quoted string
+        @chromosomes: only count circRNAs on these chromosomes (default: all)
+        Returns two dicts (chr, position) -> mapped read count, for circRNA start and end positions
         """
 
-        # process the circ_coordinates to left circ position and right circ position
-        coordinates = open(circ_coordinates, 'r').readlines()[1:]
-        start_coordinates = open(self.tmp_dir + 'tmp_start_coordinates_' + tid, 'w')
-        end_coordinates = open(self.tmp_dir + 'tmp_end_coordinates_' + tid, 'w')
+        coordinates = self.readcoordinates(circ_coordinates, chromosomes=chromosomes)
 
-        for line in coordinates:
-            tmp = line.split('\t')
-            start_coordinates.write(tmp[0] + '\t' + tmp[1] + '\n')
-            end_coordinates.write(tmp[0] + '\t' + tmp[2] + '\n')
-
-        # close position files:
-        start_coordinates.close()
-        end_coordinates.close()
+        positions = {}
+        for chrom, start, end in coordinates:
+            positions.setdefault(chrom, set()).update((int(start), int(end)))
 
         print(('Started linear gene expression counting for %s' % bamfile))
 
         start = time.time()
-        # mpileup get the read counts of the start and end positions
-        print(("\t=> running mpileup for start positions [%s]" % bamfile))
-        mpileup_start = pysam.mpileup(bamfile, '-f', ref, '-l', self.tmp_dir + 'tmp_start_coordinates_' + tid)
-        end = time.time() - start
-        print(("\t=> mpileup for start positions for %s took %d seconds" % (bamfile, end)))
-
-        start = time.time()
-        # mpileup get the read counts of the start and end positions
-        print(("\t=> running mpileup for end positions [%s]" % bamfile))
-        mpileup_end = pysam.mpileup(bamfile, '-f', ref, '-l', self.tmp_dir + 'tmp_end_coordinates_' + tid)
+        print(("\t=> counting reads at start and end positions [%s]" % bamfile))
+        counts = self.pileupcounts(bamfile, ref, positions)
         end = time.time() - start
-        print(("\t=> mpileup for end positions for %s took %d seconds" % (bamfile, end)))
+        print(("\t=> counting reads at start and end positions for %s took %d seconds" % (bamfile, end)))
 
-        print("\t=> gathering read counts for start positions [%s]" % bamfile)
-        startcount = self.getreadscount(mpileup_start, countmapped=True)
-
-        print("\t=> gathering read counts for end positions [%s]" % bamfile)
-        endcount = self.getreadscount(mpileup_end, countmapped=True)
-
-        # remove tmp files
-        # os.remove(self.tmp_dir + 'tmp_start_coordinates_' + tid)
-        # os.remove(self.tmp_dir + 'tmp_end_coordinates_' + tid)
+        startcount = {}
+        endcount = {}
+        for chrom, start, end in coordinates:
+            if (chrom, int(start)) in counts:
+                startcount[(chrom, start)] = str(counts[(chrom, int(start))][0])
+            if (chrom, int(end)) in counts:
+                endcount[(chrom, end)] = str(counts[(chrom, int(end))][0])
 
         print('Finished linear gene expression counting for %s' % bamfile)
 
         return startcount, endcount
 
+    def linearsplicedreadscount(self, circ_coor, bamfile, ref, header=True, chromosomes=None):
+        # Count linear spliced reads: reads skipping (start-1) but not start, and reads skipping (end+1) but not end,
+        # i.e. reads with an intron ending right before the circle start or starting right after the circle end.
+        # Returns two dicts (chr, position) -> spliced read count, for circRNA start and end positions
+        coordinates = self.readcoordinates(circ_coor, header=header, chromosomes=chromosomes)
+
+        positions = {}
+        for chrom, start, end in coordinates:
+            positions.setdefault(chrom, set()).update((int(start) - 1, int(start), int(end), int(end) + 1))
 
-    def submpileup(self, mpileup1, mpileup2, left=True):
-        # Genome region: mpileup1 < mpileup2
-        # used to calculate the spliced read counts difference
-        # Input mpileup is the result of getreadscount function.
-        # Input in a list of elements with format str\tstr\tstr
-        new_mpileup = []
-        # need to consider that mpileup1 and mpileup2 are not the same length
-        if len(mpileup1) == len(mpileup2):
-            for itm in range(len(mpileup1)):
-                mpileup1_count = int(mpileup1[itm].split('\t')[2])
-                mpileup2_count = int(mpileup2[itm].split('\t')[2])
-                shift = mpileup1_count - mpileup2_count
-                if shift < 0:
-                    shift = 0
-                new_mpileup.append(
-                    mpileup1[itm].split('\t')[0] + '\t' + mpileup1[itm].split('\t')[1] + '\t' + str(shift))
-        else:
-            mpileup1_dict = {}
-            mpileup2_dict = {}
-            for itm in mpileup1:
-                mpileup1_dict[(itm.split('\t')[0] + '\t' + itm.split('\t')[1])] = int(itm.split('\t')[2])
-            for itm in mpileup2:
-                mpileup2_dict[(itm.split('\t')[0] + '\t' + str(int(itm.split('\t')[1]) - 1))] = int(itm.split('\t')[2])
-
-            for itm in mpileup1_dict:
-                if itm in mpileup2_dict:
-                    if left:
-                        shift = mpileup1_dict[itm] - mpileup2_dict[itm]
-                        if shift < 0:
-                            shift = 0
-                        new_mpileup.append(
-                            itm.split('\t')[0] + '\t' + str(int(itm.split('\t')[1]) + 1) + '\t' + str(shift))
-                    else:
-                        shift = mpileup2_dict[itm] - mpileup1_dict[itm]
-                        if shift < 0:
-                            shift = 0
-                        new_mpileup.append(itm.split('\t')[0] + '\t' + itm.split('\t')[1] + '\t' + str(shift))
-
-        return new_mpileup
-
-    def linearsplicedreadscount(self, circ_coor, bamfile, ref, header=True):
-        # Count linear spliced reads
-        # process the circ_coordinates to left circ position and right circ position
-        if header:
-            coor = open(circ_coor, 'r').readlines()[1:]
-        else:
-            coor = open(circ_coor, 'r').readlines()
-        start_coor = open(self.tmp_dir + 'tmp_start_coor', 'w')
-        start_coor_1 = open(self.tmp_dir + 'tmp_start_coor_1', 'w')
-        end_coor = open(self.tmp_dir + 'tmp_end_coor', 'w')
-        end_coor_1 = open(self.tmp_dir + 'tmp_end_coor_1', 'w')
-
-        for line in coor:
-            tmp = line.split('\t')
-            start_coor.write(tmp[0] + '\t' + tmp[1] + '\n')
-            start_coor_1.write(tmp[0] + '\t' + str(int(tmp[1]) - 1) + '\n')
-            end_coor.write(tmp[0] + '\t' + tmp[2] + '\n')
-            end_coor_1.write(tmp[0] + '\t' + str(int(tmp[2]) + 1) + '\n')
-
-        # close position files:
-        start_coor.close()
-        start_coor_1.close()
-        end_coor.close()
-        end_coor_1.close()
         print(('Started linear spliced read counting for %s' % bamfile))
 
-        # mpileup get the number of spliced reads at circle start position and (start-1) position.
+        print(("\t=> counting spliced reads at start and end positions [%s]" % bamfile))
+        counts = self.pileupcounts(bamfile, ref, positions)
 
-        print(("\t=> running mpileup 1 for start positions [%s]" % bamfile))
-        mpileup_start = pysam.mpileup(bamfile, '-f', ref, '-l', self.tmp_dir + 'tmp_start_coor')
+        def shift(outer, inner):
+            # spliced reads at the position outside the circle minus those at the circle boundary
+            if outer in counts and inner in counts:
+                return str(max(counts[outer][1] - counts[inner][1], 0))
 
-        print(("\t=> running mpileup 2 for start positions [%s]" % bamfile))
-        mpileup_start_1 = pysam.mpileup(bamfile, '-f', ref, '-l', self.tmp_dir + 'tmp_start_coor_1')
+        startcount = {}
+        endcount = {}
+        for chrom, start, end in coordinates:
+            count = shift((chrom, int(start) - 1), (chrom, int(start)))
+            if count is not None:
+                startcount[(chrom, start)] = count
+            count = shift((chrom, int(end) + 1), (chrom, int(end)))
+            if count is not None:
+                endcount[(chrom, end)] = count
 
-        # mpileup get the number of spliced reads at circle end position and (end+1) position.
-        print(("\t=> running mpileup 1 for end positions [%s]" % bamfile))
-        mpileup_end = pysam.mpileup(bamfile, '-f', ref, '-l', self.tmp_dir + 'tmp_end_coor')
+        print('Finished linear spliced read counting for %s' % bamfile)
 
-        print(("\t=> running mpileup 2 for end positions [%s]" % bamfile))
-        mpileup_end_1 = pysam.mpileup(bamfile, '-f', ref, '-l', self.tmp_dir + 'tmp_end_coor_1')
+        return startcount, endcount
 
-        # get count
+    def comb_gen_count(self, circ_coor, bamfile, ref, output, countlinearsplicedreads=True):
+        tid = self.id_generator()
 
-        print("\t=> gathering read counts for start positions [%s]" % bamfile)
-        startcount = self.submpileup(self.getreadscount(mpileup_start_1), self.getreadscount(mpileup_start))
+        coordinates_start, coordinates_end = self.count_positions(circ_coor, bamfile, ref,
+                                                                  countlinearsplicedreads)
 
-        print("\t=> gathering read counts for end positions [%s]" % bamfile)
-        endcount = self.submpileup(self.getreadscount(mpileup_end), self.getreadscount(mpileup_end_1), left=False)
+        print('Ended linear gene expression counting %s' % bamfile)
+        logging.info('Ended linear gene expression counting %s' % bamfile)
 
-        # remove tmp files
-        # os.remove(self.tmp_dir + 'tmp_start_coor')
-        # os.remove(self.tmp_dir + 'tmp_start_coor_1')
-        # os.remove(self.tmp_dir + 'tmp_end_coor')
-        # os.remove(self.tmp_dir + 'tmp_end_coor_1')
+        self.write_count_table(circ_coor, coordinates_start, coordinates_end, output)
 
-        print('Finished linear spliced read counting for %s' % bamfile)
+        print('Ended post processing %s' % bamfile)
+        logging.info('Ended post processing %s' % bamfile)
+        return tid
 
-        return startcount, endcount
+    def count_positions(self, circ_coor, bamfile, ref, countlinearsplicedreads=True, chromosomes=None):
+        # Start and end position counts of the circRNAs in circ_coor, optionally only on the given chromosomes.
+        # Used by comb_gen_count and as a (BAM file, chromosomes) work unit for parallel counting.
+        if countlinearsplicedreads:
+            return self.linearsplicedreadscount(circ_coor, bamfile, ref, chromosomes=chromosomes)
+        else:
+            # call genecount to get the start and end positon read counts
+            return self.genecount(circ_coor, bamfile, ref, chromosomes=chromosomes)
 
-    def comb_gen_count(self, circ_coor, bamfile, ref, output, countlinearsplicedreads=True):
+    def write_count_table(self, circ_coor, coordinates_start, coordinates_end, output):
+        """
+        Write the *_junction.linear count table in the order of circ_coor.
+        @coordinates_start / coordinates_end: dict (chromosome, start or end position) -> read count
+        """
         idx = open(circ_coor, 'r').readlines()[1:]  # make sure are tab delimited
 
-        tid = self.id_generator()
-
-        # tmp_start = open(options.startfile,'r') # make sure are tab delimited
-        # tmp_end = open(options.endfile,'r') # make sure are taa delimited
-
         # This is the chromosome name and start position of the original bed file list, like Lvr_F_104_filtered_candid
         coordinates_indx_start = []
 
         # This is the chromosome name and end position of the original bed file list, like Lvr_F_104_filtered_candid
         coordinates_indx_end = []
 
-        # This is the chromosome name and start position of the counted read counts bed file list,
-        # like tmp_readcounts_start
-        coordinates_start = {}
-
-        # This is the chromosome name and start position of the counted read counts bed file list,
-        # like tmp_readcounts_end
-        coordinates_end = {}
-
         # Store the read counts of start positions
         count_start = []
 
@@ -260,23 +199,6 @@ class Genecount(object):
         # Store chr, start, end information from circRNAs candidates file
         coordinates = []
 
-        if countlinearsplicedreads:
-            tmp_start, tmp_end = self.linearsplicedreadscount(circ_coor, bamfile, ref)
-        else:
-            # call genecount to get the start and end positon read counts
-            tmp_start, tmp_end = self.genecount(circ_coor, bamfile, ref, tid)
-
-        print('Ended linear gene expression counting %s' % bamfile)
-        logging.info('Ended linear gene expression counting %s' % bamfile)
-
-        for line in tmp_start:
-            tmp_start_split = line.split('\t')
-            coordinates_start[(tmp_start_split[0], tmp_start_split[1])] = tmp_start_split[2].strip()
-
-        for line in tmp_end:
-            tmp_end_split = line.split('\t')
-            coordinates_end[(tmp_end_split[0], tmp_end_split[1])] = tmp_end_split[2].strip()
-
         for line in idx:
             indx_split = line.split('\t')
             coordinates_indx_start.append((indx_split[0], indx_split[1]))
@@ -309,11 +231,4 @@ class Genecount(object):
         else:
             sys.exit('read count number does not match with number of circRNAs candidates')
 
-        # close files
-        # tmp_start.close()
-        # tmp_end.close()
         count_table.close()
-
-        print('Ended post processing %s' % bamfile)
-        logging.info('Ended post processing %s' % bamfile)
-        return tid
@@ -0,0 +1,119 @@
+# Columnar reader for STAR Chimeric.out.junction files
+# Required: numpy, pandas
+#
+# Junction files are read in chunks into pandas DataFrames with integer typed
+# coordinates and the genomic span of both CIGAR strings already computed, so
+# the filters in findcircRNA and fix2chimera can run as vectorized masks.
+
+import csv
+
+import numpy as np
+import pandas as pd
+
+# Columns of the (old style) STAR Chimeric.out.junction format, additional columns are ignored
+COLUMNS = ['chr_donorA', 'brkpt_donorA', 'strand_donorA', 'chr_acceptorB', 'brkpt_acceptorB', 'strand_acceptorB',
+           'junction_type', 'repeat_left_lenA', 'repeat_right_lenB', 'read_name', 'start_alnA', 'cigar_alnA',
+           'start_alnB', 'cigar_alnB']
+
+INTEGER_COLUMNS = ['brkpt_donorA', 'brkpt_acceptorB', 'junction_type', 'start_alnA', 'start_alnB']
+
+# Low cardinality text columns are read as categoricals, which is much cheaper than one string object per field
+DTYPES = {'chr_donorA': 'category', 'strand_donorA': 'category', 'chr_acceptorB': 'category',
+          'strand_acceptorB': 'category', 'repeat_left_lenA': 'category', 'repeat_right_lenB': 'category',
+          'read_name': str, 'cigar_alnA': 'category', 'cigar_alnB': 'category'}
+
+HEADER = b'chr_donorA\t'
+
+# Number of junction lines per chunk
+CHUNKSIZE = 1000000
+
+
+class ByteRange(object):
+    # File like wrapper which stops reading at byte offset end
+    def __init__(self, fileobj, end=None):
+        self.fileobj = fileobj
+        self.end = end
+
+    def read(self, size=-1):
+        if self.end is None:
+            return self.fileobj.read(size)
+        remaining = max(self.end - self.fileobj.tell(), 0)
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        return self.fileobj.read(size)
+
+    def __iter__(self):
+        return iter(self.read().splitlines(True))
+
+
+def cigarspans(cigars):
+    # Genomic distance covered by each CIGAR string (all operations except S and I) of a categorical Series.
+    # Every distinct CIGAR string is only parsed once.
+    categories = pd.Series(cigars.cat.categories.astype(str))
+    ops = categories.str.extractall(r'(\-?[0-9]+)([a-zA-Z])')
+    if len(ops) == 0:
+        return np.zeros(len(cigars), dtype='int64')
+    lengths = ops[0].astype('int64').where(~ops[1].isin(['S', 'I']), 0)
+    spans = lengths.groupby(level=0).sum().reindex(categories.index, fill_value=0).values
+    return spans[cigars.cat.codes.values]
+
+
+def readchunks(Chim_junc, start=0, end=None, chunksize=CHUNKSIZE):
+    """
+    Yield DataFrames of up to chunksize lines of Chim_junc, optionally restricted to the byte range start:end.
+    A leading STAR header line is skipped (see hasheader), otherwise there is one row per input line: header,
+    comment and incomplete lines are kept, so rows can be matched with the raw lines, but are marked as not
+    valid and have their integer columns set to -1.
+    """
+    with open(Chim_junc, 'rb') as junctionfile:
+        junctionfile.seek(start)
+        # the STAR header line is skipped here, so the integer columns of the first chunk can be parsed as such
+        if junctionfile.read(len(HEADER)) != HEADER:
+            junctionfile.seek(start)
+        else:
+            junctionfile.readline()
+        reader = pd.read_csv(ByteRange(junctionfile, end), sep='\t', header=None, names=COLUMNS,
+                             usecols=range(len(COLUMNS)), dtype=DTYPES, quoting=csv.QUOTE_NONE, na_filter=False,
+                             skip_blank_lines=False, low_memory=False, chunksize=chunksize)
+        for junctions in reader:
+            # header and comment lines are found on the (few) chromosome categories
+            categories = junctions.chr_donorA.cat.categories
+            comments = [chrom for chrom in categories if chrom == 'chr_donorA' or chrom.startswith('#')]
+            comment = junctions.chr_donorA.isin(comments).values
+            incomplete = np.asarray(junctions.cigar_alnB.values == '') & ~comment
+            valid = ~(comment | incomplete)
+
+            for linecnt in junctions.index[incomplete]:
+                print(("WARNING: File " + str(Chim_junc) + ", line " + str(linecnt + 1) +
+                       " does not contain all features."))
+                print(("WARNING: " + str(Chim_junc) + " is probably corrupt."))
+
+            # integer columns are only parsed as text if the chunk holds a header, comment or incomplete line
+            for column in INTEGER_COLUMNS:
+                if junctions[column].dtype != np.int64:
+                    junctions[column] = junctions[column].where(valid, '-1').astype('int64')
+
+            # donor and acceptor categoricals need the same categories to be compared
+            for donor, acceptor in (('chr_donorA', 'chr_acceptorB'), ('strand_donorA', 'strand_acceptorB')):
+                categories = junctions[donor].cat.categories.union(junctions[acceptor].cat.categories)
+                junctions[donor] = junctions[donor].cat.set_categories(categories)
+                junctions[acceptor] = junctions[acceptor].cat.set_categories(categories)
+
+            junctions['valid'] = valid
+            junctions['span_alnA'] = cigarspans(junctions.cigar_alnA)
+            junctions['span_alnB'] = cigarspans(junctions.cigar_alnB)
+
+            yield junctions
+
+
+def hasheader(junctionfile):
+    # Check whether the (text mode) junctionfile continues with a STAR header line, without consuming it
+    pos = junctionfile.tell()
+    header = junctionfile.read(len(HEADER)) == HEADER.decode()
+    junctionfile.seek(pos)
+    return header
+
+
+def tolines(junctions):
+    # Convert junction rows back to lists of strings, as from line.split('\t')
+    return junctions[COLUMNS].astype(str).values.tolist()
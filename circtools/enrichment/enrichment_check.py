@@ -15,20 +15,28 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import functools
+import hashlib
+import json
 import logging
 import multiprocessing
 import os
 import re
 import sys
+import tempfile
 import time
 
 import circ_module.circ_template
+import numpy as np
 import pybedtools
 
+from . import permutation
+
 FILE_TYPE_GTF = ".gtf"
 FILE_TYPE_BED = ".bed"
 
+# bump whenever the checkpoint layout changes, older checkpoints are ignored
+CHECKPOINT_VERSION = 1
+
 
 class EnrichmentModule(circ_module.circ_template.CircTemplate):
     def __init__(self, argparse_arguments, program_name, version):
@@ -38,12 +46,14 @@ class EnrichmentModule(circ_module.circ_template.CircTemplate):
         self.program_name = program_name
         self.version = version
         self.observed_counts = []
-        self.results = []
         self.tmp_dict = {}
         self.phase_storage = {}
         self.virtual_inclusion_file_path = "all"
         self.virtual_inclusion_object = None
         self.circRNA_buddies = {}
+        self.count_layouts = []
+        self.engine = None
+        self.permutation_plan = {}
         self.whitelist_fg = ""
         self.whitelist_bg = ""
 
@@ -200,104 +210,94 @@ class EnrichmentModule(circ_module.circ_template.CircTemplate):
         # set up the multiprocessing pool for multi-threading
         mp_pool = multiprocessing.Pool(processes=self.cli_params.num_processes)
 
-        # create list of shuffled peaks
-        self.log_entry("Starting random shuffling of input peaks")
-        shuffled_peaks = (mp_pool.map(functools.partial(self.shuffle_peaks_through_genome,
-                                                        bed_file=supplied_bed,
-                                                        genome_file=self.cli_params.genome_file,
-                                                        include=self.virtual_inclusion_file_path),
-                                      range(self.cli_params.num_iterations)))
+        # intervals we count the peaks in: circular [0] and linear RNA [1]
+        if not self.cli_params.whitelist:
+            base_beds = [circ_rna_bed, annotation_bed]
+        else:
+            # the enriched exons as circular, the "normal" exons are running as linear from here on
+            base_beds = [self.whitelist_fg, circ_rna_bed]
 
-        shuffled_peaks.insert(0, supplied_bed)
+        self.count_layouts = [self.count_layout(base_bed) for base_bed in base_beds]
 
-        # shuffled_peaks.append(supplied_bed)
-        # do the intersections
-        self.log_entry("Starting data acquisition from samplings")
-        self.results = mp_pool.map(functools.partial(self.random_sample_step,
-                                                     circ_rna_bed=circ_rna_bed,
-                                                     annotation_bed=annotation_bed,
-                                                     shuffled_peaks=shuffled_peaks,
-                                                     ), range(self.cli_params.num_iterations + 1))
+        include = None
+        if self.virtual_inclusion_file_path != "all":
+            include = permutation.Intervals.from_bed(self.virtual_inclusion_object)
 
-        self.tmp_dict = self.process_intersection(self.results[0][0])
+        try:
+            self.engine = permutation.PermutationEngine(permutation.Intervals.from_bed(supplied_bed),
+                                                        [layout["intervals"] for layout in self.count_layouts],
+                                                        permutation.read_genome_file(self.cli_params.genome_file),
+                                                        include)
+        except ValueError as error:
+            self.log_entry(str(error))
+            exit(-1)
+
+        observed = self.engine.observed()
+
+        self.tmp_dict = self.process_intersection(self.intersection_text(0, observed[0]))
 
         self.observed_counts = (
             self.tmp_dict,
-            self.process_intersection(self.results[0][1], linear_start=True)
+            self.process_intersection(self.intersection_text(1, observed[1]), linear_start=True)
         )
-        import pprint
-        pp = pprint.PrettyPrinter(indent=4)
-        pp.pprint(self.observed_counts[0])
-        print("------------")
-        pp.pprint(self.observed_counts[1])
-
-        # how many iterations do we want to do before cleaning up?
-        iterations_per_phase = int(self.cli_params.num_iterations / self.cli_params.num_processes)
-
-        # we probably have some leftover iterations we have to take care of
-        leftover_iterations = (self.cli_params.num_iterations % self.cli_params.num_processes)
-
-        # how many phases do we have?
-        num_phases = self.cli_params.num_processes
-
-        # add one to compensate for remaining permutations
-        if leftover_iterations > 0:
-            num_phases += 1
-
-        # we'll store the final results here
-        self.phase_storage = {}
-
-        # we need some manual garbage collection to keep memory profile lower
-        # import gc
-
-        self.log_entry("Cleaning up... just a second")
-
-        # before starting permutation test, clean up
-        # gc.collect()
-
-        # for each phase we perform iterations_per_phase tests
-        # the remainder is done in an extra run
-        for phase in range(0, num_phases):
 
-            self.log_entry("Starting permutation test phase %d" % (phase+1))
+        self.log_entry("Observed peaks in %d circular RNA and %d linear RNA locations" %
+                       (sum(len(locations) for locations in self.observed_counts[0].values()),
+                        sum(len(locations) for locations in self.observed_counts[1].values())))
 
-            start_id = (phase*iterations_per_phase)+1
-            stop_id = ((phase+1)*iterations_per_phase)+1
+        # the comparisons of the permutation test, as arrays
+        self.permutation_plan = self.compile_permutation_test()
 
-            # compensate for the first round so that we start correctly at ID 0
-            if phase == 0:
-                start_id -= 1
+        # master seed of the shuffling, every iteration derives its own generator from it
+        seed = self.cli_params.seed
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
 
-            # results of one phase of the computation
-            intermediate_result = mp_pool.map(functools.partial(self.run_permutation_test), range(start_id, stop_id))
+        # we only keep the number of iterations each comparison was exceeded in, independent of the number of
+        # iterations: each phase returns its counts which are added up here
+        exceedances = np.zeros(len(self.permutation_plan["targets"]), dtype='int64')
+        completed_iterations = 0
 
-            # how many results did we get back?
-            num_results = len(intermediate_result)
+        checkpoint_file = os.path.join(self.cli_params.output_directory,
+                                       self.cli_params.output_filename + "_checkpoint.json")
+        fingerprint = self.permutation_fingerprint()
 
-            # we now have to convert the temporary dicts into out main dict to save memory
-            for current_num in range(0, num_results):
+        # pick up the iterations of an earlier, interrupted run on the same input
+        checkpoint = self.read_checkpoint(checkpoint_file)
+        if checkpoint and checkpoint["fingerprint"] == fingerprint and \
+                checkpoint["iterations"] <= self.cli_params.num_iterations and \
+                (self.cli_params.seed is None or checkpoint["seed"] == self.cli_params.seed):
+            seed = checkpoint["seed"]
+            completed_iterations = checkpoint["iterations"]
+            exceedances = np.array(checkpoint["exceedances"], dtype='int64')
+            self.log_entry("Resuming from checkpoint %s after %d iterations" % (checkpoint_file, completed_iterations))
 
-                # for each gene per permutation
-                for gene in intermediate_result[current_num]:
+        self.log_entry("Shuffling with seed %d" % seed)
 
-                    # initialize with 2 empty dicts for linear and circular RNA
-                    if gene not in self.phase_storage:
-                        self.phase_storage[gene] = {0: {}, 1: {}}
+        # the remaining iterations in phases of at most checkpoint_iterations, spread over the processes
+        iterations_per_phase = max(1, min(self.cli_params.checkpoint_iterations,
+                                          -(-self.cli_params.num_iterations // self.cli_params.num_processes)))
 
-                    # for both RNA types
-                    for rna in range(0, 2):
-                        if rna in intermediate_result[current_num][gene]:
-                            # get the location
-                            for location_key in self.observed_counts[rna][gene]:
+        phases = [(first, min(first + iterations_per_phase, self.cli_params.num_iterations), seed)
+                  for first in range(completed_iterations, self.cli_params.num_iterations, iterations_per_phase)]
 
-                                if location_key not in self.phase_storage[gene][rna]:
-                                    self.phase_storage[gene][rna][location_key] = 0
-
-                                # only if the temporary data says true (= we saw more peaks than observed)
-                                if location_key in intermediate_result[current_num][gene][rna]:
-                                    self.phase_storage[gene][rna][location_key] += 1
+        self.log_entry("Starting random shuffling of input peaks")
+        try:
+            # phases are returned in order, so the checkpoint always covers the first completed_iterations
+            for (first, last, _), phase_exceedances in zip(phases, mp_pool.imap(self.run_permutation_phase, phases)):
+                exceedances += phase_exceedances
+                completed_iterations = last
+                self.write_checkpoint(checkpoint_file, {"fingerprint": fingerprint,
+                                                        "seed": seed,
+                                                        "iterations": completed_iterations,
+                                                        "exceedances": exceedances.tolist()})
+                self.log_entry("Finished permutation test iterations %d to %d" % (first + 1, last))
+        except ValueError as error:
+            self.log_entry(str(error))
+            exit(-1)
 
-            self.log_entry("Cleaning up... just a second")
+        # we'll store the final results here
+        self.phase_storage = self.exceedance_table(exceedances)
 
         # generate the result table
         result_table = self.print_results()
@@ -311,6 +311,10 @@ class EnrichmentModule(circ_module.circ_template.CircTemplate):
         with open(result_file, 'w') as text_file:
             text_file.write(result_table)
 
+        # the run is complete, nothing to resume anymore
+        if os.path.isfile(checkpoint_file):
+            os.remove(checkpoint_file)
+
         if not self.cli_params.keep_temp:
             self.clean_up_temp_files()
 
@@ -579,56 +583,41 @@ class EnrichmentModule(circ_module.circ_template.CircTemplate):
                 virtual_bed_file = pybedtools.BedTool(bed_content, from_string=True)
                 return virtual_bed_file
 
-    def shuffle_peaks_through_genome(self, iteration, bed_file, genome_file, include):
-        """Gets a (virtual) BED files and shuffle its contents throughout the supplied genome
-        Will only use supplied annotation for features (in our case only transcript regions)
+    def count_layout(self, base_bed):
+        """Prepares the peak counting for a (virtual) BED file of circular or linear RNAs
+        Returns a dict with the intervals to count peaks in, the lines of the intersection output (without the
+        count column), the line each interval count is added to and the count table slot of each line
         """
-        # set temporary directory for pybedtools
-        pybedtools.set_tempdir(self.cli_params.tmp_directory)
-
-        self.log_entry("Processing shuffling thread %d" % (iteration+1))
+        base_lines = permutation.bed_lines(base_bed)
 
-        if include == "all":
-            shuffled_bed = bed_file.shuffle(g=genome_file)
+        if self.virtual_inclusion_file_path != "all":
+            # in feature mode the counts of all features of a circular / linear RNA are added up
+            lines, rows = self.group_features(base_lines)
         else:
-            shuffled_bed = bed_file.shuffle(g=genome_file, incl=include)
+            lines, rows = base_lines, np.arange(len(base_lines))
 
-        return shuffled_bed
+        layout = {"intervals": permutation.Intervals.from_bed("\n".join(base_lines)),
+                  "lines": lines,
+                  "rows": rows}
 
-    def do_intersection(self, query_bed, base_bed):
-        """Gets two bed files (supplied peaks and circle coordinates) and does an intersection
-        """
-        # set temporary directory for pybedtools
-        pybedtools.set_tempdir(self.cli_params.tmp_directory)
-
-        # we employ the c=true parameter to directly get the counts as part of the results
-
-        if self.virtual_inclusion_file_path != "all":
-            # we need to do a second intersect to get the amount of peaks that are located within circular RNAs _AND_
-            # also part of a features: e.g. an exon of a circRNA
+        # the count table with the line numbers as counts tells which line ends up where
+        layout["slots"] = self.process_intersection("".join(line + "\t%d\n" % i for i, line in enumerate(lines)))
 
-            intersect_return = base_bed.intersect(query_bed, c=True, s=True)
-            intersect_return = self.pre_process_intersection(intersect_return)
-        else:
-            intersect_return = base_bed.intersect(query_bed, c=True, s=True)
-
-        return intersect_return
+        return layout
 
-    def pre_process_intersection(self, intersection_input):
-        """Processes intersection output generated by do_intersection() in case of feature-based shuffling
-        Returns a count table for the given intersection
+    def group_features(self, lines):
+        """Groups the lines of a feature-based (virtual) BED file by the circular or linear RNA they are part of
+        Returns the BED lines of the groups (without count) and the group of each line (-1: not counted)
         """
-        # initialise empty dict
-        return_string = ""
-
         # holds the different circRNA isoforms for an annotated host gene
-        # once we see another host gene annotation, all isoforms are written in the bed string
         isoform_net_length = {}
         isoform_num_features = {}
-        isoform_count = {}
         isoform_name = {}
+        isoform_row = {}
 
-        for line in str(intersection_input).splitlines():
+        rows = np.full(len(lines), -1, dtype='int64')
+
+        for line_number, line in enumerate(lines):
             bed_feature = line.split('\t')
 
             # we add up the length of each feature that is part of the "uber" feature, e.g. sum up exon length
@@ -640,38 +629,50 @@ class EnrichmentModule(circ_module.circ_template.CircTemplate):
             if key not in isoform_net_length:
                 isoform_net_length[key] = (int(bed_feature[2]) - int(bed_feature[1]))
                 isoform_num_features[key] = 1
-                isoform_count[key] = int(bed_feature[12])
                 isoform_name[key] = bed_feature[9]
+                isoform_row[key] = len(isoform_row)
+                rows[line_number] = isoform_row[key]
 
             elif bed_feature[1] != bed_feature[7] or bed_feature[2] != bed_feature[8]:
                 isoform_net_length[key] += (int(bed_feature[2]) - int(bed_feature[1]))
                 isoform_num_features[key] += 1
-                isoform_count[key] += int(bed_feature[12])
+                rows[line_number] = isoform_row[key]
+
+        group_lines = []
 
         for feature_key in isoform_net_length:
             data = self.decode_location_key(feature_key)
 
-            new_line = data["chr"] + "\t" \
-                       + str(data["start"]) + "\t" \
-                       + str(data["stop"]) + "\t" \
-                       + str(isoform_name[feature_key]) + "\t" \
-                       + str(isoform_net_length[feature_key]) + "_" + \
-                       str(isoform_num_features[feature_key]) + "\t" + \
-                       data["strand"] + "\t" \
-                       + str(isoform_count[feature_key])
+            group_lines.append(data["chr"] + "\t"
+                               + str(data["start"]) + "\t"
+                               + str(data["stop"]) + "\t"
+                               + str(isoform_name[feature_key]) + "\t"
+                               + str(isoform_net_length[feature_key]) + "_" +
+                               str(isoform_num_features[feature_key]) + "\t" +
+                               data["strand"])
 
-            return_string += new_line + "\n"
+        return group_lines, rows
 
-        # reset stuff
-        isoform_net_length.clear()
-        isoform_num_features.clear()
-        isoform_count.clear()
-        isoform_name.clear()
-
-        return pybedtools.BedTool(return_string, from_string=True)
+    def line_counts(self, rna_type, counts):
+        """Adds up the peak counts of the intervals per line of the intersection output
+        Returns a (iterations x lines) array for a (iterations x intervals) array of peak counts
+        """
+        layout = self.count_layouts[rna_type]
+        counted = layout["rows"] >= 0
+        line_counts = np.zeros((len(layout["lines"]), counts.shape[0]), dtype='int64')
+        np.add.at(line_counts, layout["rows"][counted], counts[:, counted].T)
+        return line_counts.T
+
+    def intersection_text(self, rna_type, counts):
+        """Generates the bedtools intersect -c output for the given peak counts of circular [0] or linear RNAs [1]
+        Returns the output as string, to be processed by process_intersection()
+        """
+        return "".join(line + "\t%d\n" % count
+                       for line, count in zip(self.count_layouts[rna_type]["lines"],
+                                              self.line_counts(rna_type, counts[None])[0].tolist()))
 
     def process_intersection(self, intersection_input, normalize=False, linear_start=False):
-        """Processes intersection output generated by do_intersection()
+        """Processes bedtools intersect -c output as generated by intersection_text()
         Returns a count table for the given intersection
         """
 
@@ -917,20 +918,6 @@ class EnrichmentModule(circ_module.circ_template.CircTemplate):
         # print(self.observed_counts[0])
         # for all genes we have seen
 
-        with open("f11.txt", 'w') as text_file:
-            text_file.write(str(self.observed_counts[0]))
-
-        with open("f22.txt", 'w') as text_file:
-            text_file.write(str(self.observed_counts[1]))
-
-
-        import pprint
-        pp1 = pprint.PrettyPrinter(stream=open("f1.txt",'w'),indent=4)
-        pp2 = pprint.PrettyPrinter(stream=open("f2.txt",'w'),indent=4)
-
-        pp1.pprint(self.observed_counts[0])
-        pp2.pprint(self.observed_counts[1])
-
         for gene in self.observed_counts[1]:
             # make sure we found a circular RNA
             if gene in self.observed_counts[0]:
@@ -1054,50 +1041,34 @@ class EnrichmentModule(circ_module.circ_template.CircTemplate):
         # return the data string
         return result_string
 
-    def run_permutation_test(self, current_iteration):
-        """Computes the probability that a given number of peaks is significantly higher than the simulated random
-        distribution obtained by the random shuffling.
-        Returns a dictionary containing the result for a given iteration
+    def compile_permutation_test(self):
+        """Translates the comparisons of shuffled and observed counts of the permutation test into arrays
+        Each comparison adds up some of the shuffled line counts (with sign) and checks if the sum is higher than
+        a value computed from the observed counts. Count tables are addressed through the count layout slots.
+        Returns a dict with the count table entries tested ("targets": gene, RNA type, location key) and per
+        comparison its target, the indices and signs of the summed line counts and the observed value
         """
-        gene_dict = {}
+        # shuffled line counts are addressed in the line counts of both RNA types, concatenated
+        offsets = [0, len(self.count_layouts[0]["lines"])]
+        slots = [layout["slots"] for layout in self.count_layouts]
 
-        if current_iteration >= self.cli_params.num_iterations:
-            return gene_dict
+        def shuffled(rna_type, gene, location_key):
+            return offsets[rna_type] + slots[rna_type][gene][location_key]
 
-        self.log_entry("Permutation test iteration %d" % (current_iteration+1))
-
-        # we pre-process the first entry of the list because here we stored the observed counts
-        # order of tuples: pos 0: circular rna, pos 1: linear rna
-
-        processed_counts = []
+        # list of (target, [(index, sign)], observed value)
+        comparisons = []
 
         for rna_type in range(0, 2):
-            processed_counts.append(self.process_intersection(self.results[current_iteration][rna_type]))
 
-        for rna_type in range(0, 2):
-
-            for gene, nested_dict in processed_counts[rna_type].items():
+            for gene, nested_dict in slots[rna_type].items():
 
                 # we need to get the observed count for this gene before we start
                 observed_value_dict = self.observed_counts[rna_type][gene]
-                # for each location key (for linear that's only one anyway. for circular it may me multiple)
-                for location_key, shuffled_value in nested_dict.items():
 
-                    # location_data = self.decode_location_key(location_key)
-                    #
-                    #
-                    # length = self.decode_location_key(location_key)["length"]
-                    #
-                    #
-                    # if self.normalize_count(length, shuffled_value) >= \
-                    #         self.normalize_count(length, observed_value_dict[location_key]):
-
-                    # let's test if we observed a higher count in this iteration than web observed experimentally
-                    # first make sure the location exists.. should always be true for linear rna but not for
-                    # circular RNAs
-
-                    # we need the observed counts from the current circle
+                # for each location key (for linear that's only one anyway. for circular it may me multiple)
+                for location_key in nested_dict:
 
+                    # for the linear RNA we subtract the counts of the circRNAs of the same gene
                     if rna_type == 1 and gene in self.observed_counts[0]:
                         for location_key_circular in self.observed_counts[0][gene]:
                             tmp_data = self.decode_location_key(location_key_circular)
@@ -1109,95 +1080,157 @@ class EnrichmentModule(circ_module.circ_template.CircTemplate):
                                                tmp_data["strand"] + "_" + \
                                                str(tmp_data["feature_length"]) + "_" + \
                                                str(tmp_data["feature_count"])
-                            circ_count = 0
 
-                            if location_key_circular in processed_counts[0][gene]:
-                                circ_count = processed_counts[0][gene][location_key_circular]
-                                # for intron mode we have to also subtract / add here
+                            terms = [(shuffled(rna_type, gene, location_key), 1)]
+                            observed_count_correction = 0
 
-                                # we got the first circRNA of the buddy pair, we now need to get the second one
-                                count_correction = 0
-                                observed_count_correction = 0
+                            if location_key_circular in slots[0][gene]:
+                                terms.append((shuffled(0, gene, location_key_circular), -1))
 
+                                # we got the first circRNA of the buddy pair, we now need to get the second one
                                 if location_key_circular in self.circRNA_buddies:
+                                    buddy = self.circRNA_buddies[location_key_circular]
 
-                                    if self.circRNA_buddies[location_key_circular] in processed_counts[0][gene]:
+                                    if buddy in slots[0][gene]:
+                                        terms.append((shuffled(0, gene, buddy), -1))
 
-                                        count_correction = processed_counts[0][gene][self.circRNA_buddies[location_key_circular]]
+                                    if buddy in self.observed_counts[0][gene]:
+                                        observed_count_correction = self.observed_counts[0][gene][buddy]
 
-                                    if self.circRNA_buddies[location_key_circular] in self.observed_counts[0][gene]:
+                            comparisons.append(((gene, rna_type, location_key_new), terms,
+                                                observed_value_dict[location_key_new] - observed_count_correction))
 
-                                        observed_count_correction = self.observed_counts[0][gene][self.circRNA_buddies[location_key_circular]]
+                    else:
+                        # if circ rna get sister rna and get counts for obs and raw
+                        terms = [(shuffled(rna_type, gene, location_key), 1)]
+                        observed_count_correction = 0
 
-                            if shuffled_value-circ_count-count_correction > observed_value_dict[location_key_new] - observed_count_correction:
+                        if location_key in self.circRNA_buddies:
+                            buddy = self.circRNA_buddies[location_key]
+
+                            if buddy in slots[0][gene]:
+                                terms.append((shuffled(0, gene, buddy), 1))
+                                observed_count_correction = self.observed_counts[0][gene][buddy]
+
+                        comparisons.append(((gene, rna_type, location_key), terms,
+                                            observed_value_dict[location_key] + observed_count_correction))
+
+        targets = []
+        target_numbers = {}
+        # unused terms point to a zero count behind the line counts
+        width = max([len(terms) for target, terms, observed in comparisons] + [1])
+        indices = np.full((len(comparisons), width), offsets[1] + len(self.count_layouts[1]["lines"]), dtype='int64')
+        signs = np.zeros((len(comparisons), width), dtype='int64')
+
+        for comparison, (target, terms, observed) in enumerate(comparisons):
+            if target not in target_numbers:
+                target_numbers[target] = len(targets)
+                targets.append(target)
+            for term, (index, sign) in enumerate(terms):
+                indices[comparison, term] = index
+                signs[comparison, term] = sign
+
+        return {"targets": targets,
+                "target": np.array([target_numbers[target] for target, terms, observed in comparisons], dtype='int64'),
+                "indices": indices,
+                "signs": signs,
+                "observed": np.array([observed for target, terms, observed in comparisons], dtype='int64')}
+
+    def count_exceedances(self, counts):
+        """Computes for a batch of iterations how often the shuffled counts were higher than the observed counts
+        Returns an array with the number of exceeding iterations per target of the permutation plan
+        """
+        plan = self.permutation_plan
+        num_iterations = counts[0].shape[0]
 
-                                # Yes, it's higher, so we update the count of "more than observed" for this gene
-                                if gene not in gene_dict:
-                                    # initialize new dict entry
-                                    gene_dict[gene] = {}
+        line_counts = np.concatenate((self.line_counts(0, counts[0]),
+                                      self.line_counts(1, counts[1]),
+                                      np.zeros((num_iterations, 1), dtype='int64')), axis=1)
 
-                                # look if we already have circ/linear rna entries
-                                if rna_type not in gene_dict[gene]:
-                                    # first time we see a higher shuffled value
-                                    gene_dict[gene][rna_type] = {}
+        # comparisons x iterations
+        exceeding = ((line_counts[:, plan["indices"]] * plan["signs"]).sum(axis=2) > plan["observed"]).T
 
-                                if location_key_new not in gene_dict[gene][rna_type]:
-                                    gene_dict[gene][rna_type][location_key_new] = True
+        # a target is exceeded in an iteration if one of its comparisons is
+        hits = np.zeros((len(plan["targets"]), num_iterations), dtype=bool)
+        np.logical_or.at(hits, plan["target"], exceeding)
 
-                    else:
-                        # if circ rna get sister rna and get counts for obs and raw
+        return hits.sum(axis=1)
 
-                        count_correction = 0
-                        observed_count_correction = 0
+    def run_permutation_phase(self, phase):
+        """Runs one phase of the permutation test: shuffles the input peaks in the iterations first to last - 1
+        and compares the counts with the observed counts, batch by batch
+        Returns the number of iterations each target of the permutation plan was exceeded in
+        """
+        first, last, seed = phase
 
-                        if location_key in self.circRNA_buddies:
+        exceedances = np.zeros(len(self.permutation_plan["targets"]), dtype='int64')
 
-                            if self.circRNA_buddies[location_key] in processed_counts[0][gene]:
-                                count_correction = processed_counts[0][gene][self.circRNA_buddies[location_key]]
-                                observed_count_correction = self.observed_counts[0][gene][self.circRNA_buddies[location_key]]
+        # we also hold the summed counts of all comparisons of a batch in memory
+        batch_size = self.engine.batch_size(self.permutation_plan["indices"].size)
 
-                        if shuffled_value + count_correction > observed_value_dict[location_key] + observed_count_correction:
+        for batch in self.engine.permutations(seed, first, last, batch_size):
+            exceedances += self.count_exceedances(batch)
 
-                            # Yes, it's higher, so we update the count of "more than observed" for this gene
-                            if gene not in gene_dict:
-                                # initialize new dict entry
-                                gene_dict[gene] = {}
+        return exceedances
 
-                            # look if we already have circ/linear rna entries
-                            if rna_type not in gene_dict[gene]:
-                                # first time we see a higher shuffled value
-                                gene_dict[gene][rna_type] = {}
+    def permutation_fingerprint(self):
+        """Computes a checksum of the shuffled data and the permutation test comparisons
+        Returns the SHA-1 as hex string, checkpoints are only resumed for the same fingerprint
+        """
+        sha1 = hashlib.sha1()
+        sha1.update(self.engine.fingerprint().encode())
+        sha1.update(repr(self.permutation_plan["targets"]).encode())
+        for key in ["target", "indices", "signs", "observed"]:
+            sha1.update(self.permutation_plan[key].tobytes())
+        return sha1.hexdigest()
 
-                            if location_key not in gene_dict[gene][rna_type]:
-                                gene_dict[gene][rna_type][location_key] = True
+    @staticmethod
+    def read_checkpoint(checkpoint_file):
+        """Reads the state of an interrupted permutation test
+        Returns the checkpoint dict or None if there is no (readable) checkpoint
+        """
+        try:
+            with open(checkpoint_file) as checkpoint:
+                checkpoint = json.load(checkpoint)
+        except (IOError, OSError, ValueError):
+            return None
 
-        return gene_dict
+        if checkpoint.get("version") != CHECKPOINT_VERSION:
+            return None
 
-    def random_sample_step(self, iteration, circ_rna_bed, annotation_bed, shuffled_peaks):
-        """Supervises the intersection of the shuffled peaks of a given iteration
-        with circular and linear RNA annotation
-        Returns a list of bedtools intersection outputs: circular [0] and linear RNA [1] intersection counts
-        """
+        return checkpoint
 
-        if not self.cli_params.whitelist:
-            # get circular and linear intersect
-            circular_intersect = self.do_intersection(shuffled_peaks[iteration], circ_rna_bed)
-            linear_intersect = self.do_intersection(shuffled_peaks[iteration], annotation_bed)
-        else:
-            # get circular and circular intersect for enriched / non enriched exons
+    @staticmethod
+    def write_checkpoint(checkpoint_file, state):
+        """Writes the state of the permutation test via a temporary file, so an interrupted write never
+        replaces the last checkpoint with a partial one
+        """
+        state = dict(state, version=CHECKPOINT_VERSION)
 
-            # the enriched exons
-            circular_intersect = self.do_intersection(shuffled_peaks[iteration], self.whitelist_fg)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(checkpoint_file)), prefix='.tmp_')
+        try:
+            with os.fdopen(fd, 'w') as out:
+                json.dump(state, out)
+            os.replace(tmp, checkpoint_file)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def exceedance_table(self, exceedances):
+        """Converts the exceedance counts of the targets of the permutation plan
+        Returns a dict gene -> RNA type (0: circular, 1: linear) -> location key -> count
+        """
+        phase_storage = {}
 
-            # the "normal" exons are running as linear from here on
-            linear_intersect = self.do_intersection(shuffled_peaks[iteration], circ_rna_bed)
+        for (gene, rna_type, location_key), count in zip(self.permutation_plan["targets"], exceedances.tolist()):
 
-        # process results of the intersects
-        intersects = [circular_intersect, linear_intersect]
+            # initialize with 2 empty dicts for linear and circular RNA
+            if gene not in phase_storage:
+                phase_storage[gene] = {0: {}, 1: {}}
 
-        self.log_entry("Processed intersections for iteration %s" % (iteration+1))
+            phase_storage[gene][rna_type][location_key] = count
 
-        return intersects
+        return phase_storage
 
     def clean_up_temp_files(self):
         """Delete temporary files created by pybedtools
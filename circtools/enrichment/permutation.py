@@ -0,0 +1,238 @@
+# Copyright (C) 2017 Tobias Jakobi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either self.version 3 of the License, or
+# (at your option) any later self.version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# In-process permutation engine of the enrichment module, replacing the bedtools shuffle and
+# intersect -c -s rounds of each iteration.
+#
+# Peaks and the circRNA / host gene intervals are held as NumPy arrays. Every chromosome is given its own
+# range of one linear coordinate axis, and each iteration of a batch its own copy of that axis, so the
+# overlaps of all peaks of a batch are counted with two binary searches per interval and strand.
+#
+# Every iteration shuffles with its own generator derived from the master seed and the iteration number,
+# so the shuffles do not depend on how the iterations are split into phases and batches.
+
+import hashlib
+
+import numpy as np
+
+# maximal number of shuffled peak positions held in memory at once
+BATCH_POSITIONS = 10 ** 7
+
+# bedtools shuffle gives up on a peak after this many placements beyond its chromosome end
+MAX_TRIES = 1000
+
+
+def iteration_seed(seed, iteration):
+    # Seed of one iteration: the iteration-th child of the master seed (as SeedSequence(seed).spawn would give)
+    return np.random.SeedSequence(seed, spawn_key=(iteration,))
+
+
+def bed_lines(bed):
+    # Lines of a (virtual) BED file, without empty and comment lines
+    return [line for line in str(bed).splitlines() if line and not line.startswith("#")]
+
+
+class Intervals(object):
+    def __init__(self, chroms, starts, ends, strands):
+        self.chroms = list(chroms)
+        self.starts = np.asarray(starts, dtype='int64')
+        self.ends = np.asarray(ends, dtype='int64')
+        self.strands = list(strands)
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def from_bed(cls, bed, strand_column=5):
+        """Reads the intervals of a (virtual) BED file
+        Returns an Intervals object, intervals without strand column are unstranded (".")
+        """
+        chroms = []
+        starts = []
+        ends = []
+        strands = []
+        for line in bed_lines(bed):
+            columns = line.split('\t')
+            chroms.append(columns[0])
+            starts.append(int(columns[1]))
+            ends.append(int(columns[2]))
+            strands.append(columns[strand_column].strip() if len(columns) > strand_column else ".")
+        return cls(chroms, starts, ends, strands)
+
+
+def read_genome_file(genome_file):
+    """Reads a bedtools genome file
+    Returns a list of (chromosome, size) tuples in file order
+    """
+    genome = []
+    with open(genome_file) as file_handle:
+        for line in file_handle:
+            columns = line.split()
+            if len(columns) >= 2 and not line.startswith("#"):
+                genome.append((columns[0], int(columns[1])))
+    return genome
+
+
+class PermutationEngine(object):
+    """Shuffles peaks through the genome (or the included regions) and counts the peaks overlapping each
+    interval of a list of base interval sets on the same strand, like bedtools intersect -c -s.
+    @peaks: Intervals of the peaks, each peak keeps its length and strand but may move to another chromosome,
+            as with bedtools shuffle
+    @bases: list of Intervals to count peaks for
+    @genome: list of (chromosome, size) the peaks are shuffled into
+    @include: optional Intervals, peaks are only placed to start within these regions (bedtools shuffle -incl)
+    """
+
+    def __init__(self, peaks, bases, genome, include=None):
+        self.peaks = peaks
+        self.bases = bases
+
+        # linear axis: genome chromosomes first, then those only seen in the peaks or bases; every
+        # chromosome is long enough for all intervals on it
+        lengths = {}
+        for chrom, size in genome:
+            lengths[chrom] = max(lengths.get(chrom, 0), size)
+        for intervals in [peaks] + list(bases):
+            for chrom, end in zip(intervals.chroms, intervals.ends.tolist()):
+                lengths[chrom] = max(lengths.get(chrom, 0), end)
+        self.offsets = {}
+        offset = 0
+        for chrom in lengths:
+            self.offsets[chrom] = offset
+            offset += lengths[chrom] + 1
+        self.axis_length = offset
+
+        self.strand_codes = {}
+        self.peak_lengths = peaks.ends - peaks.starts
+        self.peak_strands = self.encode_strands(peaks.strands)
+        self.observed_starts = self.positions(peaks)
+
+        self.base_starts = [self.positions(intervals) for intervals in bases]
+        self.base_ends = [starts + intervals.ends - intervals.starts
+                          for starts, intervals in zip(self.base_starts, bases)]
+        self.base_strands = [self.encode_strands(intervals.strands) for intervals in bases]
+
+        # regions to draw the peak starts from: whole chromosomes or the included intervals
+        sizes = dict(genome)
+        if include is None:
+            region_chroms = [chrom for chrom in sizes]
+            region_starts = np.zeros(len(region_chroms), dtype='int64')
+            region_ends = np.array([sizes[chrom] for chrom in region_chroms], dtype='int64')
+        else:
+            keep = [i for i, chrom in enumerate(include.chroms) if chrom in sizes]
+            region_chroms = [include.chroms[i] for i in keep]
+            region_starts = np.clip(include.starts[keep], 0, None)
+            region_ends = np.minimum(include.ends[keep], [sizes[chrom] for chrom in region_chroms])
+        usable = region_ends > region_starts
+        self.region_offsets = np.array([self.offsets[chrom] for chrom in region_chroms], dtype='int64')[usable]
+        self.region_starts = region_starts[usable]
+        self.region_sizes = np.array([sizes[chrom] for chrom in region_chroms], dtype='int64')[usable]
+        self.region_cumulative = np.cumsum(region_ends[usable] - region_starts[usable])
+        # first drawn position falling into each region
+        self.region_first = self.region_cumulative - (region_ends[usable] - region_starts[usable])
+
+        if len(self.peaks) and not len(self.region_cumulative):
+            raise ValueError("No genome region to shuffle the peaks into")
+
+    def encode_strands(self, strands):
+        return np.array([self.strand_codes.setdefault(strand, len(self.strand_codes)) for strand in strands],
+                        dtype='int64')
+
+    def positions(self, intervals):
+        return np.array([self.offsets[chrom] for chrom in intervals.chroms], dtype='int64') + intervals.starts
+
+    def shuffle(self, rng, num_iterations):
+        """Draws new positions for all peaks in num_iterations iterations
+        Returns a (num_iterations x peaks) array of peak starts on the linear axis
+        """
+        shape = (num_iterations, len(self.peaks))
+        starts = np.zeros(shape, dtype='int64')
+        pending = np.ones(shape, dtype=bool)
+
+        for _ in range(MAX_TRIES):
+            todo = np.flatnonzero(pending)
+            if not len(todo):
+                return starts
+            # uniform over all bases of the regions, peaks have to end on their chromosome
+            position = rng.integers(0, self.region_cumulative[-1], len(todo))
+            region = np.searchsorted(self.region_cumulative, position, side='right')
+            start = self.region_starts[region] + position - self.region_first[region]
+            fits = start + self.peak_lengths[todo % shape[1]] <= self.region_sizes[region]
+            starts.flat[todo[fits]] = self.region_offsets[region[fits]] + start[fits]
+            pending.flat[todo[fits]] = False
+
+        raise ValueError("Could not place %d peaks within their chromosome" % pending.sum())
+
+    def count(self, starts):
+        """Counts the peaks overlapping each base interval on the same strand for each row of peak starts
+        Returns a list with a (rows x intervals) count array per base interval set
+        """
+        starts = np.atleast_2d(starts)
+        rows = starts.shape[0]
+        # each row gets its own copy of the axis
+        row_offsets = np.arange(rows, dtype='int64')[:, None] * self.axis_length
+        counts = [np.zeros((rows, len(intervals)), dtype='int64') for intervals in self.bases]
+
+        for strand in range(len(self.strand_codes)):
+            peaks = self.peak_strands == strand
+            peak_starts = np.sort((starts[:, peaks] + row_offsets).ravel())
+            peak_ends = np.sort((starts[:, peaks] + self.peak_lengths[peaks] + row_offsets).ravel())
+            for k in range(len(self.bases)):
+                bases = self.base_strands[k] == strand
+                if not bases.any():
+                    continue
+                # peaks starting before the end of the interval, minus those ending before its start
+                counts[k][:, bases] = (
+                    np.searchsorted(peak_starts, self.base_ends[k][bases] + row_offsets, side='left') -
+                    np.searchsorted(peak_ends, self.base_starts[k][bases] + row_offsets, side='right'))
+        return counts
+
+    def observed(self):
+        # Count the input peaks at their own positions
+        return [counts[0] for counts in self.count(self.observed_starts)]
+
+    def shuffle_iterations(self, seed, iterations):
+        """Draws new positions for all peaks in the given iterations, each with its own generator
+        Returns a (iterations x peaks) array of peak starts on the linear axis
+        """
+        starts = np.zeros((len(iterations), len(self.peaks)), dtype='int64')
+        for row, iteration in enumerate(iterations):
+            starts[row] = self.shuffle(np.random.default_rng(iteration_seed(seed, iteration)), 1)[0]
+        return starts
+
+    def fingerprint(self):
+        # SHA-1 of all data the shuffling and counting depend on
+        sha1 = hashlib.sha1()
+        sha1.update(repr((self.offsets, self.strand_codes)).encode())
+        for array in [self.peak_lengths, self.peak_strands, self.observed_starts,
+                      self.region_offsets, self.region_starts, self.region_sizes, self.region_cumulative] + \
+                self.base_starts + self.base_ends + self.base_strands:
+            sha1.update(np.ascontiguousarray(array, dtype='int64').tobytes())
+            sha1.update(b'|')
+        return sha1.hexdigest()
+
+    def batch_size(self, values_per_iteration=0):
+        # number of iterations shuffled and counted at once, with values_per_iteration more values held by the caller
+        return max(1, int(BATCH_POSITIONS / max(len(self.peaks), sum(len(intervals) for intervals in self.bases),
+                                                values_per_iteration, 1)))
+
+    def permutations(self, seed, first, last, batch_size=None):
+        """Shuffles and counts the iterations first to last - 1 of the master seed in batches
+        Yields a list with a (iterations x intervals) count array per base interval set for every batch
+        """
+        if batch_size is None:
+            batch_size = self.batch_size()
+        for batch_first in range(first, last, batch_size):
+            yield self.count(self.shuffle_iterations(seed, range(batch_first, min(batch_first + batch_size, last))))
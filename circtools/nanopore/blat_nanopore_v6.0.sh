@@ -73,38 +73,12 @@ pblat  -threads=$threads -trimT -dots=50000 -mask=lower $fa $sample.fa $sample.p
 echo "Blat done"
 date
 
-# Remove non-standard chromosomes
-cat $sample.psl | grep -v "_random" | grep -v "_hap" | grep -v "chrUn_" > $sample.temp.psl
-rm $sample.psl
-mv $sample.temp.psl $sample.psl
-cat $sample.psl | awk '{print $10}' | sort | uniq -c | sort -nrk 1,1 > mappings_per_read.txt
-cat mappings_per_read.txt | awk '{print $1}' | uniq -c | sort -nrk 1,1 > $sample.histogram_number_of_genomic_hits_per_read.txt
-
-cat $sample.psl | python3 $scriptFolder/psl2bed12.py |  bedtools sort > $sample.psl.bed
-
+# Remove non-standard chromosomes, count the genomic hits per read, classify the read fragments into groups and
+# convert all hits as well as the circRNA and Potential_multi-round_circRNA fragments to sorted bed12, in one pass
 echo
 date
 echo "Getting group numbers"
-cat $sample.psl | python3 $scriptFolder/blat_output_processing_v3.py > $sample.scan.psl
-
-# Read fragment numbers
-echo
-date
-echo "The different groups, numbers of read fragments:"
-cat $sample.scan.psl | awk '{print $NF}' | sort | uniq -c | sort -nrk 1,1 | head -6
-cat $sample.scan.psl | awk '{print $NF}' | sort | uniq -c | sort -nrk 1,1 | head -6 > $sample.scan.groupNumbers.fragments.txt
-# Read numbers
-echo
-echo "The different groups, numbers of unique reads:"
-cat $sample.scan.psl | awk '{print $10,$NF}' | sort | uniq | awk '{print $NF}' | sort | uniq -c | sort -nrk 1,1 | head -6
-cat $sample.scan.psl | awk '{print $10,$NF}' | sort | uniq | awk '{print $NF}' | sort | uniq -c | sort -nrk 1,1 | head -6 > $sample.scan.groupNumbers.reads.txt
-
-
-# Get circRNA reads
-head -5 $sample.scan.psl > $sample.scan.circRNA.psl
-grep circRNA $sample.scan.psl >> $sample.scan.circRNA.psl
-## converting psl to bed12
-cat $sample.scan.circRNA.psl | python3 $scriptFolder/psl2bed12.py |  bedtools sort > $sample.scan.circRNA.psl.bed
+python3 $scriptFolder/psl_processing.py -t $threads $sample
 
 
 
@@ -129,11 +103,6 @@ cat $sample.scan.circRNA.psl | python3 $scriptFolder/psl2bed12.py |  bedtools so
 echo
 date
 echo "outputting Potential_multi-round_circRNA"
-# Get Potential_multi-round_circRNA
-head -5 $sample.scan.psl > $sample.scan.Potential_multi-round_circRNA.psl
-grep Potential_multi-round_circRNA $sample.scan.psl >> $sample.scan.Potential_multi-round_circRNA.psl
-## converting psl to bed12
-cat $sample.scan.Potential_multi-round_circRNA.psl | python3 $scriptFolder/psl2bed12.py |  bedtools sort > $sample.scan.Potential_multi-round_circRNA.psl.bed
 bedtools bedtobam -i $sample.scan.Potential_multi-round_circRNA.psl.bed -bed12 -g $genomeSize > $sample.scan.Potential_multi-round_circRNA.bam
 samtools sort $sample.scan.Potential_multi-round_circRNA.bam > $sample.scan.Potential_multi-round_circRNA.sort.bam
 samtools index $sample.scan.Potential_multi-round_circRNA.sort.bam
@@ -15,15 +15,174 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import argparse
+import heapq
+import itertools
+import multiprocessing
 import sys
+import zlib
+
+# reads classified per shard and batch in sharded mode
+READS_PER_SHARD = 5000
+
+
+class Fragment(object):
+    """One PSL line (hit) of a read, with the columns the classification looks at
+    """
+    __slots__ = ("line", "strand", "name", "read_start", "read_end", "chr", "start", "end")
+
+    def __init__(self, line):
+        self.line = line.strip()
+
+        # Parse the current line
+        fields = self.line.split("\t")
+        (col1, col2, col3, col4, col5, col6, col7, col8, self.strand, self.name,
+         col11, read_start, read_end, self.chr, col15, start, end, *rest) = fields
+
+        self.start, self.end = int(start), int(end)
+        self.read_start, self.read_end = int(read_start), int(read_end)
+
+
+def fragment_type(first, fragment, type_):
+    """Classifies a further fragment of a read against its first fragment
+    Returns the new type, or type_ if the fragment does not decide on one
+    """
+    if first.strand != fragment.strand:
+        type_ = "Not_same_strand"
+    elif fragment.strand == "+":
+        if first.read_end > fragment.read_start and (fragment.read_end - first.read_start) < 50:
+
+            if first.start < fragment.start:
+                type_ = "circRNA"
+            elif first.start > fragment.start:
+                type_ = "linear"
+
+        elif fragment.read_end > first.read_start and (first.read_end - fragment.read_start) < 50:
+
+            if first.start > fragment.start:
+                type_ = "circRNA"
+            elif first.start < fragment.start:
+                type_ = "linear"
+        else:
+            type_ = "ambiguous"
+    elif fragment.strand == "-":
+
+        if first.read_end > fragment.read_start and (fragment.read_end - first.read_start) < 50:
+            if first.start > fragment.start:
+                type_ = "circRNA"
+            elif first.start < fragment.start:
+                type_ = "linear"
+
+        elif fragment.read_end > first.read_start and (first.read_end - fragment.read_start) < 50:
+
+            if first.start < fragment.start:
+                type_ = "circRNA"
+            elif first.start > fragment.start:
+                type_ = "linear"
+
+        else:
+            type_ = "ambiguous"
+
+    return type_
+
+
+def classify_read(fragments):
+    """Classifies the fragments of one read
+    Returns the PSL lines (without line break) with their type appended as last column
+    """
+    first = fragments[0]
+    output = []
+
+    # a read without a further fragment on the same chromosome within a megabase keeps this type
+    type_ = "Potential_multi-round_circRNA"
+    prev_type = None
+
+    for internal_count, fragment in enumerate(fragments[1:], 2):
+        min_start = min(first.start, fragment.start)
+        max_end = max(first.end, fragment.end)
+
+        # Has to be on the same chromosome and within a megabase
+        if first.chr == fragment.chr and max_end - min_start < 1000000:
+            type_ = fragment_type(first, fragment, type_)
+
+            # Print outputs based on fragment counts
+            if internal_count == 2:
+                output.append(f"{first.line}\t{type_}")
+                output.append(f"{fragment.line}\t{type_}")
+                prev_type = type_
+            elif prev_type != "circRNA":
+                output.append(f"{fragment.line}\t{type_}")
+
+    if len(fragments) == 1:
+        output.append(f"{first.line}\tlinear_1_fragment")
+
+    return output
+
+
+def group_reads(lines):
+    """Groups consecutive PSL lines (without header) of the same read
+    Yields the lists of lines of the reads
+    """
+    for name, read_lines in itertools.groupby(lines, key=lambda line: line.split("\t", 10)[9]):
+        yield list(read_lines)
+
+
+def classify_shard(shard):
+    # Classifies the reads of a shard, given as (read number, lines) tuples
+    return [(number, classify_read([Fragment(line) for line in read_lines])) for number, read_lines in shard]
+
+
+def shard_batches(lines, shards):
+    """Partitions the reads into shards by the hash of their name, batch by batch
+    Yields a list of shards of (read number, lines) tuples per batch
+    """
+    numbered_reads = enumerate(group_reads(lines))
+
+    while True:
+        batch = list(itertools.islice(numbered_reads, shards * READS_PER_SHARD))
+        if not batch:
+            return
+
+        sharded = [[] for _ in range(shards)]
+        for number, read_lines in batch:
+            sharded[zlib.crc32(read_lines[0].split("\t", 10)[9].encode()) % shards].append((number, read_lines))
+
+        yield sharded
+
+
+def classify_fragments(lines, processes=1):
+    """Classifies the fragments (PSL lines without header) of each read, fragments of a read are consecutive.
+    With more than one process, the reads are classified in shards by a process pool.
+    Yields the PSL lines (without line break) with their type appended as last column, in input order
+    """
+    if processes <= 1:
+        for read_lines in group_reads(lines):
+            yield from classify_read([Fragment(line) for line in read_lines])
+        return
+
+    with multiprocessing.Pool(processes) as pool:
+
+        # the next batch is read and sharded while the shards of the current one are classified
+        pending = None
+
+        for sharded in itertools.chain(shard_batches(lines, processes), [None]):
+            submitted = pool.map_async(classify_shard, sharded) if sharded is not None else None
+
+            if pending is not None:
+                # the reads of all shards back in input order
+                for number, output in heapq.merge(*pending.get(), key=lambda read: read[0]):
+                    yield from output
+
+            pending = submitted
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Classifies the read fragments of a PSL file read from stdin")
+    parser.add_argument("-t", "--threads", dest="threads", type=int, default=1,
+                        help="Number of processes classifying the reads [default: 1]")
+    args = parser.parse_args()
+
     count = 0
-    internal_count = 0
-    prev_type = None
-    first_line = ""
-    first_name = "NONAME"  # Default name
 
     for line in sys.stdin:
         count += 1
@@ -31,89 +190,13 @@ def main():
         # First 5 lines in PSL format are headers, print them directly
         if count <= 5:
             print(line, end="")
-            continue
-
-        line = line.strip()
-
-        # Parse the current line
-        fields = line.split("\t")
-        (col1, col2, col3, col4, col5, col6, col7, col8, strand, name,
-         col11, read_start, read_end, chr_, col15, start, end, *rest) = fields
-
-        start, end = int(start), int(end)
-        read_start, read_end = int(read_start), int(read_end)
-
-        internal_count += 1
-
-        # Process fragments from the same read
-        if name == first_name:
-            min_start = min(first_start, start)
-            max_end = max(first_end, end)
-            abs_distance = max_end - min_start
-
-            # Has to be on the same chromosome and within a megabase
-            if first_chr == chr_ and abs_distance < 1000000:
-                if internal_count > 1:
-                    if first_strand != strand:
-                        type_ = "Not_same_strand"
-                    elif strand == "+":
-                        if first_read_end > read_start and (read_end - first_read_start) < 50:
-
-                            if first_start < start:
-                                type_ = "circRNA"
-                            elif first_start > start:
-                                type_ =  "linear"
-
-                        elif read_end > first_read_start and (first_read_end - read_start) < 50:
-
-                            if first_start > start:
-                                type_ = "circRNA"
-                            elif first_start < start:
-                                type_ =  "linear"
-                        else:
-                            type_ = "ambiguous"
-                    elif strand == "-":
-                        end_to_start = abs(first_read_end - read_start)
-                        start_to_end = abs(first_read_start - read_end)
-
-                        if first_read_end > read_start and (read_end - first_read_start) < 50:
-                            if first_start > start:
-                                type_ = "circRNA"
-                            elif first_start < start:
-                                type_ =  "linear"
-
-                        elif read_end > first_read_start and (first_read_end - read_start) < 50:
-
-                            if first_start < start:
-                                type_ = "circRNA"
-                            elif first_start > start:
-                                type_ =  "linear"
-
-                        else:
-                            type_ = "ambiguous"
-
-                    # Print outputs based on fragment counts
-                    if internal_count == 2:
-                        print(f"{first_line}\t{type_}")
-                        print(f"{line}\t{type_}")
-                        prev_type = type_
-                    elif internal_count > 2 and prev_type != "circRNA":
-                        print(f"{line}\t{type_}")
         else:
-            if count > 6:
-                if internal_count == 2:
-                    type_ = "linear_1_fragment"
-                    print(f"{first_line}\t{type_}")
-
-            # Start reading a new fragment
-            first_line = line
-            first_strand = strand
-            first_name = name
-            first_read_start, first_read_end = read_start, read_end
-            first_chr = chr_
-            first_start, first_end = start, end
-            internal_count = 1
-            type_ = "Potential_multi-round_circRNA"
+            break
+    else:
+        return
+
+    for fragment in classify_fragments(itertools.chain([line], sys.stdin), args.threads):
+        print(fragment)
 
 
 if __name__ == "__main__":
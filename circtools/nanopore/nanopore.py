@@ -19,12 +19,18 @@ import re
 from pathlib import Path
 import subprocess
 
+import concurrent.futures
+import contextlib
 import csv
 import gzip
+import hashlib
+import heapq
+import json
 import os
 import sys
+import tempfile
+import zlib
 
-import pybedtools
 import requests
 from tqdm import tqdm
 
@@ -74,10 +80,124 @@ def get_id_from_column_9(input_string: str, entity: str):
         return None
 
 
+# BED lines per in-memory chunk of the external sort
+SORT_CHUNK_LINES = 1000000
+
+# bedtools merge operations on the values of a column of the merged intervals
+MERGE_OPERATIONS = {
+    "collapse": lambda values: ",".join(values),
+    "count": lambda values: str(len(values)),
+    "distinct": lambda values: ",".join(sorted(set(values))),
+    "count_distinct": lambda values: str(len(set(values)))
+}
+
+
+def bed_sort_key(line):
+    columns = line.split("\t", 2)
+    return columns[0], int(columns[1])
+
+
+class BedSorter(object):
+    """Sorts BED lines by chromosome and start like bedtools sort (ties keep their input order).
+    Lines are collected in chunks, full chunks are sorted and written to temporary files in temp_dir
+    and merged at the end, so only one chunk is held in memory.
+    """
+    def __init__(self, temp_dir):
+        self.temp_dir = temp_dir
+        self.chunk = []
+        self.chunk_files = []
+
+    def add(self, line):
+        self.chunk.append(line)
+
+        if len(self.chunk) >= SORT_CHUNK_LINES:
+            self.chunk.sort(key=bed_sort_key)
+
+            chunk_file = os.path.join(self.temp_dir, "chunk_%d.bed" % len(self.chunk_files))
+            with open(chunk_file, "w") as file:
+                file.writelines(self.chunk)
+
+            self.chunk_files.append(chunk_file)
+            self.chunk = []
+
+    def sorted(self):
+        # Yields the sorted lines, chunks are merged in input order so ties stay in input order
+        self.chunk.sort(key=bed_sort_key)
+
+        chunk_handles = [open(chunk_file) for chunk_file in self.chunk_files]
+        try:
+            yield from heapq.merge(*chunk_handles, self.chunk, key=bed_sort_key)
+        finally:
+            for chunk_handle in chunk_handles:
+                chunk_handle.close()
+
+
+def merge_bed(sorted_lines, columns, operations):
+    """Merges overlapping and book-ended intervals on the same strand like bedtools merge -s
+    Input lines have to be sorted by chromosome and start.
+    @columns, operations: like -c and -o of bedtools merge, one output column per pair
+    Yields the merged intervals as BED lines, sorted by chromosome and start
+    """
+    # strand -> [chromosome, start, end, values of each column]
+    open_intervals = {}
+
+    # merged intervals not yet written, (start, strand, line) heap
+    closed_intervals = []
+
+    def close(strand):
+        chromosome, start, end, values = open_intervals.pop(strand)
+        line = "\t".join([chromosome, str(start), str(end)] +
+                         [MERGE_OPERATIONS[operation](column_values)
+                          for operation, column_values in zip(operations, values)]) + "\n"
+        heapq.heappush(closed_intervals, (start, strand, line))
+
+    for line in sorted_lines:
+        fields = line.rstrip("\n").split("\t")
+        chromosome, start, end, strand = fields[0], int(fields[1]), int(fields[2]), fields[5]
+
+        # a new chromosome closes everything
+        if open_intervals and next(iter(open_intervals.values()))[0] != chromosome:
+            for open_strand in list(open_intervals):
+                close(open_strand)
+
+            while closed_intervals:
+                yield heapq.heappop(closed_intervals)[2]
+
+        if strand in open_intervals and start > open_intervals[strand][2]:
+            close(strand)
+
+        if strand in open_intervals:
+            interval = open_intervals[strand]
+            interval[2] = max(interval[2], end)
+        else:
+            interval = open_intervals[strand] = [chromosome, start, end, [[] for _ in columns]]
+
+        for column_values, column in zip(interval[3], columns):
+            column_values.append(fields[column - 1])
+
+        # merged intervals starting before all open ones are final
+        first_open = min([open_interval[1] for open_interval in open_intervals.values()])
+        while closed_intervals and closed_intervals[0][0] < first_open:
+            yield heapq.heappop(closed_intervals)[2]
+
+    for open_strand in list(open_intervals):
+        close(open_strand)
+
+    while closed_intervals:
+        yield heapq.heappop(closed_intervals)[2]
+
+
+def write_through(lines, file):
+    # Writes the lines to file while passing them on
+    for line in lines:
+        file.write(line)
+        yield line
+
+
 def read_annotation_file(annotation_file, entity="exon"):
     """Reads a GTF file
     Will halt the program if file not accessible
-    Returns a BedTool object only containing gene sections
+    Yields BED lines of the entity (exon) sections
     """
     """
     Reads a GTF file and outputs exons output used for the main script
@@ -99,11 +219,11 @@ def read_annotation_file(annotation_file, entity="exon"):
         sys.exit(message)
     else:
 
+        found_entries = False
+
         with file_handle:
-            line_iterator = iter(file_handle)
-            bed_content = ""
             print("Start parsing GTF file")
-            for line in line_iterator:
+            for line in file_handle:
                 # we skip any comment lines
                 if line.startswith("#"):
                     continue
@@ -129,16 +249,12 @@ def read_annotation_file(annotation_file, entity="exon"):
                     get_id_from_column_9(columns[8], "gene_id")
                 ]
 
-                # concatenate lines to one string
-                bed_content += '\t'.join(entry) + "\n"
-
-        if not bed_content:
-            exit(-1)
+                found_entries = True
 
-        # create a "virtual" BED file
-        virtual_bed_file = pybedtools.BedTool(bed_content, from_string=True)
+                yield '\t'.join(entry) + "\n"
 
-        return virtual_bed_file.sort()
+        if not found_entries:
+            exit(-1)
 
 
 def postprocess_ref_flat(refflat_csv: str):
@@ -159,69 +275,54 @@ def postprocess_ref_flat(refflat_csv: str):
         file_path (str): Path to the input file.
         :param refflat_csv:
     """
-    output_exons = ""
-    output_genes = ""
-
     print("Creating refFlat-based exon files")
     try:
-        with gzip.open(refflat_csv, mode='rt') as gz_file:
-            csv_reader = csv.reader(gz_file, delimiter='\t')
-            next(csv_reader, None)
-
-            for row_number, row in enumerate(csv_reader, start=1):
-                geneName, name, chrom, strand, txStart, txEnd, cdsStart, cdsEnd, exonCount, exonStarts, exonEnds = row
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(refflat_csv))) as temp_dir:
 
-                starts = exonStarts.split(',')
-                stops = exonEnds.split(',')
+            output_exons = BedSorter(temp_dir)
+            output_genes = BedSorter(temp_dir)
 
-                output_genes += "\t".join(
-                    [chrom, txStart, txEnd, geneName, str(0),
-                     strand]) + "\n"
+            with gzip.open(refflat_csv, mode='rt') as gz_file:
+                csv_reader = csv.reader(gz_file, delimiter='\t')
+                next(csv_reader, None)
 
-                for exon_num in range(int(exonCount) - 1):
-                    strand_tag = "f" if strand == "+" else "r"
+                for row_number, row in enumerate(csv_reader, start=1):
+                    geneName, name, chrom, strand, txStart, txEnd, cdsStart, cdsEnd, exonCount, exonStarts, exonEnds = row
 
-                    name_tag = "_".join(
-                        [geneName, "exon", str(exon_num), str(0), chrom,
-                         str(int(starts[exon_num]) + 1), strand_tag])
+                    starts = exonStarts.split(',')
+                    stops = exonEnds.split(',')
 
-                    output_genes += "\t".join(
-                        [chrom, starts[exon_num], stops[exon_num], geneName,
-                         str(0), strand]) + "\n"
-                    output_exons += "\t".join(
-                        [chrom, starts[exon_num], stops[exon_num], name_tag,
-                         str(0), strand]) + "\n"
+                    output_genes.add("\t".join(
+                        [chrom, txStart, txEnd, geneName, str(0),
+                         strand]) + "\n")
 
-        virtual_bed_file = pybedtools.BedTool(output_exons,
-                                              from_string=True)
+                    for exon_num in range(int(exonCount) - 1):
+                        strand_tag = "f" if strand == "+" else "r"
 
-        virtual_bed_file_genes = pybedtools.BedTool(output_genes,
-                                                    from_string=True).sort()
+                        name_tag = "_".join(
+                            [geneName, "exon", str(exon_num), str(0), chrom,
+                             str(int(starts[exon_num]) + 1), strand_tag])
 
-        # the unique gene level file is different in regard to printing out all genes with comma instead of just choosing one
-        # and omit the other co-optimal hits
+                        output_genes.add("\t".join(
+                            [chrom, starts[exon_num], stops[exon_num], geneName,
+                             str(0), strand]) + "\n")
+                        output_exons.add("\t".join(
+                            [chrom, starts[exon_num], stops[exon_num], name_tag,
+                             str(0), strand]) + "\n")
 
-        virtual_bed_file_genes = virtual_bed_file_genes.merge(s=True,
-                                                              o=["distinct",
-                                                                 "count_distinct",
-                                                                 "distinct"],
-                                                              c=[4, 4, 6])
+            file_base = refflat_csv.replace(".gz", "")
 
-        virtual_bed_file_sorted = virtual_bed_file.sort()
+            # the unique gene level file is different in regard to printing out all genes with comma instead of just choosing one
+            # and omit the other co-optimal hits
 
-        virtual_bed_file_merged = virtual_bed_file_sorted.merge(s=True, o=[
-            "collapse", "count", "distinct"], c=[4, 4, 6])
+            with open(file_base + ".unique.bed", "w") as file:
+                file.writelines(merge_bed(output_genes.sorted(), [4, 4, 6],
+                                          ["distinct", "count_distinct", "distinct"]))
 
-        file_base = refflat_csv.replace(".gz", "")
-
-        with open(file_base + ".sort.bed", "w") as file:
-            file.write(str(virtual_bed_file_sorted))
-
-        with open(file_base + ".unique.bed", "w") as file:
-            file.write(str(virtual_bed_file_genes))
-
-        with open(file_base + ".merged.bed", "w") as file:
-            file.write(str(virtual_bed_file_merged))
+            with open(file_base + ".sort.bed", "w") as file, \
+                    open(file_base + ".merged.bed", "w") as merged_file:
+                merged_file.writelines(merge_bed(write_through(output_exons.sorted(), file), [4, 4, 6],
+                                                 ["collapse", "count", "distinct"]))
 
     except FileNotFoundError:
         print(f"Error: File '{refflat_csv}' not found.")
@@ -232,21 +333,184 @@ def postprocess_ref_flat(refflat_csv: str):
 def postprocess_gencode(gencode_file: str):
     print("Creating GENCODE-based exon files")
 
-    bed_file = read_annotation_file(gencode_file)
-
     file_base = gencode_file.replace(".gtf", "")
 
-    with open(file_base + ".exon.bed", "w") as file:
-        file.write(str(bed_file))
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(gencode_file))) as temp_dir:
+
+        bed_file = BedSorter(temp_dir)
+
+        for line in read_annotation_file(gencode_file):
+            bed_file.add(line)
+
+        with open(file_base + ".exon.bed", "w") as file, \
+                open(file_base + ".exon.merge.bed", "w") as merged_file:
+            merged_file.writelines(merge_bed(write_through(bed_file.sorted(), file), [4, 4, 6],
+                                             ["collapse", "count", "distinct"]))
+
+
+# reference files downloaded at the same time
+DOWNLOAD_THREADS = 4
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# checksums of the reference files in the reference data folder
+MANIFEST = "manifest.json"
+
+# files derived from a reference file, by postprocess type: extension removed from the file name, added extensions
+POSTPROCESS_OUTPUTS = {
+    "refFlat": (".gz", [".sort.bed", ".unique.bed", ".merged.bed"]),
+    "gencode": (".gtf", [".exon.bed", ".exon.merge.bed"])
+}
+
+
+class GunzipStream(object):
+    # Incremental decompression of (multi member) gzip data, like gzip -d
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+
+    def decompress(self, data):
+        output = []
+        while data:
+            output.append(self.decompressor.decompress(data))
+            if not self.decompressor.eof:
+                break
+            # the next member starts after the end of this one
+            data = self.decompressor.unused_data
+            self.decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        return b"".join(output)
+
+    def finish(self):
+        output = self.decompressor.flush()
+        if not self.decompressor.eof and (output or self.decompressor.unconsumed_tail):
+            raise IOError("Incomplete gzip data")
+        return output
+
+
+def file_sha256(file_name):
+    sha256 = hashlib.sha256()
+    with open(file_name, 'rb') as file:
+        for block in iter(lambda: file.read(DOWNLOAD_CHUNK_SIZE), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def file_fingerprint(file_name):
+    stat = os.stat(file_name)
+    return [stat.st_size, stat.st_mtime_ns]
+
 
-    virtual_bed_file_merged = bed_file.merge(s=True,
-                                             o=["collapse",
-                                                "count",
-                                                "distinct"],
-                                             c=[4, 4, 6])
+def read_manifest(data_path):
+    try:
+        with open(os.path.join(data_path, MANIFEST), 'r') as manifest:
+            return json.load(manifest)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def write_manifest(data_path, manifest):
+    # Written via a temporary file, so an interrupted run never leaves a partial manifest
+    fd, tmp = tempfile.mkstemp(dir=data_path, prefix='.tmp_')
+    try:
+        with os.fdopen(fd, 'w') as out:
+            json.dump(manifest, out, indent=1)
+        os.replace(tmp, os.path.join(data_path, MANIFEST))
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def current_entry(entry, url: str, file_name: str):
+    """Checks if file_name is the complete download of url, as recorded in its manifest entry.
+    The checksum is only computed again if size or modification time of the file changed.
+    Returns the (updated) manifest entry, or None if the file has to be downloaded
+    """
+    if not os.path.exists(file_name):
+        return None
+
+    fingerprint = file_fingerprint(file_name)
+
+    # files downloaded before the manifest existed are taken as they are
+    if entry is None:
+        return {"url": url, "sha256": file_sha256(file_name), "fingerprint": fingerprint}
+
+    if entry['url'] != url:
+        return None
+
+    if entry['fingerprint'] == fingerprint:
+        return entry
+
+    if entry['sha256'] == file_sha256(file_name):
+        return dict(entry, fingerprint=fingerprint)
+
+    return None
+
+
+def postprocess_outputs(postprocess: str, file_name: str):
+    extension, output_extensions = POSTPROCESS_OUTPUTS[postprocess]
+    return [file_name.replace(extension, "") + output_extension for output_extension in output_extensions]
+
+
+def download_file(url: str, file_name: str, target_file: str, unpack: bool, position=0):
+    """Downloads url to target_file, decompressed while downloading if unpack is set.
+    The download is kept in file_name.part until it is complete. An interrupted download is resumed from there
+    with an HTTP range request (or restarted if the server does not support them).
+    Returns the SHA-256 checksum of target_file
+    """
+    part_file = file_name + ".part"
+    offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+
+    headers = {"Range": "bytes=%d-" % offset} if offset else {}
+
+    with requests.get(url, stream=True, headers=headers, timeout=60) as r:
+
+        # the part is already complete (or longer than the file now is), start over
+        if offset and r.status_code == 416:
+            os.remove(part_file)
+            return download_file(url, file_name, target_file, unpack, position)
+
+        r.raise_for_status()
+
+        if r.status_code != 206:
+            offset = 0
+
+        total_size = offset + int(r.headers.get('content-length', 0))
+
+        sha256 = hashlib.sha256()
+        gunzip = GunzipStream() if unpack else None
+
+        with open(part_file, 'r+b' if offset else 'w+b') as f, \
+                open(target_file + ".part", 'wb') if unpack else contextlib.nullcontext() as target, \
+                tqdm(total=total_size, initial=offset, unit='B', unit_scale=True, position=position,
+                     desc="Downloading " + os.path.basename(file_name)) as pbar:
+
+            def store(data):
+                if unpack:
+                    data = gunzip.decompress(data)
+                    target.write(data)
+                sha256.update(data)
+
+            # the decompressed file and the checksum start from the already downloaded part
+            for block in iter(lambda: f.read(min(DOWNLOAD_CHUNK_SIZE, offset - f.tell())), b''):
+                store(block)
+            f.truncate(offset)
+
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                store(chunk)
+                pbar.update(len(chunk))
 
-    with open(file_base + ".exon.merge.bed", "w") as file:
-        file.write(str(virtual_bed_file_merged))
+            if unpack:
+                data = gunzip.finish()
+                target.write(data)
+                sha256.update(data)
+
+    if unpack:
+        os.replace(target_file + ".part", target_file)
+        os.remove(part_file)
+    else:
+        os.replace(part_file, target_file)
+
+    return sha256.hexdigest()
 
 
 def process_data(configuration: str, data_path: str):
@@ -267,59 +531,97 @@ def process_data(configuration: str, data_path: str):
             if not os.path.exists(full_data_path):
                 os.makedirs(full_data_path)
 
+            manifest = read_manifest(full_data_path)
+
+            downloads = {}
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=DOWNLOAD_THREADS) as executor:
+
+                for item in config:
+
+                    if 'url' in config[item]:
+
+                        url = config[item]['url']
+                        file_name = os.path.join(full_data_path,
+                                                 config[item]['name'])
+
+                        file_type = config[item]['type']
+
+                        file_name_unzipped = file_name.replace("." + file_type,
+                                                               "")
+
+                        entry = current_entry(manifest.get(config[item]['name']), url, file_name_unzipped)
+
+                        if entry is not None:
+
+                            # files from before the manifest: their derived files are taken as they are, too
+                            if config[item]['name'] not in manifest and 'postprocess' in config[item] and \
+                                    all(map(os.path.exists, postprocess_outputs(config[item]['postprocess'],
+                                                                                file_name_unzipped))):
+                                entry['postprocessed'] = entry['sha256']
+
+                            if entry != manifest.get(config[item]['name']):
+                                manifest[config[item]['name']] = entry
+                                write_manifest(full_data_path, manifest)
+
+                            print("Skipping, " + config[item]['name'] +
+                                  ", file already exists.")
+                            continue
+
+                        downloads[executor.submit(download_file, url, file_name, file_name_unzipped,
+                                                  file_type == 'gz', len(downloads))] = item
+
+                failed = False
+
+                for download in concurrent.futures.as_completed(downloads):
+                    item = downloads[download]
+                    file_name_unzipped = os.path.join(full_data_path, config[item]['name']).replace(
+                        "." + config[item]['type'], "")
+
+                    try:
+                        sha256 = download.result()
+                    except (requests.RequestException, IOError, zlib.error) as error:
+                        print("Error downloading {}: {}".format(config[item]['name'], error))
+                        failed = True
+                        continue
+
+                    manifest[config[item]['name']] = {"url": config[item]['url'],
+                                                      "sha256": sha256,
+                                                      "fingerprint": file_fingerprint(file_name_unzipped)}
+                    write_manifest(full_data_path, manifest)
+
+            # derived files are only created again if they are missing or the reference file changed
             for item in config:
 
-                if 'url' in config[item]:
-
-                    url = config[item]['url']
-                    file_name = os.path.join(full_data_path,
-                                             config[item]['name'])
-
-                    file_type = config[item]['type']
-
-                    file_name_unzipped = file_name.replace("." + file_type,
-                                                           "")
-
-                    if not os.path.exists(file_name_unzipped):
-
-                        with requests.get(url, stream=True) as r:
-                            r.raise_for_status()
-                            total_size = int(
-                                r.headers.get('content-length', 0))
-
-                            with open(file_name, 'wb') as f:
-                                with tqdm(total=total_size, unit='B',
-                                          unit_scale=True,
-                                          desc="Downloading " +
-                                               config[item][
-                                                   'name']) as pbar:
-                                    for chunk in r.iter_content(
-                                            chunk_size=8192):
-                                        f.write(chunk)
-                                        pbar.update(len(chunk))
-
-                        # most files need to be unpacked
-                        if file_type == 'gz':
-                            print("Unpacking.")
-                            os.system("gzip -d " + file_name)
-                            print("Done.")
-
-                        # work on the gencode file
-                        if 'postprocess' in config[item] and \
-                                config[item]['postprocess'] == 'gencode':
-                            postprocess_gencode(
-                                gencode_file=file_name_unzipped)
-
-                        # work with the refFlat file
-                        if 'postprocess' in config[item] and \
-                                config[item]['postprocess'] == 'refFlat':
-                            postprocess_ref_flat(
-                                refflat_csv=file_name_unzipped)
-
-                    # file already exists
-                    else:
-                        print("Skipping, " + config[item]['name'] +
-                              ", file already exists.")
+                if 'url' in config[item] and 'postprocess' in config[item] and config[item]['name'] in manifest:
+
+                    entry = manifest[config[item]['name']]
+                    file_name_unzipped = os.path.join(full_data_path, config[item]['name']).replace(
+                        "." + config[item]['type'], "")
+                    outputs = postprocess_outputs(config[item]['postprocess'], file_name_unzipped)
+
+                    if entry.get('postprocessed') == entry['sha256'] and all(map(os.path.exists, outputs)):
+                        continue
+
+                    # work on the gencode file
+                    if config[item]['postprocess'] == 'gencode':
+                        postprocess_gencode(
+                            gencode_file=file_name_unzipped)
+
+                    # work with the refFlat file
+                    if config[item]['postprocess'] == 'refFlat':
+                        postprocess_ref_flat(
+                            refflat_csv=file_name_unzipped)
+
+                    if all(map(os.path.exists, outputs)):
+                        entry['postprocessed'] = entry['sha256']
+                        write_manifest(full_data_path, manifest)
+
+            if failed:
+                print("Not all reference files could be downloaded, "
+                      "run the download again to resume the missing ones.")
+                exit(-1)
+
 
 class Nanopore(circ_module.circ_template.CircTemplate):
     def __init__(self, argparse_arguments, program_name, version):
@@ -17,6 +17,32 @@
 
 import sys
 
+
+def psl_to_bed12(cols):
+    """Converts the columns of a PSL line into a BED12 line (without line break)
+    """
+    # Extract relevant columns
+    col1 = cols[0]
+    col9 = cols[8]
+    col10 = cols[9]
+    col14 = cols[13]
+    col16 = int(cols[15])
+    col17 = int(cols[16])
+    col18 = cols[17]
+    col19 = cols[18]
+    col21 = cols[20]
+
+    # Parse blockStarts and adjust them relative to col16
+    block_starts = [int(x) - col16 for x in col21.split(",") if x]
+
+    # Generate required values
+    rgb = "0,0,0"
+    name = f"{col10}~{col14}:{col16}-{col17}"
+
+    return f"{col14}\t{col16}\t{col17}\t{name}\t{col1}\t{col9}\t{col16}\t{col17}\t{rgb}\t{col18}\t{col19}\t" + \
+        ",".join(map(str, block_starts)) + ","
+
+
 def main():
     count = 0
 
@@ -26,30 +52,8 @@ def main():
 
         # Skip the first 5 lines (header in PSL format)
         if count > 5:
-            # Split the line into columns
-            cols = line.split("\t")
-
-            # Extract relevant columns
-            col1 = cols[0]
-            col9 = cols[8]
-            col10 = cols[9]
-            col14 = cols[13]
-            col16 = int(cols[15])
-            col17 = int(cols[16])
-            col18 = cols[17]
-            col19 = cols[18]
-            col21 = cols[20]
-
-            # Parse blockStarts and adjust them relative to col16
-            block_starts = [int(x) - col16 for x in col21.split(",") if x]
-
-            # Generate required values
-            rgb = "0,0,0"
-            name = f"{col10}~{col14}:{col16}-{col17}"
-
-            # Print the output in the desired format
-            print(f"{col14}\t{col16}\t{col17}\t{name}\t{col1}\t{col9}\t{col16}\t{col17}\t{rgb}\t{col18}\t{col19}\t", end="")
-            print(",".join(map(str, block_starts)) + ",")
+            # Split the line into columns and print the output in the desired format
+            print(psl_to_bed12(line.split("\t")))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+# Copyright (C) 2024 Tobias Jakobi
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either self.version 3 of the License, or
+# (at your option) any later self.version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Processing of the pblat output of a nanopore sample in a single pass over the PSL file, replacing the
+# grep / awk | sort | uniq -c / psl2bed12.py / blat_output_processing_v3.py / bedtools sort chain of
+# blat_nanopore_v6.0.sh. Writes (with <sample> as prefix, in the current directory):
+#
+#   <sample>.psl                                          PSL without hits on non-standard chromosomes
+#   mappings_per_read.txt                                 genomic hits per read
+#   <sample>.histogram_number_of_genomic_hits_per_read.txt
+#   <sample>.psl.bed                                      all hits as sorted BED12
+#   <sample>.scan.psl                                     classified read fragments
+#   <sample>.scan.groupNumbers.fragments.txt              fragments per group
+#   <sample>.scan.groupNumbers.reads.txt                  reads per group
+#   <sample>.scan.circRNA.psl(.bed)                       circRNA fragments
+#   <sample>.scan.Potential_multi-round_circRNA.psl(.bed) multi-round circRNA fragments
+
+import argparse
+import itertools
+import os
+import sys
+
+from circtools.nanopore.blat_output_processing_v3 import classify_fragments
+from circtools.nanopore.psl2bed12 import psl_to_bed12
+
+# number of header lines of a PSL file
+PSL_HEADER_LINES = 5
+
+# hits on chromosomes containing one of these are removed
+NON_STANDARD_CHROMOSOMES = ("_random", "_hap", "chrUn_")
+
+# fragment groups written to their own PSL / BED12 files
+FRAGMENT_GROUPS = ("circRNA", "Potential_multi-round_circRNA")
+
+
+def is_standard(line):
+    # Same test as grep -v on the whole line
+    return not any(pattern in line for pattern in NON_STANDARD_CHROMOSOMES)
+
+
+def sort_bed(entries):
+    """Sorts (chromosome, start, line) tuples by chromosome and start as bedtools sort does
+    Returns the sorted lines
+    """
+    return [line for chromosome, start, line in sorted(entries, key=lambda entry: (entry[0], entry[1]))]
+
+
+def bed_entry(cols):
+    return cols[13], int(cols[15]), psl_to_bed12(cols)
+
+
+def uniq_counts(counts):
+    """Formats counts like uniq -c | sort -nrk 1,1 (ties in reverse order of the value)
+    Returns a list of lines
+    """
+    return ["%7d %s" % (count, value) for value, count in
+            sorted(counts.items(), key=lambda item: (item[1], item[0]), reverse=True)]
+
+
+def write_lines(file_name, lines):
+    with open(file_name, 'w') as out:
+        for line in lines:
+            out.write(line + "\n")
+
+
+class PslProcessing(object):
+    def __init__(self, sample, threads=1):
+
+        self.sample = sample
+        self.threads = threads
+        self.header = []
+
+        # hits per read
+        self.mappings = {}
+
+        # (chromosome, start, BED12 line) of all hits and of the fragments of each group
+        self.bed = []
+        self.group_bed = {group: [] for group in FRAGMENT_GROUPS}
+
+        # fragments and reads per fragment type
+        self.fragments = {}
+        self.reads = {}
+
+    def filter_hits(self, psl, filtered):
+        """Reads the header and the hits on standard chromosomes of the PSL file, which are copied to filtered.
+        Hits per read and the BED12 lines are collected on the way.
+        Yields the PSL lines of the hits
+        """
+        for count, line in enumerate(psl):
+            if not is_standard(line):
+                continue
+
+            filtered.write(line)
+
+            if count < PSL_HEADER_LINES:
+                self.header.append(line)
+                continue
+
+            cols = line.strip().split("\t")
+            self.mappings[cols[9]] = self.mappings.get(cols[9], 0) + 1
+            self.bed.append(bed_entry(cols))
+
+            yield line
+
+    def run(self):
+
+        psl_file = self.sample + ".psl"
+        temp_psl_file = self.sample + ".temp.psl"
+
+        group_files = {}
+
+        with open(psl_file) as psl, open(temp_psl_file, 'w') as filtered, \
+                open(self.sample + ".scan.psl", 'w') as scan:
+
+            for group in FRAGMENT_GROUPS:
+                group_files[group] = open(self.sample + ".scan." + group + ".psl", 'w')
+
+            hits = self.filter_hits(psl, filtered)
+
+            # make sure the header is read before the first fragment is classified
+            first_hit = next(hits, None)
+
+            scan.writelines(self.header)
+            for group in FRAGMENT_GROUPS:
+                group_files[group].writelines(self.header)
+
+            if first_hit is not None:
+                for fragment in classify_fragments(itertools.chain([first_hit], hits), self.threads):
+                    scan.write(fragment + "\n")
+
+                    cols = fragment.split("\t")
+                    fragment_type = cols[-1]
+
+                    self.fragments[fragment_type] = self.fragments.get(fragment_type, 0) + 1
+                    self.reads.setdefault(fragment_type, set()).add(cols[9])
+
+                    # like grep on the whole line: circRNA also matches Potential_multi-round_circRNA
+                    for group in FRAGMENT_GROUPS:
+                        if group in fragment:
+                            group_files[group].write(fragment + "\n")
+                            self.group_bed[group].append(bed_entry(cols))
+
+            for group in FRAGMENT_GROUPS:
+                group_files[group].close()
+
+        os.replace(temp_psl_file, psl_file)
+
+        self.write_statistics()
+
+        write_lines(self.sample + ".psl.bed", sort_bed(self.bed))
+
+        for group in FRAGMENT_GROUPS:
+            write_lines(self.sample + ".scan." + group + ".psl.bed", sort_bed(self.group_bed[group]))
+
+    def write_statistics(self):
+
+        write_lines("mappings_per_read.txt", uniq_counts(self.mappings))
+
+        # number of reads with the same number of hits
+        histogram = {}
+        for hits in self.mappings.values():
+            histogram[str(hits)] = histogram.get(str(hits), 0) + 1
+        write_lines(self.sample + ".histogram_number_of_genomic_hits_per_read.txt", uniq_counts(histogram))
+
+        fragments = uniq_counts(self.fragments)[:6]
+        reads = uniq_counts({fragment_type: len(names) for fragment_type, names in self.reads.items()})[:6]
+
+        print("")
+        print("The different groups, numbers of read fragments:")
+        print("\n".join(fragments))
+        write_lines(self.sample + ".scan.groupNumbers.fragments.txt", fragments)
+
+        print("")
+        print("The different groups, numbers of unique reads:")
+        print("\n".join(reads))
+        write_lines(self.sample + ".scan.groupNumbers.reads.txt", reads)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Processes the pblat output <sample>.psl of a nanopore sample "
+                                                 "in the current directory")
+    parser.add_argument("sample", help="Sample name, prefix of the PSL file and of all output files")
+    parser.add_argument("-t", "--threads", dest="threads", type=int, default=1,
+                        help="Number of processes classifying the read fragments [default: 1]")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.sample + ".psl"):
+        print("Error: PSL file '{}' does not exist!".format(args.sample + ".psl"))
+        sys.exit(-1)
+
+    PslProcessing(args.sample, args.threads).run()
+
+
+if __name__ == "__main__":
+    main()
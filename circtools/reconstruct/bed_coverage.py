@@ -0,0 +1,276 @@
+# in-process replacement of the bedtools intersect / coverage calls the reconstruct steps run for every circle.
+#
+# the exon BED file is parsed once per process into per chromosome NumPy arrays sorted by start (see exon_index),
+# so the exons of a circle are found by binary search. the reads of a circle come from pysam. results follow the bedtools conventions the downstream code relies on:
+#  - reads are split into blocks at N operations, D operations are part of a block (bedtools -split)
+#  - reads are named like bamToBed does, <name>/1 and <name>/2 for paired reads
+#  - the hits of a read are reported in the order of the bedtools bin index, features in the same bin in
+#    file order
+# per base depth arrays come with constant time window sums and the list style zero lookups of the callers.
+
+import numpy as np
+
+# bedtools bin index: first bin 2^14 bases, each level 2^3 times larger than the one before
+BIN_FIRST_SHIFT = 14
+BIN_NEXT_SHIFT = 3
+BIN_LEVELS = 7
+
+# CIGAR operations which extend (M, D, =, X) or break (N) a block
+BLOCK_OPS = (0, 2, 7, 8)
+SKIP_OP = 3
+
+_exon_indexes = {}
+
+
+def read_blocks(read):
+    """
+    returns the (start, end) blocks of an alignment as bedtools -split uses them.
+    """
+    blocks = []
+    position = read.reference_start
+    block_start = position
+    for operation, length in read.cigartuples:
+        if operation in BLOCK_OPS:
+            position += length
+        elif operation == SKIP_OP:
+            if position > block_start:
+                blocks += [(block_start, position)]
+            position += length
+            block_start = position
+    if position > block_start:
+        blocks += [(block_start, position)]
+    return blocks
+
+
+def read_name(read):
+    if read.is_paired:
+        return '%s/%s' % (read.query_name, 1 if read.is_read1 else 2)
+    return read.query_name
+
+
+def bin_key(start, end):
+    # level and bin of a feature in the bedtools bin index, levels are searched from the smallest bins on
+    start_bin = start >> BIN_FIRST_SHIFT
+    end_bin = max(end - 1, start) >> BIN_FIRST_SHIFT
+    for level in range(BIN_LEVELS):
+        if start_bin == end_bin:
+            return level, start_bin
+        start_bin >>= BIN_NEXT_SHIFT
+        end_bin >>= BIN_NEXT_SHIFT
+    return BIN_LEVELS, 0
+
+
+class ExonIndex(object):
+    """
+    features of a BED file, grouped by chromosome and kept in file order. the fields of each feature are kept as
+    strings, so they can be reported exactly as bedtools does.
+    """
+
+    def __init__(self, bedfile):
+        self.bedfile = bedfile
+        self.fields = []
+        self.lines = []
+        chromosomes = {}
+        input_file = open(bedfile)
+        for line in input_file:
+            if line.startswith('#') or line.startswith('track') or line.startswith('browser') or not line.strip():
+                continue
+            fields = line.rstrip('\n').split('\t')
+            chromosomes.setdefault(fields[0], []).append(len(self.fields))
+            self.fields += [fields]
+            self.lines += ['\t'.join(fields) + '\n']
+        input_file.close()
+
+        self.names = {}
+        for i, fields in enumerate(self.fields):
+            self.names.setdefault(fields[3], []).append(i)
+
+        # chromosome -> (feature numbers, starts, ends, maximal length), sorted by start. a feature can only
+        # overlap [start, end) if its own start is in (start - maximal length, end), which is a contiguous range
+        # of the sorted starts found by binary search
+        self.chromosomes = {}
+        for chromosome, features in chromosomes.items():
+            features = np.array(features, dtype='int64')
+            starts = np.array([int(self.fields[i][1]) for i in features], dtype='int64')
+            ends = np.array([int(self.fields[i][2]) for i in features], dtype='int64')
+            order = np.lexsort((features, starts))
+            self.chromosomes[chromosome] = (features[order], starts[order], ends[order],
+                                            int(max((ends - starts).max(), 0)))
+
+    def region(self, chromosome, start, end):
+        # numbers of the features on chromosome within [start, end], in file order
+        if chromosome not in self.chromosomes:
+            return np.zeros(0, dtype='int64')
+        features, starts, ends, max_length = self.chromosomes[chromosome]
+        lo = np.searchsorted(starts, start, side='left')
+        hi = np.searchsorted(starts, end, side='right')
+        return np.sort(features[lo:hi][ends[lo:hi] <= end])
+
+    def overlapping(self, chromosome, start, end):
+        # numbers of the features on chromosome overlapping [start, end), in file order
+        if chromosome not in self.chromosomes:
+            return np.zeros(0, dtype='int64')
+        features, starts, ends, max_length = self.chromosomes[chromosome]
+        lo = np.searchsorted(starts, start - max_length, side='right')
+        hi = np.searchsorted(starts, end, side='left')
+        return np.sort(features[lo:hi][ends[lo:hi] > start])
+
+    def with_names(self, names):
+        # numbers of the features with one of names, in file order
+        features = []
+        for name in set(names):
+            features += self.names.get(name, [])
+        return sorted(features)
+
+    def intersect(self, reads, features):
+        """
+        bedtools intersect -a reads -b features -split -wo: yields (read, feature number) for each feature
+        overlapping a block of the read, reads in input order and the features of a read in bin index order.
+        """
+        chromosomes = {}
+        for feature in features:
+            chromosomes.setdefault(self.fields[feature][0], []).append(feature)
+        for chromosome in chromosomes:
+            candidates = chromosomes[chromosome]
+            starts = np.array([int(self.fields[i][1]) for i in candidates], dtype='int64')
+            ends = np.array([int(self.fields[i][2]) for i in candidates], dtype='int64')
+            order = np.array(sorted(range(len(candidates)), key=lambda i: bin_key(int(starts[i]), int(ends[i])) +
+                                                                             (candidates[i],)), dtype='int64')
+            chromosomes[chromosome] = (np.array(candidates, dtype='int64')[order], starts[order], ends[order])
+
+        for read in reads:
+            if read.is_unmapped or read.reference_name not in chromosomes:
+                continue
+            candidates, starts, ends = chromosomes[read.reference_name]
+            hit = np.zeros(len(candidates), dtype=bool)
+            for block_start, block_end in read_blocks(read):
+                hit |= (starts < block_end) & (ends > block_start)
+            for feature in candidates[hit].tolist():
+                yield read, feature
+
+    def intersect_intervals(self, features, intervals):
+        """
+        bedtools intersect -a features -b intervals -wo: yields (feature number, interval) for each of the
+        (chromosome, start, end) intervals overlapping a feature, features in input order and the intervals of a
+        feature in bin index order.
+        """
+        chromosomes = {}
+        for i in sorted(range(len(intervals)), key=lambda i: bin_key(intervals[i][1], intervals[i][2]) + (i,)):
+            chromosomes.setdefault(intervals[i][0], []).append(intervals[i])
+        for chromosome in chromosomes:
+            chromosomes[chromosome] = (chromosomes[chromosome],
+                                       np.array([i[1] for i in chromosomes[chromosome]], dtype='int64'),
+                                       np.array([i[2] for i in chromosomes[chromosome]], dtype='int64'))
+
+        for feature in features:
+            fields = self.fields[feature]
+            if fields[0] not in chromosomes:
+                continue
+            candidates, starts, ends = chromosomes[fields[0]]
+            hit = (starts < int(fields[2])) & (ends > int(fields[1]))
+            for i in np.flatnonzero(hit).tolist():
+                yield feature, candidates[i]
+
+    def coverage(self, reads, features):
+        """
+        bedtools coverage -a features -b reads -d -split: yields (feature number, depth array) with the number of
+        read blocks covering each base of the feature, features in input order.
+        """
+        blocks = {}
+        for feature in features:
+            chromosome = self.fields[feature][0]
+            if chromosome not in blocks:
+                blocks[chromosome] = alignment_blocks(reads, chromosome)
+            yield feature, depth(blocks[chromosome], int(self.fields[feature][1]), int(self.fields[feature][2]))
+
+
+def alignment_blocks(reads, chromosome, split=True):
+    """
+    returns the (start, end) blocks of the reads on chromosome as (n, 2) array: the blocks of each read if split,
+    else the whole aligned span of each read (bedtools without -split).
+    """
+    blocks = []
+    for read in reads:
+        if not read.is_unmapped and read.reference_name == chromosome:
+            if split:
+                blocks.extend(read_blocks(read))
+            else:
+                blocks.append((read.reference_start, read.reference_end))
+    return np.array(blocks, dtype='int64').reshape(-1, 2)
+
+
+def depth(blocks, start, end):
+    # per base depth of the (start, end) blocks over [start, end)
+    changes = np.zeros(max(end - start, 0) + 1, dtype='int64')
+    if len(blocks):
+        block_starts = np.clip(blocks[:, 0], start, end) - start
+        block_ends = np.clip(blocks[:, 1], start, end) - start
+        covering = block_ends > block_starts
+        np.add.at(changes, block_starts[covering], 1)
+        np.add.at(changes, block_ends[covering], -1)
+    return np.cumsum(changes[:-1])
+
+
+def exon_index(bedfile):
+    """
+    returns the ExonIndex of bedfile, parsed once per process. the reconstruct steps call this before they start
+    their worker pool, so the forked workers share the index of the parent (copy-on-write) instead of parsing
+    the file again (see map_circles).
+    """
+    if bedfile not in _exon_indexes:
+        _exon_indexes[bedfile] = ExonIndex(bedfile)
+    return _exon_indexes[bedfile]
+
+
+def map_circles(function, circles, cpus, bedfile=None):
+    """
+    yields function(circle) for all circles, computed by a pathos pool of cpus workers. the results come in the
+    order of the circles, so the calling process alone writes the sample results. the ExonIndex of bedfile
+    is built before the workers are forked, so they share it. pathos caches its pools, so the pool is cleared
+    once all results are read: otherwise the next step would reuse workers forked before its index was built.
+    """
+    from pathos.multiprocessing import ProcessingPool as Pool
+
+    if bedfile is not None:
+        exon_index(bedfile)
+
+    pool = Pool(cpus)
+    for result in pool.imap(function, circles):
+        yield result
+    pool.close()
+    pool.join()
+    pool.clear()
+
+
+def prefix_sum(values):
+    # prefix[i] is the sum of values[:i]
+    return np.concatenate((np.zeros(1, dtype='int64'), np.cumsum(values, dtype='int64')))
+
+
+def window_sum(prefix, start, stop):
+    # sum(values[start:stop]) in constant time, with the python slice semantics for negative and large bounds
+    start, stop, step = slice(start, stop).indices(len(prefix) - 1)
+    if stop <= start:
+        return 0
+    return int(prefix[stop] - prefix[start])
+
+
+def first_zero(values):
+    # list(values).index(0)
+    zeros = np.flatnonzero(np.asarray(values) == 0)
+    if len(zeros) == 0:
+        raise ValueError('0 is not in list')
+    return int(zeros[0])
+
+
+def zeros_from_end(values):
+    # list(reversed(values)).index(0)
+    zeros = np.flatnonzero(np.asarray(values) == 0)
+    if len(zeros) == 0:
+        raise ValueError('0 is not in list')
+    return len(values) - 1 - int(zeros[-1])
+
+
+def count_zeros(values):
+    # list(values).count(0)
+    return int(np.count_nonzero(np.asarray(values) == 0))
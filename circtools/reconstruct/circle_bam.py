@@ -0,0 +1,168 @@
+# per sample container for the circle reads extracted by extract_reads, and the reader used by the later
+# reconstruct steps to fetch the reads of one circle at a time.
+#
+# all circle reads of a sample are stored in one coordinate-sorted and indexed bam file <sample>.circles.bam
+# next to the sample folder. every alignment carries the name of its circle in the CIRCLE_TAG tag (an alignment
+# belonging to several circles is stored once per circle). the sidecar table <sample>.circles.txt lists the
+# circles with the number of circular reads and the regions holding their alignments, so the reads of a
+# circle are found with a few indexed fetches instead of scanning the file.
+#
+# outputs of older versions, one <circle>_<n>reads.sorted.bam file per circle in the sample folder, are read
+# through the same interface (see open_circles).
+
+import os
+
+import pysam
+
+CIRCLE_TAG = 'XC'
+BAM_SUFFIX = '.circles.bam'
+INDEX_SUFFIX = '.circles.txt'
+INDEX_HEADER = 'circle\tchr\tstart\tend\tnum_reads\tregions\n'
+
+
+class Circle(object):
+    # one circle, name is <chr>_<start>_<end>_<n>reads as the per circle bam files were named before
+    def __init__(self, name, chromosome, start, end, num_reads, regions=None, bamfile=None):
+        self.name = name
+        self.chromosome = chromosome
+        self.start = start
+        self.end = end
+        self.num_reads = num_reads
+        # (chromosome, start, end) spanned by the alignments of the circle, one region per chromosome
+        self.regions = regions or []
+        # own bam file of the circle, only for outputs of older versions
+        self.bamfile = bamfile
+
+    @property
+    def coordinates(self):
+        return self.chromosome, self.start, self.end
+
+
+def circle_name(circle, num_reads):
+    # name of a circle id chr:start|end from get_readnames_from_DCC
+    return '%s_%sreads' % (circle.replace(':', '_').replace('|', '_'), num_reads)
+
+
+def parse_name(name):
+    """
+    returns the Circle of a name <chr>_<start>_<end>_<n>reads, chromosome names may contain underscores.
+    """
+    fields = name.split('_')
+    return Circle(name, '_'.join(fields[0:-3]), int(fields[-3]), int(fields[-2]),
+                  int(fields[-1].replace('reads', '')))
+
+
+def bam_name(outfolder, sample):
+    return '%s/%s%s' % (outfolder, sample, BAM_SUFFIX)
+
+
+def index_name(outfolder, sample):
+    return '%s/%s%s' % (outfolder, sample, INDEX_SUFFIX)
+
+
+def write_index(filename, circles):
+    """
+    writes the sidecar table, circles is a list of (name, regions), regions a list of (chromosome, start, end)
+    spanned by the alignments of the circle on each chromosome.
+    """
+    output_file = open(filename, 'w')
+    output_file.write(INDEX_HEADER)
+    for name, regions in sorted(circles):
+        circle = parse_name(name)
+        output_file.write('%s\t%s\t%s\t%s\t%s\t%s\n' % (
+            name, circle.chromosome, circle.start, circle.end, circle.num_reads,
+            ','.join('%s:%s-%s' % region for region in regions)))
+    output_file.close()
+
+
+def read_index(filename):
+    circles = []
+    input_file = open(filename)
+    for line in input_file:
+        if line == INDEX_HEADER:
+            continue
+        name, chromosome, start, end, num_reads, regions = line.rstrip('\n').split('\t')
+        circle_regions = []
+        for region in regions.split(','):
+            if region:
+                chrom, span = region.rsplit(':', 1)
+                circle_regions += [(chrom, int(span.split('-')[0]), int(span.split('-')[1]))]
+        circles += [Circle(name, chromosome, int(start), int(end), int(num_reads), circle_regions)]
+    input_file.close()
+    return circles
+
+
+class CircleBam(object):
+    """
+    reader of a consolidated <sample>.circles.bam. the bam file is opened on first use in each process, so
+    instances can be handed to worker processes.
+    """
+
+    def __init__(self, bamfile, indexfile):
+        self.bamfile = bamfile
+        self.indexfile = indexfile
+        self._samfile = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_samfile'] = None
+        return state
+
+    def samfile(self):
+        if self._samfile is None:
+            self._samfile = pysam.AlignmentFile(self.bamfile, 'rb')
+        return self._samfile
+
+    def circles(self):
+        return read_index(self.indexfile)
+
+    def fetch(self, circle):
+        # yields the alignments of circle in coordinate order
+        samfile = self.samfile()
+        for chromosome, start, end in circle.regions:
+            for read in samfile.fetch(chromosome, start, end):
+                if read.get_tag(CIRCLE_TAG) == circle.name:
+                    yield read
+
+    def close(self):
+        if self._samfile is not None:
+            self._samfile.close()
+            self._samfile = None
+
+
+class CircleFolder(object):
+    # reader of the per circle <circle>_<n>reads.bam files written by older versions
+    def __init__(self, folder):
+        self.folder = folder
+
+    def circles(self):
+        # the sorted file of a circle is preferred over an unsorted one left by an interrupted run
+        bamfiles = {}
+        for f in sorted(os.listdir(self.folder)):
+            if f.split('.')[-1] == 'bam':
+                if f.split('.')[0] not in bamfiles or f.split('.')[-2] == 'sorted':
+                    bamfiles[f.split('.')[0]] = '%s/%s' % (self.folder, f)
+        circles = []
+        for name in sorted(bamfiles):
+            circles += [parse_name(name)]
+            circles[-1].bamfile = bamfiles[name]
+        return circles
+
+    def fetch(self, circle):
+        samfile = pysam.AlignmentFile(circle.bamfile, 'rb')
+        for read in samfile:
+            yield read
+        samfile.close()
+
+    def close(self):
+        return
+
+
+def open_circles(outfolder, sample):
+    """
+    returns the reader for the circle reads of sample in outfolder: the consolidated <sample>.circles.bam if
+    present, else the per circle bam files of the sample folder.
+    """
+    if os.path.isfile(bam_name(outfolder, sample)) and os.path.isfile(index_name(outfolder, sample)):
+        return CircleBam(bam_name(outfolder, sample), index_name(outfolder, sample))
+    return CircleFolder('%s/%s' % (outfolder, sample))
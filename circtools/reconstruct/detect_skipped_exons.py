@@ -1,16 +1,17 @@
 # script to identify skipped exons in circRNA bam files
 
 
-import pysam
-import pybedtools
+import io
 import tempfile
-import os
+
+from . import bed_coverage
+from . import circle_bam
 
 
 class detect_skipped_exons(object):
     def __init__(self, outfolder, sample, bedfile, tmp_folder, platform, cpus):
 
-        self.folder = outfolder + sample
+        self.circle_reads = circle_bam.open_circles(outfolder, sample)
         self.sample = sample
         self.outfile = outfolder + sample + ".skipped_exons.txt"
         self.bedfile = bedfile
@@ -19,35 +20,37 @@ class detect_skipped_exons(object):
         self.cpus = cpus
 
         tempfile.tempdir = tmp_folder
-        pybedtools.set_tempdir(tmp_folder)
-
-    def run_parallel(self, f):
 
-        if f.split('.')[-1] == 'bam':
-            circle_id = ('_'.join(f.split('_')[0:-3]), int(f.split('_')[-3]), int(f.split('_')[-2]))
-            bamfile = '%s/%s' % (self.folder, f)
-            READS = self.load_bamfile(bamfile)
-            READS = self.filter_reads(READS)
-            SKIPPED = self.intersect_introns_with_bedfile(self.bedfile, READS, circle_id)
-            if len(SKIPPED) > 0:
-                SKIPPED = self.identify_skipped_exons(bamfile, SKIPPED)
-                self.write_bed12(SKIPPED, self.outfile.replace('.txt', '.bed'), circle_id, self.platform)
-                self.write_exon_skipping(SKIPPED, self.outfile, circle_id, self.platform)
+    def run_parallel(self, circle):
+        """
+        returns the skipped_exons.txt and skipped_exons.bed lines of the circle, which are written by the parent
+        process in circle order.
+        """
+        exon_skipping_out = io.StringIO()
+        bed12_out = io.StringIO()
+        circle_id = circle.coordinates
+        alignments = list(self.circle_reads.fetch(circle))
+        READS = self.load_bamfile(alignments)
+        READS = self.filter_reads(READS)
+        SKIPPED = self.intersect_introns_with_bedfile(self.bedfile, READS, circle_id)
+        if len(SKIPPED) > 0:
+            SKIPPED = self.identify_skipped_exons(alignments, SKIPPED)
+            self.write_bed12(SKIPPED, bed12_out, circle_id, self.platform)
+            self.write_exon_skipping(SKIPPED, exon_skipping_out, circle_id, self.platform)
+        return exon_skipping_out.getvalue(), bed12_out.getvalue()
 
 
                 # define functions
 
-    def load_bamfile(self, bamfile):
+    def load_bamfile(self, alignments):
         reads = {}
-        B = pysam.AlignmentFile(bamfile, 'rb')
-        for i, lola in enumerate(B):
+        for i, lola in enumerate(alignments):
             if not -1 in lola.get_tag('jI'):
                 if not lola.query_name in reads:
                     reads[lola.query_name] = {}
-                reads[lola.query_name][i] = {'reference': B.getrname(lola.reference_id),
+                reads[lola.query_name][i] = {'reference': lola.reference_name,
                                              'breakpoint': lola.get_tag('jI'),
                                              'mapq': lola.mapping_quality}
-        B.close()
         return (reads)
 
     def filter_reads(self, reads):
@@ -66,9 +69,9 @@ class detect_skipped_exons(object):
         return (reads)
 
     def intersect_introns_with_bedfile(self, bedfile, reads, coordinates):
-        exons = pybedtools.example_bedtool(bedfile)
-        exons = exons.filter(
-            lambda b: b.chrom == coordinates[0] and b.start >= coordinates[1] - 1000 and b.end <= coordinates[2] + 1000)
+        # exons within 1000 bp of the circle, the index is shared with the parent process (see run)
+        exons = bed_coverage.exon_index(bedfile)
+        features = exons.region(coordinates[0], coordinates[1] - 1000, coordinates[2] + 1000)
         skipped_exons = {}
         introns = {}
         for lola in reads:
@@ -81,33 +84,24 @@ class detect_skipped_exons(object):
                     if not (reads[lola][forrest]['reference'], start, ends[i]) in introns:
                         introns[(reads[lola][forrest]['reference'], start, ends[i])] = []
                     introns[(reads[lola][forrest]['reference'], start, ends[i])] += [lola]
-        introns_for_bed = '\n'.join([' '.join([str(i) for i in j]) for j in sorted(introns.keys())])
-        intron = pybedtools.BedTool(introns_for_bed, from_string=True)
-        features = exons.intersect(intron, wo=True)
-        for skipped in features:
-            if not (str(skipped[0]), int(skipped[1]), int(skipped[2])) in skipped_exons:
-                skipped_exons[(str(skipped[0]), int(skipped[1]), int(skipped[2]))] = {'reads': [], 'intron': [],
-                                                                                      'name': str(skipped[3])}
-            skipped_exons[(str(skipped[0]), int(skipped[1]), int(skipped[2]))]['reads'] += introns[
-                (str(skipped[6]), int(skipped[7]), int(skipped[8]))]
-            skipped_exons[(str(skipped[0]), int(skipped[1]), int(skipped[2]))]['intron'] += [
-                (str(skipped[6]), int(skipped[7]), int(skipped[8]))]
+        for feature, intron in exons.intersect_intervals(features, sorted(introns.keys())):
+            fields = exons.fields[feature]
+            exon = (str(fields[0]), int(fields[1]), int(fields[2]))
+            if not exon in skipped_exons:
+                skipped_exons[exon] = {'reads': [], 'intron': [], 'name': str(fields[3])}
+            skipped_exons[exon]['reads'] += introns[intron]
+            skipped_exons[exon]['intron'] += [intron]
         return (skipped_exons)
 
-    def identify_skipped_exons(self, bamfile, skipped_exons):
-        bam = pybedtools.example_bedtool(bamfile)
+    def identify_skipped_exons(self, alignments, skipped_exons):
         for lola in skipped_exons:
-            exon_readcount = []
-            coordinates = pybedtools.BedTool('%s %s %s' % (lola[0], lola[1], lola[2]), from_string=True)
-            reads = bam.intersect(coordinates)
-            for r in reads:
-                exon_readcount += [r[0]]
-            exon_readcount = set(exon_readcount)
+            # reads whose alignment span overlaps the exon, as bedtools intersect of the circle bam file
+            exon_readcount = set([r.query_name for r in alignments if r.reference_name == lola[0] and
+                                  r.reference_start < lola[2] and r.reference_end > lola[1]])
             skipped_exons[lola]['exon_readcount'] = len(exon_readcount)
         return (skipped_exons)
 
-    def write_exon_skipping(self, skipped, outfile, circle_id, platform):
-        O = open(outfile, 'a')
+    def write_exon_skipping(self, skipped, O, circle_id, platform):
         for exon in skipped:
             if not len(set(skipped[exon]['reads'])) == skipped[exon]['exon_readcount']:
                 if platform == 'refseq':
@@ -119,11 +113,9 @@ class detect_skipped_exons(object):
                     set(skipped[exon]['intron']),
                     ','.join(set(skipped[exon]['reads'])), len(set(skipped[exon]['reads'])),
                     skipped[exon]['exon_readcount']))
-        O.close()
         return
 
-    def write_bed12(self, skipped, outfile, circle_id, platform):
-        O = open(outfile, 'a')
+    def write_bed12(self, skipped, O, circle_id, platform):
         for exon in skipped:
             if not len(set(skipped[exon]['reads'])) == skipped[exon]['exon_readcount'] and (
                             circle_id[2] - circle_id[1] > 100) and (circle_id[2] >= skipped[exon]['intron'][0][2]) and (
@@ -144,23 +136,21 @@ class detect_skipped_exons(object):
                         (float(len(set(skipped[exon]['reads']))) / skipped[exon]['exon_readcount']) * 100,
                         skipped[exon]['intron'][0][1], skipped[exon]['intron'][0][2], (exon[2] - exon[1]),
                         exon[1] - circle_id[1], circle_id[2] - circle_id[1] - 1))
-        O.close()
         return
 
     def run(self):
 
-        files = os.listdir(self.folder)
+        circles = self.circle_reads.circles()
         outfile_bed = self.outfile.replace('.txt', '.bed')
 
         output_file = open(self.outfile, 'w')
         output_file.write('circle_id\ttranscript_id\tskipped_exon\tintron\tread_names\tsplice_reads\texon_reads\n')
-        output_file.close()
 
-        output_file = open(outfile_bed, 'w')
-        output_file.write('# bed12 format\n')
-        output_file.close()
-
-        from pathos.multiprocessing import ProcessingPool as Pool
+        output_file_bed = open(outfile_bed, 'w')
+        output_file_bed.write('# bed12 format\n')
 
-        p = Pool(self.cpus)
-        p.map(self.run_parallel, files)
+        for exon_skipping, bed12 in bed_coverage.map_circles(self.run_parallel, circles, self.cpus, self.bedfile):
+            output_file.write(exon_skipping)
+            output_file_bed.write(bed12)
+        output_file.close()
+        output_file_bed.close()
@@ -3,6 +3,8 @@
 import pybedtools
 import tempfile
 
+from . import bed_coverage
+
 
 class detect_splicing_variants(object):
     def __init__(self, split_character, platform, circles, bedfile, outfolder, sample, tmp_folder, cpus):
@@ -48,10 +50,7 @@ class detect_splicing_variants(object):
 
     def annotate_circles(self, circles):
 
-        from pathos.multiprocessing import ProcessingPool as Pool
-
-        pool = Pool(self.cpus)
-        tmp = pool.map(self.run_parallel, circles)
+        tmp = bed_coverage.map_circles(self.run_parallel, circles, self.cpus)
 
         new_dict = {}
         for item in tmp:
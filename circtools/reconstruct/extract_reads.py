@@ -1,22 +1,13 @@
 # python script, to extract circular reads from a bam file, based on a
-# tab-separated circle_id - reads file and a bam file. writes out circle-specific bam files
+# tab-separated circle_id - reads file and a bam file. writes out one bam file with the reads of all circles
 
 # required packages
 import os
-import pysam
 import tempfile
 
+import pysam
 
-def run_parallel(f):
-    # no do re-sort sorted files and create duplicates
-    if f.split('.')[-1] == 'bam' and "sorted" not in f:
-        pysam.sort("-o",
-                   '%s' % (f.replace('.bam', '.sorted.bam')),
-                   '%s' % (f)
-                   )
-
-        pysam.index('%s' % (f.replace('.bam', '.sorted.bam')))
-        os.system('rm %s' % (f))
+from . import circle_bam
 
 
 class extract_reads(object):
@@ -46,50 +37,62 @@ class extract_reads(object):
         input_file.close()
         return circle_IDs, reads
 
-    def load_alignment(self, infile, circle_reads, cutoff):
+    def stream_alignment(self, infile, circles, cutoff, mapq_cutoff, outfolder, sample):
         """
-        loads sample bam file and extracts all circular reads based
-        on read list obtained from read_circles or any given list of read ids.
+        single pass over the sample bam file: each circular read is routed to its circles as soon as it is seen.
+        the reads spanning the circle junctions and their mates if mates are present are written to one
+        coordinate-sorted and indexed bam file for the sample, tagged with the name of their circle, see
+        circle_bam. returns the number of circles with reads.
         """
-        reads = {}
+        # only circles passing the read cutoff are written
+        selected = [circle for circle in circles if len(circles[circle]) >= cutoff]
+        names = [circle_bam.circle_name(circle, len(circles[circle])) for circle in selected]
+        read_circles = {}
+        for indx, circle in enumerate(selected):
+            for read in circles[circle]:
+                read_circles.setdefault(read, []).append(indx)
+
         if 'bam' in infile.split('.')[-1]:
-            samfile = pysam.AlignmentFile(self.bamfile, 'rb')
+            samfile = pysam.AlignmentFile(infile, 'rb')
         else:
-            samfile = pysam.AlignmentFile(self.bamfile, 'r')
-        for i, read in enumerate(samfile.fetch()):
-            if read.query_name in circle_reads and read.mapq > cutoff and read.get_tag("HI") == 1:
-                if not read.query_name in reads:
-                    reads[read.query_name] = {}
-                reads[read.query_name][(read.reference_start, read.cigarstring, read.is_reverse)] = read
-        samfile.close()
-        return reads
-
-    def write_circle_bam(self, reads, circles, cutoff, template, outfolder):
-        """
-        for each circle, writes a bam file containing only reads spanning the
-        circle junction and their mates if mates are present.
-        """
-        samfile = pysam.AlignmentFile(template, 'rb')
-        for circle in circles:
-            if len(circles[circle]) >= cutoff:
-                circle_bam = pysam.AlignmentFile(
-                    "%s/%s_%sreads.bam" % (outfolder, circle.replace(':', '_').replace('|', '_'), len(circles[circle])),
-                    "wb", template=samfile)
-                has_content = 0
-                for read in circles[circle]:
-                    if read in reads:
-                        for part in reads[read]:
-                            circle_bam.write(reads[read][part])
-                            has_content += 1
-                circle_bam.close()
-                # nothing was written to the bam file, delete it so that following steps don't operate
-                # on an empty file
-                if has_content == 0:
-                    os.remove("%s/%s_%sreads.bam" % (
-                        outfolder, circle.replace(':', '_').replace('|', '_'), len(circles[circle])))
-
-        samfile.close()
-        return
+            samfile = pysam.AlignmentFile(infile, 'r')
+
+        fd, unsorted_bam = tempfile.mkstemp(prefix='%s.circles.' % sample, suffix='.bam')
+        os.close(fd)
+        regions = {}  # circle index -> chromosome -> [start, end] spanned by the alignments of the circle
+        seen = set()  # repeated copies of the same alignment in the bam file are only written once
+        try:
+            outfile = pysam.AlignmentFile(unsorted_bam, 'wb', template=samfile)
+            # all alignments of the circular reads are kept, wherever they (or their mates) map
+            for read in samfile.fetch(until_eof=True):
+                if read.query_name not in read_circles or read.mapping_quality <= mapq_cutoff \
+                        or read.get_tag("HI") != 1:
+                    continue
+                part = (read.query_name, read.reference_start, read.cigarstring, read.is_reverse)
+                if part in seen:
+                    continue
+                seen.add(part)
+                for indx in read_circles[read.query_name]:
+                    read.set_tag(circle_bam.CIRCLE_TAG, names[indx], value_type='Z')
+                    outfile.write(read)
+                    span = regions.setdefault(indx, {}).setdefault(read.reference_name, [read.reference_start,
+                                                                                         read.reference_end])
+                    span[0] = min(span[0], read.reference_start)
+                    span[1] = max(span[1], read.reference_end)
+            outfile.close()
+
+            # one sort and index for all circles of the sample
+            pysam.sort("-@", '%s' % self.cpus, "-o", circle_bam.bam_name(outfolder, sample), unsorted_bam)
+            pysam.index(circle_bam.bam_name(outfolder, sample))
+        finally:
+            os.remove(unsorted_bam)
+            samfile.close()
+
+        circle_bam.write_index(circle_bam.index_name(outfolder, sample),
+                               [(names[indx], [(chromosome, span[0], span[1])
+                                               for chromosome, span in sorted(regions[indx].items())])
+                                for indx in regions])
+        return len(regions)
 
     def run(self):
 
@@ -97,28 +100,10 @@ class extract_reads(object):
 
         circle_info, circle_reads = self.read_circles(self.circles)
         print(('DONE reading circles, found %s circles' % (len(circle_info))))
-        reads = self.load_alignment(self.bamfile, circle_reads, self.mapq_cutoff)
-        print('DONE extracting circular reads')
-        folders = os.listdir(self.outfolder)
-        if not self.sample in folders:
-            os.mkdir('%s/%s' % (self.outfolder, self.sample))
-        self.write_circle_bam(reads, circle_info, self.cutoff, self.bamfile, '%s/%s' % (self.outfolder, self.sample))
-        print('DONE writing circle bam files\n')
-        # files = os.listdir('%s/%s' % (self.outfolder, self.sample))
-        import glob
-
-        files = glob.glob('%s/%s/*.bam' % (self.outfolder, self.sample))
-
-        # possible sorted files from previous run
-        sorted_bams = glob.glob('%s/%s/*.sorted.bam' % (self.outfolder, self.sample))
-
-        # fix the file / circle count
-        actual_bams = len(files) - len(sorted_bams)
+        num_circles = self.stream_alignment(self.bamfile, circle_info, self.cutoff, self.mapq_cutoff,
+                                            self.outfolder, self.sample)
+        print(('DONE extracting circular reads and writing %s\n' % (
+            circle_bam.bam_name(self.outfolder, self.sample))))
 
         print(('%s circles passed your thresholds of at least %s reads with at least a mapq of %s\n\n' % (
-            actual_bams, self.cutoff, self.mapq_cutoff)))
-
-        from pathos.multiprocessing import ProcessingPool as Pool
-
-        pool = Pool(self.cpus)
-        pool.map(run_parallel, files)
+            num_circles, self.cutoff, self.mapq_cutoff)))
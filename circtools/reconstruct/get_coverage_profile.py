@@ -2,11 +2,14 @@
 # include some checks to make sure input was provided correctly
 
 # required packages
+import io
 import os
 import argparse
-import pybedtools
 import tempfile
 
+from . import bed_coverage
+from . import circle_bam
+
 
 class get_coverage_profile(object):
     def __init__(self, exon_index, split_character, platform, bedfile, outfolder, sample, tmp_folder, cpus):
@@ -20,43 +23,40 @@ class get_coverage_profile(object):
         self.platform = platform
         self.tmp_folder = tmp_folder
         self.exon_count_file = ""
+        self.circle_reads = circle_bam.open_circles(outfolder, sample)
         self.cpus = cpus
 
         # set temp folder
         tempfile.tempdir = tmp_folder
-        pybedtools.set_tempdir(tmp_folder)
 
     # define functions
-    def circle_exon_count(self, bamfile2, bedfile, exon_index, split_character, platform, coordinates):
+    def circle_exon_count(self, reads, exons, exon_index, split_character, platform, coordinates):
 
         # does what I think it does, adjust to collapse different transcripts from the same gene,
         # choose transcript describing the circle best
 
         """
+        counts the reads on the exons of the circle region, as bedtools intersect -bed -wo -split of the
+        circle bam file with the exons of the ExonIndex exons.
         """
-        x = pybedtools.BedTool(bamfile2)
-        b = pybedtools.BedTool(bedfile)
-
-        b = b.filter(
-            lambda b: b.chrom == coordinates[0] and b.start >= coordinates[1] - 1000 and b.end <= coordinates[2] + 1000)
-        y = x.intersect(b, bed=True, wo=True, split=True)
+        features = exons.region(coordinates[0], coordinates[1] - 1000, coordinates[2] + 1000)
         transcripts = {}
         found_features = []
-        y = y.remove_invalid()
 
-        for hit in y:
+        for hit, feature in exons.intersect(reads, features):
 
-            if len(str(hit).split("\t")) < 19:
-                print(("Malformed BED line: " + str(hit)))
+            fields = exons.fields[feature]
+            if len(fields) < 6:
+                print(("Malformed BED line: " + exons.lines[feature]))
                 continue
 
-            found_features += [hit[15]]
-            transcript = hit[15]
-            start = int(hit[13])
-            end = int(hit[14])
+            found_features += [fields[3]]
+            transcript = fields[3]
+            start = int(fields[1])
+            end = int(fields[2])
             length = end - start
-            strand_read = hit[5]
-            strand_feature = hit[17]
+            strand_read = '-' if hit.is_reverse else '+'
+            strand_feature = fields[5]
 
             if platform == 'refseq':
                 transcript_id = split_character.join(transcript.split(split_character)[0:2])
@@ -71,8 +71,8 @@ class get_coverage_profile(object):
             else:
                 exon = 0
 
-            read = hit[3]
-            chromosome = hit[0]
+            read = bed_coverage.read_name(hit)
+            chromosome = hit.reference_name
 
             if not transcript_id in transcripts:
                 transcripts[transcript_id] = {}
@@ -86,11 +86,10 @@ class get_coverage_profile(object):
 
         return transcripts, found_features
 
-    def write_exon_count(self, outfile, exon_count, sample, circle_id,
-                         transcript):  # append to existing exon_count file for the sample
+    def write_exon_count(self, out, exon_count, sample, circle_id,
+                         transcript):  # append to the exon_count results of the sample
         """
         """
-        out = open(outfile, 'a')
         # sample\tcircle_id\ttranscript_id\texon_id\tchr\tstart\tend\tstrand\texon_length\tunique_reads\tfragments\tnumber+\tnumber-\n
         # sort exon ids per transcript..and then iterate from min to max, if one exon isn't in it, fill with 0's, identify potentially skipped exons
         for t in exon_count:
@@ -113,14 +112,10 @@ class get_coverage_profile(object):
                             exon))
         return
 
-    def filter_features(self, bed_features, feature_names):
+    def filter_features(self, exons, feature_names):
         """
         """
-        intervals = ""
-        for interval in bed_features:
-            if interval[3] in feature_names:
-                intervals += str(interval)
-        return intervals
+        return exons.with_names(feature_names)
 
     def choose_transcript(self, exon_counts):
         """
@@ -156,14 +151,13 @@ class get_coverage_profile(object):
             transcript = ''
         return transcript
 
-    def circle_coverage_profile(self, bamfile, bedfile, exon_ind, split_character, platform):
+    def circle_coverage_profile(self, reads, exons, features, exon_ind, split_character, platform):
         """
+        per base coverage of the features, as bedtools coverage -d -split of the features with the circle bam file
         """
-        virtual_bed = pybedtools.BedTool(bedfile, from_string=True)
-        bam = pybedtools.BedTool(bamfile)
-        coverage = virtual_bed.coverage(bam, d=True, split=True)
         transcriptwise_coverage = {}
-        for position in coverage:
+        for feature, coverage in exons.coverage(reads, features):
+            position = exons.fields[feature]
             if platform == 'refseq':
                 transcript = split_character.join(position[3].split(split_character)[0:2])
             elif platform == 'ensembl':
@@ -178,8 +172,8 @@ class get_coverage_profile(object):
                 transcriptwise_coverage[transcript][exon] = {'relative_positions': [], 'position_coverage': [],
                                                              'chromosome': position[0], 'start': position[1],
                                                              'end': position[2]}
-            transcriptwise_coverage[transcript][exon]['position_coverage'] += [position[7]]
-            transcriptwise_coverage[transcript][exon]['relative_positions'] += [position[6]]
+            transcriptwise_coverage[transcript][exon]['position_coverage'] += coverage.tolist()
+            transcriptwise_coverage[transcript][exon]['relative_positions'] += list(range(1, len(coverage) + 1))
         return transcriptwise_coverage
 
     def write_coverage_profile(self, inputfolder, coverage_profile, sample, circle_id, transcript):
@@ -220,7 +214,7 @@ class get_coverage_profile(object):
         return exon_count
 
     def format_to_bed12(self, exon_count, transcript, circle_id, number_of_reads,
-                        outfile):  # correctly formatted now :)
+                        out):  # correctly formatted now :)
         bed12 = {}
         for t in exon_count:
             if t == transcript and len(exon_count[t]) > 0:
@@ -272,38 +266,39 @@ class get_coverage_profile(object):
         Bed12 = []
         for i in sorted(bed12):
             Bed12 += [bed12[i]]
-        o = open(outfile, 'a')
-        o.write('%s\n' % ('\t'.join(Bed12)))
-        o.close()
+        out.write('%s\n' % ('\t'.join(Bed12)))
         return bed12
 
-    def run_parallel(self, f):
-        if f.split('.')[-2] == 'sorted':
-            # extract circle id from filename, works for files
-            # generated by extract_reads.py, consider making this more flexible
-            circle_id = ('_'.join(f.split('_')[0:-3]), int(f.split('_')[-3]), int(f.split('_')[-2]))
-            number_of_reads = int(f.split('_')[-1].split('.')[0].replace('reads', ''))
-            bamfile2 = '%s/%s/%s' % (self.inputfolder, self.sample, f)
-            # open bed feature file
-            b = pybedtools.BedTool(self.bedfile)
-            # get read counts for each exon in circle
-
-            exon_counts, found_features = self.circle_exon_count(bamfile2, self.bedfile, self.exon_index,
-                                                                 self.split_character, self.platform, circle_id)
-            if len(exon_counts) > 0:
-                # choose best fitting transcript
-                transcript_id = self.choose_transcript(exon_counts)
-                # add circle to result table
-                self.write_exon_count(self.exon_count_file, exon_counts, self.sample, circle_id, transcript_id)
-                exon_counts = self.remove_exons_outside_circle(exon_counts, transcript_id, circle_id)
-                self.format_to_bed12(exon_counts, transcript_id, circle_id, number_of_reads,
-                                     '%s/%s.exon_counts.bed' % (self.inputfolder, self.sample))
-                filtered_features = self.filter_features(b, found_features)
-                if len(filtered_features) > 0:
-                    coverage_track = self.circle_coverage_profile(bamfile2, filtered_features, self.exon_index,
-                                                                  self.split_character,
-                                                                  self.platform)
-                    self.write_coverage_profile(self.inputfolder, coverage_track, self.sample, circle_id, transcript_id)
+    def run_parallel(self, circle):
+        """
+        returns the exon_counts.txt and exon_counts.bed lines of the circle, which are written by the parent
+        process in circle order. the coverage profile of the circle is a file of its own.
+        """
+        exon_counts_out = io.StringIO()
+        bed12_out = io.StringIO()
+        circle_id = circle.coordinates
+        number_of_reads = circle.num_reads
+        reads = list(self.circle_reads.fetch(circle))
+        # exon features, shared with the parent process (see run)
+        exons = bed_coverage.exon_index(self.bedfile)
+        # get read counts for each exon in circle
+
+        exon_counts, found_features = self.circle_exon_count(reads, exons, self.exon_index,
+                                                             self.split_character, self.platform, circle_id)
+        if len(exon_counts) > 0:
+            # choose best fitting transcript
+            transcript_id = self.choose_transcript(exon_counts)
+            # add circle to result table
+            self.write_exon_count(exon_counts_out, exon_counts, self.sample, circle_id, transcript_id)
+            exon_counts = self.remove_exons_outside_circle(exon_counts, transcript_id, circle_id)
+            self.format_to_bed12(exon_counts, transcript_id, circle_id, number_of_reads, bed12_out)
+            filtered_features = self.filter_features(exons, found_features)
+            if len(filtered_features) > 0:
+                coverage_track = self.circle_coverage_profile(reads, exons, filtered_features, self.exon_index,
+                                                              self.split_character,
+                                                              self.platform)
+                self.write_coverage_profile(self.inputfolder, coverage_track, self.sample, circle_id, transcript_id)
+        return exon_counts_out.getvalue(), bed12_out.getvalue()
 
     # circle exon count over all bam files in sample folder, this could easily be parralellised
     # also think about using our denovo recontruction as bases for coverage profiles
@@ -315,21 +310,20 @@ class get_coverage_profile(object):
         exon_counts_out = open(self.exon_count_file, 'w')
         exon_counts_out.write('sample\tcircle_id\ttranscript_id\tother_ids\texon_id\tchr\tstart'
                               '\tend\tstrand\texon_length\tunique_reads\tfragments\tnumber+\tnumber-\n')
-        exon_counts_out.close()
 
         output_file = open('%s/%s.exon_counts.bed' % (self.inputfolder, self.sample), 'w')
         output_file.write('# BED12\n')
-        output_file.close()
 
-        # all circle files in a given folder
-        files = os.listdir('%s/%s' % (self.inputfolder, self.sample))
+        # all circles of the sample
+        circles = self.circle_reads.circles()
 
         # create folder for coverage profiles
         folders = os.listdir(self.inputfolder)
         if not '%s.coverage_profiles' % (self.sample) in folders:
             os.mkdir('%s/%s.coverage_profiles' % (self.inputfolder, self.sample))
 
-        from pathos.multiprocessing import ProcessingPool as Pool
-
-        pool = Pool(self.cpus)
-        pool.map(self.run_parallel, files)
+        for exon_counts, bed12 in bed_coverage.map_circles(self.run_parallel, circles, self.cpus, self.bedfile):
+            exon_counts_out.write(exon_counts)
+            output_file.write(bed12)
+        exon_counts_out.close()
+        output_file.close()
@@ -1,9 +1,8 @@
 # required packages
-import os
 import tempfile
 
-import pybedtools
-import pysam
+from . import bed_coverage
+from . import circle_bam
 
 
 # script to identify circles where both mates map over the junction
@@ -12,34 +11,32 @@ import pysam
 
 class mate_information(object):
 
-    def run_parallel(self, f):
+    def run_parallel(self, circle):
 
         internal_dict = {}
 
-        if f.split('.')[-1] == 'bam':
-            circle_coordinates = ['_'.join(f.split('_')[0:-3]), int(f.split('_')[-3]),
-                                  int(f.split('_')[-2])]
-            num_reads = int(f.split('_')[-1].split('.')[0].replace('reads', ''))
-            mates, fragments = self.get_reads_from_bamfile('%s/%s' % (self.bamfolder, f), circle_coordinates)
-            mates = self.classify_reads(mates)
-            if not self.bedfile == 'none':
-                length = self.annotate_circle(circle_coordinates, self.bedfile, self.platform, self.split_character)
-            else:
-                length = {}
-            stats = self.get_statistics(mates)
-            internal_dict[f.split('.')[0]] = stats
-            if len(length) > 0:
-                internal_dict[f.split('.')[0]]['min_length'] = min(list(length.items()), key=lambda x: x[1])[1]
-                internal_dict[f.split('.')[0]]['max_length'] = max(list(length.items()), key=lambda x: x[1])[1]
-                internal_dict[f.split('.')[0]]['transcript_ids'] = ','.join(list(length.keys()))
-            else:
-                internal_dict[f.split('.')[0]]['min_length'] = circle_coordinates[2] - circle_coordinates[1]
-                internal_dict[f.split('.')[0]]['max_length'] = circle_coordinates[2] - circle_coordinates[1]
-                internal_dict[f.split('.')[0]]['transcript_ids'] = 'not_annotated'
-
-            internal_dict[f.split('.')[0]]['circle_id'] = '%s_%s_%s' % (
-                circle_coordinates[0], circle_coordinates[1], circle_coordinates[2])
-            internal_dict[f.split('.')[0]]['num_reads'] = num_reads
+        circle_coordinates = [circle.chromosome, circle.start, circle.end]
+        num_reads = circle.num_reads
+        mates, fragments = self.get_reads_from_bamfile(self.circle_reads.fetch(circle), circle_coordinates)
+        mates = self.classify_reads(mates)
+        if not self.bedfile == 'none':
+            length = self.annotate_circle(circle_coordinates, self.bedfile, self.platform, self.split_character)
+        else:
+            length = {}
+        stats = self.get_statistics(mates)
+        internal_dict[circle.name] = stats
+        if len(length) > 0:
+            internal_dict[circle.name]['min_length'] = min(list(length.items()), key=lambda x: x[1])[1]
+            internal_dict[circle.name]['max_length'] = max(list(length.items()), key=lambda x: x[1])[1]
+            internal_dict[circle.name]['transcript_ids'] = ','.join(list(length.keys()))
+        else:
+            internal_dict[circle.name]['min_length'] = circle_coordinates[2] - circle_coordinates[1]
+            internal_dict[circle.name]['max_length'] = circle_coordinates[2] - circle_coordinates[1]
+            internal_dict[circle.name]['transcript_ids'] = 'not_annotated'
+
+        internal_dict[circle.name]['circle_id'] = '%s_%s_%s' % (
+            circle_coordinates[0], circle_coordinates[1], circle_coordinates[2])
+        internal_dict[circle.name]['num_reads'] = num_reads
 
         return internal_dict
 
@@ -47,7 +44,7 @@ class mate_information(object):
     def __init__(self, platform, split_character, bedfile, outfolder, sample, tmp_folder, cpus):
 
         # parse arguments
-        self.bamfolder = outfolder + sample
+        self.circle_reads = circle_bam.open_circles(outfolder, sample)
         self.outfile = outfolder + sample + ".mate_status.txt"
         self.bedfile = bedfile
         self.platform = platform
@@ -58,14 +55,12 @@ class mate_information(object):
 
         # set temp folder
         tempfile.tempdir = tmp_folder
-        pybedtools.set_tempdir(tmp_folder)
 
     # define functions
-    def get_reads_from_bamfile(self, bamfile, circle_coordinates):
+    def get_reads_from_bamfile(self, reads, circle_coordinates):
         mates = {}
         non_junction_fragments = []
-        circles = pysam.AlignmentFile(bamfile, "rb")
-        for circle in circles:
+        for circle in reads:
             name = circle.query_name
             reverse = circle.is_reverse
             start = circle.reference_start
@@ -82,7 +77,6 @@ class mate_information(object):
                 mates[name]['forward']['start'] += [end]
             else:
                 non_junction_fragments += [circle]
-        circles.close()
         return mates, non_junction_fragments
 
     def classify_reads(self, mates):
@@ -106,10 +100,11 @@ class mate_information(object):
         return stats
 
     def annotate_circle(self, circle_coordinates, bedfile, platform, split_character):
-        circle = pybedtools.BedTool('%s %s %s' % (circle_coordinates[0], circle_coordinates[1], circle_coordinates[2]),
-                                    from_string=True)
-        exons = pybedtools.example_bedtool(bedfile)
-        features = exons.intersect(circle)
+        # exons overlapping the circle, clipped to the circle as by bedtools intersect. the index is shared with
+        # the parent process (see iterate_over_circles)
+        exons = bed_coverage.exon_index(bedfile)
+        features = [exons.fields[f] for f in exons.overlapping(circle_coordinates[0], circle_coordinates[1],
+                                                               circle_coordinates[2]).tolist()]
         lengths = {}
         for feature in features:
             if platform == 'refseq':
@@ -119,19 +114,17 @@ class mate_information(object):
             else:
                 transcript_name = 'NA'
                 print('you are using an unknown reference platform. Please choose between refseq or ensembl')
-            length = int(feature[2]) - int(feature[1])
+            length = min(int(feature[2]), circle_coordinates[2]) - max(int(feature[1]), circle_coordinates[1])
             if not transcript_name in lengths:
                 lengths[transcript_name] = 0
             lengths[transcript_name] += length
         return lengths
 
-    def iterate_over_folder(self, inputfolder, bedfile, platform, split_character):
-        files = os.listdir(inputfolder)
-
-        from pathos.multiprocessing import ProcessingPool as Pool
+    def iterate_over_circles(self, bedfile, platform, split_character):
+        circles = self.circle_reads.circles()
 
-        p = Pool(self.cpus)
-        tmp = p.map(self.run_parallel, files)
+        tmp = bed_coverage.map_circles(self.run_parallel, circles, self.cpus,
+                                       None if bedfile == 'none' else bedfile)
 
         new_dict = {}
         for item in tmp:
@@ -157,5 +150,5 @@ class mate_information(object):
     # run script
     def run(self):
 
-        RESULTS = self.iterate_over_folder(self.bamfolder, self.bedfile, self.platform, self.split_character)
+        RESULTS = self.iterate_over_circles(self.bedfile, self.platform, self.split_character)
         self.write_results(RESULTS, self.outfile)
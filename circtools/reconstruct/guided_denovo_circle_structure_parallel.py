@@ -3,14 +3,19 @@
 
 # define functions
 
-import pysam
-import pybedtools
+import collections
+import io
 
-def load_bamfile(bamfile, coordinates):
+import numpy as np
+
+from . import bed_coverage
+from . import circle_bam
+
+
+def load_bamfile(alignments, coordinates):
     reads = {}
-    B = pysam.AlignmentFile(bamfile, 'rb')
-    for i, lola in enumerate(B):
-        if not lola.get_tag('jI')[0] == -1 and B.getrname(lola.reference_id) == \
+    for i, lola in enumerate(alignments):
+        if not lola.get_tag('jI')[0] == -1 and lola.reference_name == \
                 coordinates[0]:
             if not lola.query_name in reads:
                 reads[lola.query_name] = {}
@@ -18,10 +23,9 @@ def load_bamfile(bamfile, coordinates):
             for b in lola.get_tag('jI'):
                 breakpoints += [b]
             reads[lola.query_name][i] = {
-                'reference': B.getrname(lola.reference_id),
+                'reference': lola.reference_name,
                 'breakpoint': breakpoints,
                 'mapq': lola.mapping_quality}
-    B.close()
     return (reads)
 
 
@@ -68,70 +72,69 @@ def get_introns(reads):
 def connect_introns(introns, circ_coordinates):
     transcripts = {0: [
         (circ_coordinates[0], circ_coordinates[1] - 1, circ_coordinates[1])]}
+    # number of transcripts with each intron chain, to check for existing chains in constant time
+    chains = collections.Counter([tuple(transcripts[0])])
     sorted_introns = sorted(introns.keys())
     for i in sorted_introns:
         # print(i)
         connected = False
         for t in transcripts:
             if i[1] > transcripts[t][-1][2]:
+                chains[tuple(transcripts[t])] -= 1
                 transcripts[t] += [i]
+                chains[tuple(transcripts[t])] += 1
                 connected = True
         if not connected:
             st = sorted(transcripts)
             for t in st:
-                ti = max(transcripts) + 1
-                if not (transcripts[t][:-1] + [i]) in list(
-                        transcripts.values()):
-                    transcripts[ti] = transcripts[t][:-1] + [i]
+                ti = len(transcripts)
+                chain = transcripts[t][:-1] + [i]
+                if chains[tuple(chain)] <= 0:
+                    transcripts[ti] = chain
+                    chains[tuple(chain)] += 1
     for t in transcripts:
         transcripts[t] += [(circ_coordinates[0], circ_coordinates[2] + 1,
                             circ_coordinates[2] + 2)]
     tmp = {}
+    seen = set()
     for key, value in list(transcripts.items()):
-        if value not in list(tmp.values()):
+        if tuple(value) not in seen:
             tmp[key] = value
+            seen.add(tuple(value))
     transcripts = tmp
     return (transcripts)
 
 
-def get_coverage_profile(bamfile, circ_coordinates, transcripts):
-    bam = pybedtools.BedTool(bamfile)
-    coordinates = pybedtools.BedTool('%s %s %s' % (
-        circ_coordinates[0], circ_coordinates[1], circ_coordinates[2]),
-                                     from_string=True)
-    circle_coverage = coordinates.coverage(bam, d=True)
-    split_circle_coverage = coordinates.coverage(bam, d=True, split=True)
-    coverage = []
-    split_coverage = []
-    for lola in circle_coverage:
-        coverage += [int(lola[4])]
-    for lola in split_circle_coverage:
-        split_coverage += [int(lola[4])]
+def get_coverage_profile(reads, circ_coordinates, transcripts):
+    # per base depth over the circle, of the whole reads and of their blocks (bedtools coverage -d [-split])
+    coverage = bed_coverage.depth(
+        bed_coverage.alignment_blocks(reads, circ_coordinates[0], split=False),
+        circ_coordinates[1], circ_coordinates[2])
+    split_coverage = bed_coverage.depth(
+        bed_coverage.alignment_blocks(reads, circ_coordinates[0]),
+        circ_coordinates[1], circ_coordinates[2])
+    prefix = bed_coverage.prefix_sum(coverage)
+    if 0 in coverage:
+        coverage_breaks = [
+            (circ_coordinates[0], circ_coordinates[1] + bed_coverage.first_zero(coverage),
+             circ_coordinates[1] + len(coverage) - bed_coverage.zeros_from_end(coverage))]
+    else:
+        coverage_breaks = []
     transcript_coverage = {}
     for t in transcripts:
         transcript_coverage[t] = {'exons': {}, 'introns': {}}
-        if 0 in coverage:
-            transcript_coverage[t]['coverage_breaks'] = [
-                (circ_coordinates[0], circ_coordinates[1] + coverage.index(0),
-                 circ_coordinates[1] + len(coverage) - (
-                     list(reversed(coverage)).index(0)))]
-        else:
-            transcript_coverage[t]['coverage_breaks'] = []
+        transcript_coverage[t]['coverage_breaks'] = list(coverage_breaks)
         for i, intron in enumerate(transcripts[t]):
             if i > 0 and (i + 1) < len(transcripts[t]) and (
                     intron[2] - intron[1]) > 0:
-                transcript_coverage[t]['introns'][intron] = sum(
-                    coverage[intron[1] - circ_coordinates[1]:intron[2] -
-                                                             circ_coordinates[
-                                                                 1]]) / float(
-                    intron[2] - intron[1])
+                transcript_coverage[t]['introns'][intron] = bed_coverage.window_sum(
+                    prefix, intron[1] - circ_coordinates[1],
+                    intron[2] - circ_coordinates[1]) / float(intron[2] - intron[1])
             if not (i + 1) == len(transcripts[t]):
                 transcript_coverage[t]['exons'][
-                    (intron[0], intron[2], transcripts[t][i + 1][1] - 1)] = sum(
-                    coverage[
-                    intron[2] - circ_coordinates[1]:transcripts[t][i + 1][1] -
-                                                    circ_coordinates[
-                                                        1]]) / float(
+                    (intron[0], intron[2], transcripts[t][i + 1][1] - 1)] = bed_coverage.window_sum(
+                    prefix, intron[2] - circ_coordinates[1],
+                    transcripts[t][i + 1][1] - circ_coordinates[1]) / float(
                     transcripts[t][i + 1][1] - intron[2])
     return (transcript_coverage, coverage, split_coverage)
 
@@ -145,47 +148,41 @@ def filter_out_exons(transcript_coverage, split_coverage,
             relative_start = exon[1] - circ_coordinates[1]
             relative_end = exon[2] - circ_coordinates[1] - 1
             coverage = split_coverage[relative_start:relative_end]
-
-            if sum(coverage) > 0:
-                if 0 in coverage and not (
+            total = int(coverage.sum())
+
+            if total > 0:
+                has_zero = 0 in coverage
+                if has_zero:
+                    # bases before the first and after the last uncovered base
+                    first_zero = bed_coverage.first_zero(coverage)
+                    zeros_from_end = bed_coverage.zeros_from_end(coverage)
+                if has_zero and not (
                         coverage[0] == 0 or coverage[-1] == 0):
-                    breakpoint = coverage.index(0)
-                    new_end = exon[1] + coverage.index(0) - 1
-                    new_start = exon[2] - (
-                        list(reversed(coverage)).index(0)) - 1
-                    avg_coverage = sum(coverage[:coverage.index(0)]) / float(
-                        coverage.index(0))
-                    avg_coverage_right = sum(list(reversed(coverage))[
-                                             :list(reversed(coverage)).index(
-                                                 0)]) / float(
-                        list(reversed(coverage)).index(0))
+                    new_end = exon[1] + first_zero - 1
+                    new_start = exon[2] - zeros_from_end - 1
+                    avg_coverage = int(coverage[:first_zero].sum()) / float(
+                        first_zero)
+                    avg_coverage_right = int(coverage[len(coverage) - zeros_from_end:].sum()) / float(
+                        zeros_from_end)
                     exons_to_remove += [exon]
                     tmp_exons[(exon[0], exon[1], new_end)] = avg_coverage
                     tmp_exons[
                         (exon[0], new_start, exon[2])] = avg_coverage_right
-                elif 0 in coverage and coverage[0] == 0 and not (list(
-                        coverage).index(0)) == 0:
-                    breakpoint = coverage.index(0)
-                    new_end = exon[1] + coverage.index(0) - 1
-                    new_start = exon[2] - (list(reversed(coverage)).index(0))
-                    avg_coverage_right = sum(list(reversed(coverage))[
-                                             :list(reversed(coverage)).index(
-                                                 0)]) / float(
-                        list(reversed(coverage)).index(0))
+                elif has_zero and coverage[0] == 0 and not first_zero == 0:
+                    new_start = exon[2] - zeros_from_end
+                    avg_coverage_right = int(coverage[len(coverage) - zeros_from_end:].sum()) / float(
+                        zeros_from_end)
                     exons_to_remove += [exon]
                     tmp_exons[
                         (exon[0], new_start, exon[2])] = avg_coverage_right
-                elif 0 in coverage and coverage[-1] == 0 and not coverage.index(
-                        0) == 0:
-                    breakpoint = coverage.index(0)
-                    new_end = exon[1] + coverage.index(0) - 1
-                    new_start = exon[2] - (list(reversed(coverage)).index(0))
-                    avg_coverage = sum(coverage[:coverage.index(0)]) / float(
-                        coverage.index(0))
+                elif has_zero and coverage[-1] == 0 and not first_zero == 0:
+                    new_end = exon[1] + first_zero - 1
+                    avg_coverage = int(coverage[:first_zero].sum()) / float(
+                        first_zero)
                     exons_to_remove += [exon]
                     tmp_exons[(exon[0], exon[1], new_end)] = avg_coverage
                 else:
-                    avg_coverage = sum(coverage) / float(len(coverage))
+                    avg_coverage = total / float(len(coverage))
                     transcript_coverage[t]['exons'][exon] = avg_coverage
             else:
                 exons_to_remove += [exon]
@@ -214,25 +211,21 @@ def collapse_transcripts(transcript_coverage):
 
 
 def infer_missing_structure(transcripts, coordinates, bedfile):
-    B = pybedtools.BedTool(bedfile)
-    # B = B.filter(lambda b: b.chrom == coordinates[0] and b.start >= coordinates[1] and b.end <= coordinates[2])
+    # annotated exons, shared with the parent process (see main)
+    B = bed_coverage.exon_index(bedfile)
     for t in transcripts:
         if len(transcripts[t]['coverage_breaks']) > 0:
             for unsupported in transcripts[t]['coverage_breaks']:
-                missing_region = pybedtools.BedTool('%s %s %s' % (
-                    unsupported[0], unsupported[1], unsupported[2]),
-                                                    from_string=True)
-                features = B.intersect(missing_region)
-                unsuported_exons = {}
-                for f in features:
+                # parts of the annotated exons within the unsupported region, as bedtools intersect
+                for f in B.overlapping(unsupported[0], unsupported[1], unsupported[2]).tolist():
                     transcripts[t]['exons'][
-                        (str(f[0]), int(f[1]), int(f[2]))] = 0
+                        (str(B.fields[f][0]), max(int(B.fields[f][1]), unsupported[1]),
+                         min(int(B.fields[f][2]), unsupported[2]))] = 0
+        # merge_exons does not change the exons any more once a pass merged nothing
         merged = [1]
-        counter = 0
-        while len(merged) > 0 or counter < 100:
+        while len(merged) > 0:
             transcripts[t]['exons'], merged = merge_exons(
                 transcripts[t]['exons'])
-            counter += 1
     return (transcripts)
 
 
@@ -277,15 +270,14 @@ def merge_exons(exons):
     return (new_exons, merged)
 
 
-def write_bed12(outfile, transcript_coverage, circ_coordinates, coverage,
+def write_bed12(O, transcript_coverage, circ_coordinates, coverage,
                 introns):
-    O = open(outfile, 'a')
     for t in transcript_coverage:
         O.write('%s\t%s\t%s\t%s:%s-%s|%s|%s\t' % (
             circ_coordinates[0], circ_coordinates[1], circ_coordinates[2],
             circ_coordinates[0], circ_coordinates[1],
             circ_coordinates[2], t,
-            1 - (coverage.count(0) / float(len(coverage)))))
+            1 - (bed_coverage.count_zeros(coverage) / float(len(coverage)))))
         transcript_confidence = []
         if len(transcript_coverage[t]['introns']) > 0:
             for i in transcript_coverage[t]['introns']:
@@ -319,13 +311,12 @@ def write_bed12(outfile, transcript_coverage, circ_coordinates, coverage,
                 exon_location += ['%s' % e_location]
 
         O.write('%s\t%s\n' % (','.join(exon_length), ','.join(exon_location)))
-    O.close()
     return
 
 
-def write_bed6(transcript_coverage, outfile, circ_coordinates, coverage):
+def write_bed6(transcript_coverage, O, circ_coordinates, coverage):
     exons = {}
-    O = open(outfile, 'a')
+    prefix = bed_coverage.prefix_sum(coverage)
     for t in transcript_coverage:
         for e in transcript_coverage[t]['exons']:
             if not e in exons:
@@ -337,61 +328,56 @@ def write_bed6(transcript_coverage, outfile, circ_coordinates, coverage):
         O.write('%s\t%s\t%s\t%s:%s-%s|%i|%s\t%s\t.\n' % (
             e[0], e[1], e[2], circ_coordinates[0], circ_coordinates[1],
             circ_coordinates[2], i, ','.join(exons[e]),
-            int(sum(coverage[e[1] - circ_coordinates[1]:e[2] - circ_coordinates[
-                1]]) / float(e[2] - e[1]))))
-    O.close()
+            int(bed_coverage.window_sum(prefix, e[1] - circ_coordinates[1],
+                                        e[2] - circ_coordinates[1]) / float(e[2] - e[1]))))
     return
 
 
-def get_coverage(circ_coordinates, bamfile):
-    bam = pybedtools.BedTool(bamfile)
-    coordinates = pybedtools.BedTool('%s %s %s' % (
-        circ_coordinates[0], circ_coordinates[1], circ_coordinates[2]),
-                                     from_string=True)
-    circle_coverage = coordinates.coverage(bam, d=True)
-    coverage = []
-    for lola in circle_coverage:
-        coverage += [int(lola[4])]
-    return (coverage)
+def get_coverage(circ_coordinates, reads):
+    # per base depth of the whole reads over the circle (bedtools coverage -d)
+    return bed_coverage.depth(
+        bed_coverage.alignment_blocks(reads, circ_coordinates[0], split=False),
+        circ_coordinates[1], circ_coordinates[2])
 
 
-def write_single_exon(outfile, coverage, circ_coordinates, annotation):
+def write_single_exon(outputs, outfile, coverage, circ_coordinates, annotation):
     if not annotation == '.':
-        O12 = open('%sinferred_12.bed' % (outfile), 'a')
-        O6 = open('%sinferred_6.bed' % (outfile), 'a')
+        O12 = outputs['%sinferred_12.bed' % (outfile)]
+        O6 = outputs['%sinferred_6.bed' % (outfile)]
     else:
-        O12 = open('%s12.bed' % (outfile), 'a')
-        O6 = open('%s6.bed' % (outfile), 'a')
-    if 0 in coverage and sum(coverage) > 0:
+        O12 = outputs['%s12.bed' % (outfile)]
+        O6 = outputs['%s6.bed' % (outfile)]
+    if 0 in coverage and np.sum(coverage) > 0:
+        first_zero = bed_coverage.first_zero(coverage)
         breakpoints = (
-            circ_coordinates[1] + coverage.index(0),
-            circ_coordinates[2] - (list(reversed(coverage)).index(0)))
+            circ_coordinates[1] + first_zero,
+            circ_coordinates[2] - bed_coverage.zeros_from_end(coverage))
         if circ_coordinates[2] == breakpoints[1] or len(coverage) == 0 or float(
-                coverage.index(0)) == 0:
+                first_zero) == 0:
             return
         exon1 = (circ_coordinates[0], circ_coordinates[1], breakpoints[0])
         exon2 = (circ_coordinates[0], breakpoints[1], circ_coordinates[2])
+        left = int(np.sum(coverage[:first_zero]))
+        right = int(np.sum(coverage[breakpoints[1] - circ_coordinates[1]:]))
         O12.write(
             '%s\t%s\t%s\t%s:%s-%s|0|%s\t%s\t.\t%s\t%s\t255,0,0\t2\t%s,%s\t0,%s\n' % (
                 circ_coordinates[0], circ_coordinates[1], circ_coordinates[2],
                 circ_coordinates[0], circ_coordinates[1],
                 circ_coordinates[2],
-                1 - (coverage.count(0) / float(len(coverage))), int((sum(
-                    coverage[:coverage.index(0)]) / float(
-                    coverage.index(0)) + sum(
-                    coverage[breakpoints[1] - circ_coordinates[1]:]) / float(
+                1 - (bed_coverage.count_zeros(coverage) / float(len(coverage))), int((left / float(
+                    first_zero) + right / float(
                     circ_coordinates[2] - breakpoints[1])) / 2),
-                circ_coordinates[1], circ_coordinates[2], coverage.index(0),
+                circ_coordinates[1], circ_coordinates[2], first_zero,
                 circ_coordinates[2] - breakpoints[1],
                 breakpoints[1] - circ_coordinates[1]))
         O6.write('%s\t%s\t%s\t%s:%s-%s|0|0\t%s\t.\n' % (
             exon1[0], exon1[1], exon1[2], circ_coordinates[0],
             circ_coordinates[1], circ_coordinates[2],
-            int(sum(coverage[:coverage.index(0)]) / float(coverage.index(0)))))
+            int(left / float(first_zero))))
         O6.write('%s\t%s\t%s\t%s:%s-%s|1|0\t%s\t.\n' % (
             exon2[0], exon2[1], exon2[2], circ_coordinates[0],
             circ_coordinates[1], circ_coordinates[2],
-            int(sum(coverage[breakpoints[1] - circ_coordinates[1]:]) / float(
+            int(right / float(
                 circ_coordinates[2] - breakpoints[1]))))
     elif not 0 in coverage:
         O12.write(
@@ -399,106 +385,110 @@ def write_single_exon(outfile, coverage, circ_coordinates, annotation):
                 circ_coordinates[0], circ_coordinates[1], circ_coordinates[2],
                 circ_coordinates[0], circ_coordinates[1],
                 circ_coordinates[2],
-                1 - (coverage.count(0) / float(len(coverage))),
-                int(sum(coverage) / float(len(coverage))),
+                1 - (bed_coverage.count_zeros(coverage) / float(len(coverage))),
+                int(int(np.sum(coverage)) / float(len(coverage))),
                 circ_coordinates[1], circ_coordinates[2],
                 circ_coordinates[2] - circ_coordinates[1]))
         O6.write('%s\t%s\t%s\t%s:%s-%s|0|0\t%s\t.\n' % (
             circ_coordinates[0], circ_coordinates[1], circ_coordinates[2],
             circ_coordinates[0], circ_coordinates[1],
-            circ_coordinates[2], int(sum(coverage) / float(len(coverage)))))
+            circ_coordinates[2], int(int(np.sum(coverage)) / float(len(coverage)))))
     else:
         print(('no reads for circle %s:%s-%s' % (
             circ_coordinates[0], circ_coordinates[1], circ_coordinates[2])))
-    O6.close()
-    O12.close()
     return
 
 
-def run_denovo_exon_chain_reconstruction(f, folder, annotation, outfile):
-    if f.split('.')[-1] == 'bam':
-        print(f)
-        # extract generic information from filename
-        circ_coordinates = ('_'.join(f.split('_')[0:-3]), int(f.split('_')[-3]),
-                            int(f.split('_')[-2]))
-        num_reads = int(f.split('_')[-1].split('.')[0].replace('reads', ''))
-        bamfile = '%s/%s' % (folder, f)
-        # load bamfile
-        READS = load_bamfile(bamfile, circ_coordinates)
-        READS = filter_reads(READS, circ_coordinates)
-        Introns = get_introns(READS)
-        if len(Introns) > 0:
-            # reconstruct transcripts
-            T = connect_introns(Introns, circ_coordinates)
-            # get coverage for Transcripts
-            TC, Cov, splitCov = get_coverage_profile(bamfile, circ_coordinates,
-                                                     T)
-            TC = filter_out_exons(TC, splitCov, circ_coordinates)
+def run_denovo_exon_chain_reconstruction(circle, circle_reads, annotation, outfile):
+    """
+    returns the circle name, its number of introns and the lines for each of the result files, which are
+    written by the parent process in circle order.
+    """
+    outputs = collections.defaultdict(io.StringIO)
+    f = circle.name
+    print(f)
+    circ_coordinates = circle.coordinates
+    reads = list(circle_reads.fetch(circle))
+    # load bamfile
+    READS = load_bamfile(reads, circ_coordinates)
+    READS = filter_reads(READS, circ_coordinates)
+    Introns = get_introns(READS)
+    if len(Introns) > 0:
+        # reconstruct transcripts
+        T = connect_introns(Introns, circ_coordinates)
+        # get coverage for Transcripts
+        TC, Cov, splitCov = get_coverage_profile(reads, circ_coordinates,
+                                                 T)
+        TC = filter_out_exons(TC, splitCov, circ_coordinates)
+        if not annotation == '.':
+            TC = infer_missing_structure(TC, circ_coordinates, annotation)
+            # write out results to 3 different files, this will probably have to be adjuste
+            write_bed12(outputs['%sinferred_12.bed' % (outfile)], TC,
+                        circ_coordinates, Cov, Introns)
+            write_bed6(TC, outputs['%sinferred_6.bed' % (outfile)], circ_coordinates,
+                       splitCov)
+        else:
+            write_bed12(outputs['%s12.bed' % (outfile)], TC, circ_coordinates, Cov,
+                        Introns)
+            write_bed6(TC, outputs['%s6.bed' % (outfile)], circ_coordinates,
+                       splitCov)
+
+    else:
+        Cov = get_coverage(circ_coordinates, reads)
+        if not 0 in Cov or annotation == '.':
+            write_single_exon(outputs, outfile, Cov, circ_coordinates, annotation)
+        elif np.sum(Cov) > 0:
+            first_zero = bed_coverage.first_zero(Cov)
+            breakpoints = (circ_coordinates[1] + first_zero,
+                           circ_coordinates[2] - bed_coverage.zeros_from_end(Cov))
+
+            # print(breakpoints)
+            # print(breakpoints[1])
+            #
+            print((circ_coordinates[2]))
+            #
+            # print(float(circ_coordinates[2] - breakpoints[1]))
+
+            if circ_coordinates[2] == breakpoints[1] or first_zero == 0:
+                return f, len(Introns), results_of(outputs)
+            # print(float(Cov.index(0)))
+            # print(float(circ_coordinates[2] - breakpoints[1]))
+
+            print(str(float(circ_coordinates[2] - breakpoints[1]) -
+                      breakpoints[1]))
+            print(str(float(first_zero)))
+
+            TC = {
+                0: {'introns': Introns, 'coverage_breaks': [
+                    (circ_coordinates[0], breakpoints[0], breakpoints[1])],
+                    'exons': {
+                        (circ_coordinates[0], circ_coordinates[1],
+                         breakpoints[0]): int(np.sum(Cov[:first_zero])) / float(
+                            first_zero), (
+                            circ_coordinates[0], breakpoints[1],
+                            circ_coordinates[2]): int(np.sum(
+                            Cov[
+                            breakpoints[1] - circ_coordinates[1]:])) / float(
+                            circ_coordinates[2] - breakpoints[1])}}}
             if not annotation == '.':
-                TC = infer_missing_structure(TC, circ_coordinates, annotation)
-                # write out results to 3 different files, this will probably have to be adjuste
-                write_bed12('%sinferred_12.bed' % (outfile), TC,
+                TC = infer_missing_structure(TC, circ_coordinates,
+                                             annotation)
+                write_bed12(outputs['%sinferred_12.bed' % (outfile)], TC,
                             circ_coordinates, Cov, Introns)
-                write_bed6(TC, '%sinferred_6.bed' % (outfile), circ_coordinates,
-                           splitCov)
+                write_bed6(TC, outputs['%sinferred_6.bed' % (outfile)],
+                           circ_coordinates, Cov)
             else:
-                write_bed12('%s12.bed' % (outfile), TC, circ_coordinates, Cov,
-                            Introns)
-                write_bed6(TC, '%s6.bed' % (outfile), circ_coordinates,
-                           splitCov)
-
+                write_bed12(outputs['%s12.bed' % (outfile)], TC, circ_coordinates,
+                            Cov, Introns)
+                write_bed6(TC, outputs['%s6.bed' % (outfile)], circ_coordinates, Cov)
         else:
-            Cov = get_coverage(circ_coordinates, bamfile)
-            if not 0 in Cov or annotation == '.':
-                write_single_exon(outfile, Cov, circ_coordinates, annotation)
-            elif sum(Cov) > 0:
-                breakpoints = (circ_coordinates[1] + Cov.index(0),
-                               circ_coordinates[2] - (
-                                   list(reversed(Cov)).index(0)))
-
-                # print(breakpoints)
-                # print(breakpoints[1])
-                #
-                print((circ_coordinates[2]))
-                #
-                # print(float(circ_coordinates[2] - breakpoints[1]))
-
-                if circ_coordinates[2] == breakpoints[1] or Cov.index(0) == 0:
-                    return f, len(Introns)
-                # print(float(Cov.index(0)))
-                # print(float(circ_coordinates[2] - breakpoints[1]))
-
-                print(str(float(circ_coordinates[2] - breakpoints[1]) -
-                          breakpoints[1]))
-                print(str(float(Cov.index(0))))
-
-                TC = {
-                    0: {'introns': Introns, 'coverage_breaks': [
-                        (circ_coordinates[0], breakpoints[0], breakpoints[1])],
-                        'exons': {
-                            (circ_coordinates[0], circ_coordinates[1],
-                             breakpoints[0]): sum(Cov[:Cov.index(0)]) / float(
-                                Cov.index(0)), (
-                                circ_coordinates[0], breakpoints[1],
-                                circ_coordinates[2]): sum(
-                                Cov[
-                                breakpoints[1] - circ_coordinates[1]:]) / float(
-                                circ_coordinates[2] - breakpoints[1])}}}
-                if not annotation == '.':
-                    TC = infer_missing_structure(TC, circ_coordinates,
-                                                 annotation)
-                    write_bed12('%sinferred_12.bed' % (outfile), TC,
-                                circ_coordinates, Cov, Introns)
-                    write_bed6(TC, '%sinferred_6.bed' % (outfile),
-                               circ_coordinates, Cov)
-                else:
-                    write_bed12('%s12.bed' % (outfile), TC, circ_coordinates,
-                                Cov, Introns)
-                    write_bed6(TC, '%s6.bed' % (outfile), circ_coordinates, Cov)
-            else:
-                print(('no reads mapped for %s' % f))
+            print(('no reads mapped for %s' % f))
+
+    return f, len(Introns), results_of(outputs)
+
 
-    return f, len(Introns)
+def results_of(outputs):
+    return dict((name, output.getvalue()) for name, output in outputs.items())
 
 
 # Run script
@@ -520,7 +510,7 @@ def main():
     # input
     parser.add_argument('-I', '--inputFolder', dest='inputfolder',
                         required=True,
-                        help='folder containing all circle bam files. (full path, but without sample name)')
+                        help='folder containing the circle bam file(s) of the sample. (full path, but without sample name)')
     parser.add_argument('-N', '--sampleName', dest='sample', required=True,
                         help='sample_name to title every thing.')
     # options
@@ -562,46 +552,45 @@ def main():
     tempfile.tempdir = tmp_folder
     pybedtools.set_tempdir(tmp_folder)
 
-    folder = '%s/%s/' % (infolder, sample)
-    if not os.path.isabs(folder):
-        folder = os.path.abspath(os.path.join(working_dir, folder))
-        print(('changed inputfolder folder to %s\n' % (folder)))
-    if not os.path.isdir(folder):
-        print(('ERROR, no such file or directory: %s' % (folder)))
+    # reads of all circles in <sample>.circles.bam, or one bam file per circle in the sample folder
+    circle_reads = circle_bam.open_circles(infolder, sample)
+    if isinstance(circle_reads, circle_bam.CircleFolder) and not os.path.isdir(circle_reads.folder):
+        print(('ERROR, no such file or directory: %s or %s' % (
+            circle_bam.bam_name(infolder, sample), circle_reads.folder)))
         quit()
 
     outfile = '%s/%s_exon_chain_' % (infolder, sample)
 
+    # result files, only written by this process
+    output_files = {}
     if not annotation_file == '.':
-        output = open('%sinferred_12.bed' % (outfile), 'w')
-        output.write('#bed12\n')
-        output.close()
+        output_files['%sinferred_12.bed' % (outfile)] = open('%sinferred_12.bed' % (outfile), 'w')
+        output_files['%sinferred_12.bed' % (outfile)].write('#bed12\n')
 
-        output = open('%sinferred_6.bed' % (outfile), 'w')
-        output.write('#bed6\n')
-        output.close()
+        output_files['%sinferred_6.bed' % (outfile)] = open('%sinferred_6.bed' % (outfile), 'w')
+        output_files['%sinferred_6.bed' % (outfile)].write('#bed6\n')
     else:
-        output = open('%s12.bed' % (outfile), 'w')
-        output.write('#bed12\n')
-        output.close()
+        output_files['%s12.bed' % (outfile)] = open('%s12.bed' % (outfile), 'w')
+        output_files['%s12.bed' % (outfile)].write('#bed12\n')
 
-        output = open('%s6.bed' % (outfile), 'w')
-        output.write('#bed6\n')
-        output.close()
+        output_files['%s6.bed' % (outfile)] = open('%s6.bed' % (outfile), 'w')
+        output_files['%s6.bed' % (outfile)].write('#bed6\n')
+
+    # parse the annotation before the workers are forked, so they share the index
+    if not annotation_file == '.':
+        bed_coverage.exon_index(annotation_file)
 
     # Start my pool
     pool = multiprocessing.Pool(num_cpus)
 
-    files = os.listdir(folder)
-    files = sorted(files)
+    circles = circle_reads.circles()
     # Build task list
     tasks = []
     plotNum = 0
-    for f in files:
-        if f.split('.')[-1] == 'bam':
-            tasks.append((f, folder, annotation_file, outfile))
-            # run_denovo_exon_chain_reconstruction(f, folder, annotation_file, outfile)
-    print((len(files)))
+    for circle in circles:
+        tasks.append((circle, circle_reads, annotation_file, outfile))
+        # run_denovo_exon_chain_reconstruction(circle, circle_reads, annotation_file, outfile)
+    print((len(circles)))
     print(("Processing %d circRNAs using %d processors..." % (
         len(tasks), num_cpus)))
 
@@ -609,10 +598,14 @@ def main():
     results = [pool.apply_async(run_denovo_exon_chain_reconstruction, t) for t
                in tasks]
 
-    # Process results
+    # Process results, in the order of the circles
     for result in results:
-        (filename, introns) = result.get()
+        (filename, introns, outputs) = result.get()
+        for name in sorted(outputs):
+            output_files[name].write(outputs[name])
         print(("Result: circRNA %s has %s introns" % (filename, introns)))
+    for output in output_files.values():
+        output.close()
 
     pool.close()
     pool.join()
@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+from circtools.detect import countMatrix as Cm
+
+HEADER = 'Chr\tStart\tEnd\tStrand\tsample1\tsample2\n'
+
+
+def write_table(path, rows):
+    with open(path, 'w') as table:
+        table.write(HEADER)
+        for row in rows:
+            table.write('\t'.join(row) + '\n')
+    return str(path)
+
+
+def test_convert_count_table(tmp_path):
+    table = write_table(tmp_path / 'CircRNACount', [['1', '100', '200', '+', '0', '3'],
+                                                     ['2', '300', '400', '-', '5', '0']])
+
+    assert Cm.convert(table) == table + '.npz'
+    assert Cm.hasnpz(table)
+
+    matrix = Cm.load(table)
+    assert matrix.samples == ['sample1', 'sample2']
+    assert matrix.coordinates.tolist() == [['1', '100', '200', '+'], ['2', '300', '400', '-']]
+    assert matrix.todense().tolist() == [[0, 3], [5, 0]]
+
+
+def test_convert_circskipjunctions(tmp_path):
+    table = write_table(tmp_path / 'CircSkipJunctions', [['1', '100', '200', '+', 'chr1:50-99+:3;chr1:120-150+:1', '0'],
+                                                         ['2', '300', '400', '-', '0', 'chr2:250-299-:2']])
+
+    with pytest.raises(ValueError):
+        Cm.convert(table)
+    assert not os.path.isfile(table + '.npz')
+
+    # a stray .npz is never preferred over the text table
+    open(table + '.npz', 'w').close()
+    assert not Cm.hasnpz(table)
+
+
+def test_readtext_non_numeric(tmp_path):
+    table = write_table(tmp_path / 'junctions', [['1', '100', '200', '+', 'chr1:50-99+:3', '0']])
+
+    with pytest.raises(ValueError, match='not a count table'):
+        Cm.readtext(table)